@@ -0,0 +1,30 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Benchmarks for steelscript.wireshark.
+
+Run from the top of the source tree, without network access::
+
+    # Write a synthetic capture
+    python -m benchmarks generate /tmp/bench.pcap --packets 100000
+
+    # Run the benchmark matrix and save the results
+    python -m benchmarks run --sizes 10000,100000 --workers 1,4 \\
+        --output results-$(git rev-parse --short HEAD).json
+
+    # Compare two runs, exits with status 1 on a regression
+    python -m benchmarks compare results-old.json results-new.json
+
+The cases are ``info``, ``query`` (per backend: native decoding,
+tshark and, when installed, steelscript.packets), ``export``, ``index``,
+``split`` (the App Framework split into byte ranges, per worker count)
+and ``fields`` (rebuilding the tshark field catalog).  Native decoding
+is turned off for every other backend and case.  Each result records
+the backend that actually ran in ``backend_run``, and a query answered
+by another backend than the one asked for is reported as an error.
+This package is not installed with steelscript.wireshark.
+"""
@@ -0,0 +1,111 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+import sys
+import json
+import argparse
+
+from benchmarks import generate, harness, compare
+
+
+def _ints(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def _names(value):
+    return [v for v in value.split(',') if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='steelscript.wireshark '
+                                                 'benchmarks')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    gen = commands.add_parser('generate', help='write a synthetic capture')
+    gen.add_argument('filename')
+    gen.add_argument('--packets', type=int, default=100000)
+    gen.add_argument('--format', dest='fmt', default='pcap',
+                     choices=['pcap', 'pcap-ns', 'pcapng'])
+    gen.add_argument('--flows', type=int, default=1000)
+    gen.add_argument('--size', type=int, default=200,
+                     help='average packet size in bytes')
+    gen.add_argument('--seed', type=int, default=0)
+    gen.add_argument('--mix', default=None,
+                     help='protocol mix, such as tcp=0.6,udp=0.3,icmp=0.1')
+
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument('--sizes', type=_ints, default=[10000, 100000],
+                     help='comma separated packet counts')
+    run.add_argument('--workers', type=_ints, default=[1, 4],
+                     help='comma separated worker counts')
+    run.add_argument('--cases', type=_names, default=harness.CASES,
+                     help='comma separated cases, from %s'
+                          % ','.join(harness.CASES))
+    run.add_argument('--backends', type=_names, default=None,
+                     help='comma separated query backends, from %s'
+                          % ','.join(harness.BACKENDS))
+    run.add_argument('--format', dest='fmt', default='pcap',
+                     choices=['pcap', 'pcap-ns', 'pcapng'])
+    run.add_argument('--flows', type=int, default=1000)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--repeat', type=int, default=1,
+                     help='runs per case, the fastest is kept')
+    run.add_argument('--workdir', default=None,
+                     help='directory for the generated captures, kept '
+                          'between runs')
+    run.add_argument('--output', '-o', default=None,
+                     help='JSON results file, printed if not given')
+
+    cmp_ = commands.add_parser('compare', help='compare two results files')
+    cmp_.add_argument('base')
+    cmp_.add_argument('new')
+    cmp_.add_argument('--threshold', type=float, default=compare.THRESHOLD,
+                      help='fraction a metric may get worse before it is '
+                           'a regression')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        mix = None
+        if args.mix:
+            mix = dict((k, float(v)) for k, v in
+                       (item.split('=') for item in args.mix.split(',')))
+        n = generate.generate(args.filename, args.packets, fmt=args.fmt,
+                              flows=args.flows, size=args.size,
+                              seed=args.seed, mix=mix)
+        print('Wrote %d packets to %s' % (n, args.filename))
+        return 0
+
+    if args.command == 'run':
+        unknown = set(args.cases) - set(harness.CASES)
+        if unknown:
+            parser.error('unknown cases: %s' % ', '.join(sorted(unknown)))
+        document = harness.run(sizes=args.sizes, workers=args.workers,
+                               cases=args.cases, backends=args.backends,
+                               fmt=args.fmt, flows=args.flows,
+                               seed=args.seed, repeat=args.repeat,
+                               workdir=args.workdir)
+        if args.output:
+            harness.save(document, args.output)
+        else:
+            json.dump(document, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+        errors = [r for r in document['results'] if 'error' in r]
+        for r in errors:
+            sys.stderr.write('%s %s failed: %s\n'
+                             % (r['case'], r['backend'], r['error']))
+        return 1 if errors else 0
+
+    rows = compare.compare(compare.load(args.base), compare.load(args.new),
+                           args.threshold)
+    compare.report(rows, sys.stdout)
+    return 1 if any(r['regression'] for r in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
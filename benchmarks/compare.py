@@ -0,0 +1,72 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Comparison of two benchmark result files, for instance from two commits.
+"""
+
+import json
+
+# Fraction by which a metric may get worse before it is reported as a
+# regression
+THRESHOLD = 0.10
+
+# Metrics compared, and whether lower values are better
+METRICS = [('wall', True), ('peak_rss_kb', True),
+           ('peak_child_rss_kb', True)]
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _key(entry):
+    return (entry['case'], entry['backend'], entry['packets'],
+            entry['workers'])
+
+
+def compare(base, new, threshold=THRESHOLD):
+    """Compare two results documents.
+
+    Returns a list of dicts, one per metric of every case present in
+    both, with the base and new values, their ratio and whether it is a
+    regression.
+    """
+    before = dict((_key(e), e) for e in base['results'] if 'error' not in e)
+    rows = []
+    for entry in new['results']:
+        old = before.get(_key(entry))
+        if old is None or 'error' in entry:
+            continue
+        for metric, lower_is_better in METRICS:
+            a, b = old.get(metric), entry.get(metric)
+            if not a or b is None:
+                continue
+            ratio = b / a
+            worse = ratio - 1 if lower_is_better else 1 - ratio
+            rows.append({'case': entry['case'],
+                         'backend': entry['backend'],
+                         'packets': entry['packets'],
+                         'workers': entry['workers'],
+                         'metric': metric,
+                         'base': a, 'new': b,
+                         'ratio': round(ratio, 3),
+                         'regression': worse > threshold})
+    return rows
+
+
+def report(rows, out):
+    """Write a table of the comparison to the file object ``out``."""
+    fmt = '%-8s %-10s %10s %7s %-18s %14s %14s %7s %s\n'
+    out.write(fmt % ('case', 'backend', 'packets', 'workers', 'metric',
+                     'base', 'new', 'ratio', ''))
+    for r in rows:
+        out.write(fmt % (r['case'], r['backend'], r['packets'],
+                         r['workers'], r['metric'],
+                         '%.4g' % r['base'], '%.4g' % r['new'],
+                         '%.3f' % r['ratio'],
+                         'REGRESSION' if r['regression'] else ''))
@@ -0,0 +1,202 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Synthetic capture generator.
+
+Writes Ethernet/IPv4 captures with TCP, UDP, DNS, HTTP and ICMP packets
+spread over a number of flows, in classic pcap or pcapng format.  The
+output only depends on the arguments, so the same capture can be
+regenerated on any machine without network access.
+"""
+
+import random
+import struct
+
+ETH_IPV4 = 0x0800
+LINKTYPE_ETHERNET = 1
+
+# Default share of each protocol
+PROTOCOL_MIX = {'tcp': 0.5, 'http': 0.2, 'udp': 0.15, 'dns': 0.1,
+                'icmp': 0.05}
+
+HTTP_REQUEST = (b'GET /index%d.html HTTP/1.1\r\nHost: host%d.example.com\r\n'
+                b'User-Agent: steelscript-benchmark\r\n\r\n')
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def _ipv4(src, dst, proto, payload, ident):
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), ident,
+                         0x4000, 64, proto, 0, src, dst)
+    header = header[:10] + struct.pack('!H', _checksum(header)) + header[12:]
+    return header + payload
+
+
+def _ethernet(src, dst, payload):
+    return dst + src + struct.pack('!H', ETH_IPV4) + payload
+
+
+def _dns_query(ident, name):
+    labels = b''.join(struct.pack('B', len(p)) + p.encode('ascii')
+                      for p in name.split('.'))
+    return (struct.pack('!HHHHHH', ident, 0x0100, 1, 0, 0, 0) +
+            labels + b'\x00' + struct.pack('!HH', 1, 1))
+
+
+class Flow(object):
+    """One conversation between two hosts."""
+
+    def __init__(self, n, protocol, rnd):
+        self.protocol = protocol
+        self.src = struct.pack('!I', 0x0a000000 + (n % 0xfffff) + 1)
+        self.dst = struct.pack('!I', 0xc0a80000 + rnd.randrange(1, 0xffff))
+        self.srcmac = b'\x02\x00' + self.src
+        self.dstmac = b'\x02\x01' + self.dst
+        # Client ports from the dynamic range, so none is dissected as a
+        # tunnel
+        self.sport = 49152 + n % 16384
+        self.dport = {'http': 80, 'dns': 53}.get(protocol,
+                                                 rnd.choice([22, 443, 8080,
+                                                             5001, 161]))
+        self.seq = rnd.randrange(1 << 32)
+        self.ack = rnd.randrange(1 << 32)
+        self.count = 0
+
+    def packet(self, size, rnd):
+        """Return the bytes of the next packet of the flow, about
+        ``size`` bytes long."""
+        self.count += 1
+        ident = self.count & 0xffff
+        forward = self.count % 2 == 1
+        src, dst = (self.src, self.dst) if forward else (self.dst, self.src)
+        sport, dport = ((self.sport, self.dport) if forward
+                        else (self.dport, self.sport))
+
+        if self.protocol in ('tcp', 'http'):
+            if self.protocol == 'http' and forward:
+                data = HTTP_REQUEST % (self.count, self.count % 100)
+            else:
+                data = bytes(max(0, size - 54))
+            flags = 0x18 if data else 0x10
+            seq, ack = ((self.seq, self.ack) if forward
+                        else (self.ack, self.seq))
+            l4 = struct.pack('!HHIIBBHHH', sport, dport, seq, ack,
+                             5 << 4, flags, 65535, 0, 0) + data
+            if forward:
+                self.seq = (self.seq + len(data)) & 0xffffffff
+            else:
+                self.ack = (self.ack + len(data)) & 0xffffffff
+            proto = 6
+        elif self.protocol in ('udp', 'dns'):
+            if self.protocol == 'dns':
+                data = _dns_query(ident, 'host%d.example.com'
+                                  % (self.count % 100))
+            else:
+                data = bytes(max(0, size - 42))
+            l4 = struct.pack('!HHHH', sport, dport, 8 + len(data), 0) + data
+            proto = 17
+        else:
+            data = bytes(max(0, size - 42))
+            body = struct.pack('!BBHHH', 8 if forward else 0, 0, 0,
+                               self.sport, ident) + data
+            l4 = body[:2] + struct.pack('!H', _checksum(body)) + body[4:]
+            proto = 1
+
+        srcmac, dstmac = ((self.srcmac, self.dstmac) if forward
+                          else (self.dstmac, self.srcmac))
+        return _ethernet(srcmac, dstmac, _ipv4(src, dst, proto, l4, ident))
+
+
+def packets(count, flows=100, mix=None, size=200, seed=0,
+            start=1700000000.0, rate=10000.0):
+    """Generate ``(timestamp_ns, bytes)`` for ``count`` packets.
+
+    :param int flows: number of concurrent flows
+    :param dict mix: share of each protocol in :py:data:`PROTOCOL_MIX`
+    :param int size: average packet size in bytes
+    :param int seed: random seed
+    :param float start: time of the first packet, seconds since the epoch
+    :param float rate: average packets per second
+    """
+    rnd = random.Random(seed)
+    mix = mix or PROTOCOL_MIX
+    protocols = sorted(mix)
+    weights = [mix[p] for p in protocols]
+    active = [Flow(n, rnd.choices(protocols, weights)[0], rnd)
+              for n in range(flows)]
+
+    t = int(start * 1e9)
+    gap = int(1e9 / rate)
+    for _ in range(count):
+        t += rnd.randrange(1, 2 * gap)
+        flow = active[rnd.randrange(flows)]
+        yield t, flow.packet(rnd.randrange(size // 2, size * 3 // 2), rnd)
+
+
+def write_pcap(filename, pkts, nanosecond=False):
+    """Write packets to a classic pcap file."""
+    magic = 0xa1b23c4d if nanosecond else 0xa1b2c3d4
+    count = 0
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', magic, 2, 4, 0, 0, 65535,
+                            LINKTYPE_ETHERNET))
+        for t, data in pkts:
+            sec, frac = divmod(t, 1000000000)
+            if not nanosecond:
+                frac //= 1000
+            f.write(struct.pack('<IIII', sec, frac, len(data), len(data)))
+            f.write(data)
+            count += 1
+    return count
+
+
+def _pad(data):
+    return data + b'\x00' * (-len(data) % 4)
+
+
+def write_pcapng(filename, pkts):
+    """Write packets to a pcapng file with nanosecond timestamps."""
+    count = 0
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<IIIHHqI', 0x0a0d0d0a, 28, 0x1a2b3c4d, 1, 0,
+                            -1, 28))
+        # if_tsresol = 9, end of options
+        options = struct.pack('<HHB3x', 9, 1, 9) + struct.pack('<HH', 0, 0)
+        length = 20 + len(options)
+        f.write(struct.pack('<IIHHI', 1, length, LINKTYPE_ETHERNET, 0, 0) +
+                options + struct.pack('<I', length))
+        for t, data in pkts:
+            body = _pad(data)
+            length = 32 + len(body)
+            f.write(struct.pack('<IIIIIII', 6, length, 0, t >> 32,
+                                t & 0xffffffff, len(data), len(data)))
+            f.write(body)
+            f.write(struct.pack('<I', length))
+            count += 1
+    return count
+
+
+def generate(filename, count, fmt='pcap', **kwargs):
+    """Write a synthetic capture of ``count`` packets.
+
+    :param str fmt: 'pcap', 'pcap-ns' (nanosecond pcap) or 'pcapng'
+    :param kwargs: passed to :py:func:`packets`
+    :returns: number of packets written
+    """
+    pkts = packets(count, **kwargs)
+    if fmt == 'pcapng':
+        return write_pcapng(filename, pkts)
+    elif fmt in ('pcap', 'pcap-ns'):
+        return write_pcap(filename, pkts, nanosecond=(fmt == 'pcap-ns'))
+    raise ValueError('Unknown format: %s' % fmt)
@@ -0,0 +1,298 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Benchmark harness.
+
+Each case runs in a fresh process so that its peak RSS, and that of the
+tshark/editcap processes it starts, can be measured on its own.  Results
+are returned as dicts with the wall time, packets/sec, rows/sec and peak
+RSS (in KiB) of the case.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import resource
+import tempfile
+import datetime
+import subprocess
+import multiprocessing
+
+from benchmarks import generate
+
+# Fields queried by the query cases
+FIELDS = ['frame.time_epoch', 'ip.src', 'ip.dst', 'ip.len',
+          'tcp.srcport', 'tcp.dstport', 'udp.dstport']
+
+# Benchmark cases and query backends
+CASES = ['info', 'query', 'export', 'index', 'split', 'fields']
+BACKENDS = ['native', 'tshark', 'ss_packets']
+
+# PcapFile operation timed by each case, whose backend is recorded
+OPERATIONS = {'info': 'info', 'query': 'query', 'export': 'export',
+              'split': 'query'}
+
+# QueryStats backends that may answer a query for each backend asked for
+EXPECTED = {'native': ('native',), 'tshark': ('tshark', 'parallel'),
+            'ss_packets': ('ss_packets',)}
+
+
+def have_ss_packets():
+    from steelscript.wireshark.core.pcap import PcapFile
+    return PcapFile.HAVE_STEELSCRIPT_PACKETS
+
+
+def capture(workdir, packets, fmt='pcap', flows=1000, seed=0):
+    """Return the path of a synthetic capture, generating it if needed."""
+    ext = 'pcapng' if fmt == 'pcapng' else 'pcap'
+    path = os.path.join(workdir, 'bench-%s-%d-%d-%d.%s'
+                        % (fmt, packets, flows, seed, ext))
+    if not os.path.exists(path):
+        tmp = path + '.tmp'
+        generate.generate(tmp, packets, fmt=fmt, flows=flows, seed=seed)
+        _check_native(tmp)
+        os.rename(tmp, path)
+    return path
+
+
+def _check_native(path):
+    """Raise ValueError if :py:data:`FIELDS` of ``path`` cannot be
+    decoded natively, the native backend would then time tshark."""
+    from steelscript.wireshark.core import decode
+    if decode.decode(path, FIELDS) is None:
+        raise ValueError('%s cannot be decoded natively' % path)
+
+
+def _remove_index(path):
+    from steelscript.wireshark.core.pcapindex import PcapIndex
+    sidecar = PcapIndex.sidecar(path)
+    if os.path.exists(sidecar):
+        os.unlink(sidecar)
+
+
+def _case_info(path, backend, workers, workdir):
+    from steelscript.wireshark.core.pcap import PcapFile
+    info = PcapFile(path).info()
+    return 0, int(info['Number of packets'])
+
+
+def _case_query(path, backend, workers, workdir):
+    from steelscript.wireshark.core.pcap import PcapFile
+    rows = PcapFile(path).query(FIELDS, use_cache=False,
+                                use_ss_packets=(backend == 'ss_packets'),
+                                workers=workers)
+    return len(rows), None
+
+
+def _case_export(path, backend, workers, workdir):
+    from steelscript.wireshark.core.pcap import PcapFile
+    pcap = PcapFile(path)
+    pcap.info()
+    middle = pcap.starttime + (pcap.endtime - pcap.starttime) / 4
+    out = os.path.join(workdir, 'export.pcap')
+    try:
+        exported = pcap.export(out, starttime=middle,
+                               endtime=middle + (pcap.endtime -
+                                                 pcap.starttime) / 2)
+        return 0, int(exported.info()['Number of packets'])
+    finally:
+        if os.path.exists(out):
+            os.unlink(out)
+
+
+def _case_index(path, backend, workers, workdir):
+    from steelscript.wireshark.core.pcapindex import PcapIndex
+    _remove_index(path)
+    index = PcapIndex.build(path)
+    return 0, index.numpackets
+
+
+def _case_split(path, backend, workers, workdir):
+    """The split used by the App Framework pcap source: index the file
+    and query each chunk, as WiresharkPcapQuery does."""
+    from steelscript.wireshark.core.pcap import PcapFile
+    pcap = PcapFile(path)
+    rows = 0
+    for start, end, first in [(c.start, c.end, c.first_packet)
+                              for c in pcap.index().chunks(workers)]:
+        rows += len(pcap.query(FIELDS, use_cache=False, use_ss_packets=False,
+                               byterange=(start, end, first)))
+    return rows, None
+
+
+def _case_fields(path, backend, workers, workdir):
+    from steelscript.wireshark.core.pcap import TSharkFields
+    fields = TSharkFields()
+    fields.CACHEFILE = os.path.join(workdir, 'fields.db')
+    fields.load(ignore_cache=True)
+    return len(fields.fields), None
+
+
+def _run_child(conn, case, path, backend, workers, workdir):
+    from steelscript.wireshark.core.pcap import PcapFile
+    func = globals()['_case_%s' % case]
+    # The planner prefers native decoding over the other backends for
+    # the benchmark fields
+    PcapFile.NATIVE_DECODE = (backend == 'native')
+    ran = set()
+
+    def record(stats):
+        if stats.operation == OPERATIONS.get(case):
+            ran.add(stats.backend)
+
+    PcapFile.STATS_HOOKS = [record]
+    try:
+        start = time.time()
+        rows, packets = func(path, backend, workers, workdir)
+        wall = time.time() - start
+        conn.send({'wall': wall, 'rows': rows, 'packets': packets,
+                   'ran': ','.join(sorted(str(b) for b in ran)) or None,
+                   'rss_kb': resource.getrusage(
+                       resource.RUSAGE_SELF).ru_maxrss,
+                   'child_rss_kb': resource.getrusage(
+                       resource.RUSAGE_CHILDREN).ru_maxrss})
+    except Exception as e:
+        conn.send({'error': '%s: %s' % (e.__class__.__name__, e)})
+    finally:
+        conn.close()
+
+
+def run_case(case, path, packets, backend='tshark', workers=1,
+             workdir=None, repeat=1):
+    """Run one case ``repeat`` times, each in a new process, and return
+    the result of the fastest run.
+
+    Every run starts without an index sidecar, so cases that use the
+    index include building it.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    best = None
+    for _ in range(repeat):
+        _remove_index(path)
+        parent, child = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_run_child,
+                           args=(child, case, path, backend, workers,
+                                 workdir))
+        proc.start()
+        child.close()
+        try:
+            result = parent.recv()
+        except EOFError:
+            result = {'error': 'benchmark process exited with %s'
+                      % proc.exitcode}
+        proc.join()
+        if 'error' in result:
+            best = result
+            break
+        if best is None or result['wall'] < best['wall']:
+            best = result
+
+    entry = {'case': case, 'backend': backend, 'workers': workers,
+             'file': os.path.basename(path),
+             'size': os.path.getsize(path),
+             'packets': packets}
+    if 'error' in best:
+        entry['error'] = best['error']
+        return entry
+
+    # What actually ran, a query falling back to another backend would
+    # otherwise be reported under the one asked for
+    entry['backend_run'] = best['ran']
+    if case in ('query', 'split') and best['ran'] is not None and \
+            not set(best['ran'].split(',')) <= set(EXPECTED[backend]):
+        entry['error'] = ('ran with backend %s instead of %s'
+                          % (best['ran'], backend))
+
+    wall = best['wall']
+    entry.update({'wall': round(wall, 6),
+                  'rows': best['rows'],
+                  'packets_per_sec': (round(packets / wall, 1)
+                                      if wall else None),
+                  'rows_per_sec': (round(best['rows'] / wall, 1)
+                                   if wall and best['rows'] else None),
+                  'peak_rss_kb': best['rss_kb'],
+                  'peak_child_rss_kb': best['child_rss_kb']})
+    if best['packets'] is not None and best['packets'] != packets:
+        entry['packets_seen'] = best['packets']
+    return entry
+
+
+def environment():
+    """Describe the machine and versions the benchmarks ran with."""
+    from steelscript.wireshark.core.pcap import popen_env
+    from steelscript.wireshark.core.fieldcatalog import tshark_version
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=here,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit,
+            'date': datetime.datetime.utcnow().isoformat() + 'Z',
+            'host': socket.gethostname(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'tshark': tshark_version(popen_env),
+            'ss_packets': have_ss_packets()}
+
+
+def run(sizes=(10000, 100000), workers=(1, 4), cases=CASES,
+        backends=None, fmt='pcap', flows=1000, seed=0, repeat=1,
+        workdir=None, log=sys.stderr):
+    """Run the benchmark matrix and return the results document.
+
+    Query cases run for every backend and worker count, ``split`` for
+    every worker count, the other cases once per size.
+    """
+    if backends is None:
+        backends = ['native', 'tshark'] + (['ss_packets']
+                                           if have_ss_packets() else [])
+
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='ss-wireshark-bench-')
+    results = []
+    try:
+        for size in sizes:
+            path = capture(workdir, size, fmt=fmt, flows=flows, seed=seed)
+            for case in cases:
+                if case == 'fields' and size != sizes[0]:
+                    continue
+                for backend in (backends if case == 'query'
+                                else ['tshark']):
+                    counts = (workers if case in ('query', 'split')
+                              else [1])
+                    for n in counts:
+                        if backend in ('native', 'ss_packets') and n > 1:
+                            continue
+                        if log:
+                            log.write('%-8s %-10s %9d packets %2d workers\n'
+                                      % (case, backend, size, n))
+                        results.append(run_case(case, path, size, backend,
+                                                n, workdir, repeat))
+            _remove_index(path)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {'environment': environment(),
+            'parameters': {'sizes': list(sizes), 'workers': list(workers),
+                           'format': fmt, 'flows': flows, 'seed': seed,
+                           'repeat': repeat},
+            'results': results}
+
+
+def save(document, filename):
+    with open(filename, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
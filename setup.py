@@ -33,7 +33,8 @@ For a complete guide to installation, see:
 http://pythonhosted.org/steelscript/
     """,
 
-    'packages': find_packages(exclude=('gitpy_versioning',)),
+    'packages': find_packages(exclude=('gitpy_versioning', 'benchmarks',
+                                            'benchmarks.*')),
     'zip_safe': False,
 
     'install_requires': (
@@ -43,7 +44,9 @@ http://pythonhosted.org/steelscript/
         'pytz'
     ),
 
-    'extras_require': None,
+    'extras_require': {
+        'parquet': ['pyarrow'],
+    },
     'test_suite': '',
     'include_package_data': True,
 
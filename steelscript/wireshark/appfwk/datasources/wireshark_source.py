@@ -10,16 +10,14 @@ A data source for querying data from pcap files via tshark
 
 import logging
 import os
-import math
 import copy
 import pandas
-import shutil
-import subprocess
 import multiprocessing
 
 from django import forms
 
-from steelscript.wireshark.core.pcap import PcapFile, popen_env
+from steelscript.wireshark.core.pcap import PcapFile
+from steelscript.wireshark.core.batcher import QueryBatcher
 
 from steelscript.appfwk.apps.datasource.models \
     import DatasourceTable, TableField, Column, TableQueryBase
@@ -35,8 +33,8 @@ from steelscript.appfwk.apps.datasource.models import Table
 
 logger = logging.getLogger(__name__)
 
-
-SPLIT_DIR = '/tmp/split_pcaps'
+# Shared by WiresharkTables with the 'share_dissection' option
+query_batcher = QueryBatcher()
 
 
 class WiresharkColumn(Column):
@@ -73,8 +71,20 @@ class WiresharkTable(DatasourceTable):
     _column_class = 'WiresharkColumn'
     _query_class = 'WiresharkQuery'
 
+    # aggregate: group packets into 'resolution' time buckets while
+    #   tshark runs, combining each column with its 'operation',
+    #   instead of returning one row per packet.  Every value of a
+    #   multi-valued field is aggregated, as in the per-packet rows.
+    #   Operations other than sum, min, max, count and mean, such as
+    #   median, keep every row until tshark finishes.  Buckets are
+    #   aligned in UTC, so daily buckets start at midnight UTC
+    # share_dissection: run in one tshark pass with the queries of other
+    #   tables with this option over the same pcap and time range that
+    #   start within query_batcher.window seconds
     TABLE_OPTIONS = {'show_pcap_mgr': True,
-                     'show_entire_pcap': True}
+                     'show_entire_pcap': True,
+                     'aggregate': False,
+                     'share_dissection': False}
     FIELD_OPTIONS = {'resolution': '1m',
                      'resolutions': ('1s', '1m', '15min', '1h')}
 
@@ -100,7 +110,22 @@ class WiresharkTable(DatasourceTable):
         fields_add_filterexpr(obj=self)
 
 
+def attach_stats(job, stats):
+    """Attach the QueryStats of the PcapFile operation run for ``job`` to
+    it as ``job.query_stats``, a dict of the timings, row counts and
+    resource usage, and log them."""
+    if stats is None:
+        return
+    job.query_stats = stats.as_dict()
+    logger.info("%s: %s" % (job, stats))
+
+
 def get_pcap_file(criteria):
+    # Set by WiresharkPcapQuery for its dependent jobs
+    filename = getattr(criteria, 'pcapfilename', None)
+    if filename:
+        return filename
+
     p = criteria.pcapmgrfile
 
     if not p:
@@ -125,6 +150,23 @@ class WiresharkQuery(TableQueryBase):
 
         pcapfile = PcapFile(pcapfilename)
 
+        if criteria.entire_pcap:
+            starttime = None
+            endtime = None
+        else:
+            starttime = criteria.starttime
+            endtime = criteria.endtime
+
+        # Byte range of the capture to analyze, see WiresharkPcapQuery
+        byterange = getattr(criteria, 'pcapbyterange', None)
+        if byterange:
+            byterange = tuple(byterange)
+
+        timecols = [tc for tc in columns if tc.datatype == 'time']
+        if table.options.aggregate and timecols:
+            return self.run_aggregate(pcapfile, columns, timecols[0],
+                                      starttime, endtime, byterange)
+
         fieldnames = []
         basecolnames = []  # list of colummns
         # dict by field name of the base (or first) column to use this field
@@ -140,19 +182,24 @@ class WiresharkQuery(TableQueryBase):
             fieldnames.append(tc_options.field)
             basecolnames.append(tc.name)
 
-        if criteria.entire_pcap:
-            starttime = None
-            endtime = None
+        if table.options.share_dissection:
+            data = query_batcher.submit(
+                pcapfilename,
+                dict(fieldnames=fieldnames,
+                     filterexpr=criteria.wireshark_filterexpr,
+                     use_tshark_fields=True),
+                starttime=starttime,
+                endtime=endtime,
+                byterange=byterange)
         else:
-            starttime = criteria.starttime
-            endtime = criteria.endtime
-
-        data = pcapfile.query(
-            fieldnames,
-            starttime=starttime,
-            endtime=endtime,
-            filterexpr=criteria.wireshark_filterexpr,
-            use_tshark_fields=True)
+            data = pcapfile.query(
+                fieldnames,
+                starttime=starttime,
+                endtime=endtime,
+                filterexpr=criteria.wireshark_filterexpr,
+                use_tshark_fields=True,
+                byterange=byterange)
+            attach_stats(self.job, pcapfile.last_stats)
 
         # Can be list of 0 elements or None
         if not data:
@@ -181,6 +228,118 @@ class WiresharkQuery(TableQueryBase):
 
         return True
 
+    def run_aggregate(self, pcapfile, columns, timecol,
+                      starttime, endtime, byterange):
+        """Return one row per 'resolution' time bucket, aggregating
+        each column with its 'operation' as packets are read."""
+        criteria = self.job.criteria
+
+        valuecols = [tc for tc in columns if tc is not timecol]
+        df = pcapfile.aggregate(
+            [tc.options.field for tc in valuecols],
+            criteria.resolution,
+            operations=[tc.options.operation for tc in valuecols],
+            timefield=timecol.options.field,
+            names=[tc.name for tc in valuecols],
+            filterexpr=criteria.wireshark_filterexpr,
+            starttime=starttime,
+            endtime=endtime,
+            byterange=byterange)
+        attach_stats(self.job, pcapfile.last_stats)
+
+        if df is None:
+            self.data = None
+            return True
+
+        df = df.rename(columns={timecol.options.field: timecol.name})
+        if self.table.rows > 0:
+            df = df[:self.table.rows]
+
+        logger.info("Aggregated data (first 3 rows...):\n%s", df[:3])
+
+        colnames = [col.name for col in columns]
+        self.data = df.loc[:, colnames].values.tolist()
+
+        return True
+
+
+class WiresharkStatsTable(WiresharkTable):
+    """Table of tshark statistics rather than per-packet fields.
+
+    The 'stat' table option selects the statistic:
+
+    * 'conversations' - ``PcapFile.conversations(proto)``
+    * 'endpoints' - ``PcapFile.endpoints(proto)``
+    * 'io' - ``PcapFile.io_stat(resolution, exprs)``
+
+    Each column's 'field' option names a column of the statistics
+    DataFrame (for example 'address_a', 'bytes' or 'time'), defaulting
+    to the column name.
+    """
+    class Meta:
+        proxy = True
+        app_label = 'steelscript.wireshark.appfwk'
+
+    _column_class = 'WiresharkColumn'
+    _query_class = 'WiresharkStatsQuery'
+
+    TABLE_OPTIONS = {'show_pcap_mgr': True,
+                     'show_entire_pcap': True,
+                     'stat': 'conversations',
+                     'proto': 'tcp',
+                     'exprs': None}
+
+
+class WiresharkStatsQuery(TableQueryBase):
+
+    def run(self):
+        criteria = self.job.criteria
+        table = self.table
+        options = table.options
+
+        pcapfile = PcapFile(get_pcap_file(criteria))
+
+        kwargs = {'filterexpr': criteria.wireshark_filterexpr}
+        if not criteria.entire_pcap:
+            kwargs['starttime'] = criteria.starttime
+            kwargs['endtime'] = criteria.endtime
+
+        byterange = getattr(criteria, 'pcapbyterange', None)
+        if byterange:
+            kwargs['byterange'] = tuple(byterange)
+
+        if options.stat == 'conversations':
+            df = pcapfile.conversations(options.proto, **kwargs)
+        elif options.stat == 'endpoints':
+            df = pcapfile.endpoints(options.proto, **kwargs)
+        elif options.stat == 'io':
+            df = pcapfile.io_stat(criteria.resolution, options.exprs,
+                                  **kwargs)
+        else:
+            raise ValueError('Unknown statistic: %s' % options.stat)
+
+        if df is None or len(df) == 0:
+            self.data = None
+            return True
+
+        columns = table.get_columns(synthetic=False)
+        data = pandas.DataFrame()
+        for tc in columns:
+            field = tc.options.field or tc.name
+            if field not in df:
+                raise ValueError('No column %s in %s statistics, expected '
+                                 'one of %s' % (field, options.stat,
+                                                ', '.join(df.columns)))
+            data[tc.name] = df[field]
+
+        if table.rows > 0:
+            data = data[:table.rows]
+
+        logger.info("Statistics returned (first 3 rows...):\n%s", data[:3])
+
+        self.data = data.values.tolist()
+        return True
+
 
 class WiresharkInfoTable(DatasourceTable):
 
@@ -206,6 +365,7 @@ class WiresharkInfoQuery(TableQueryBase):
 
         pcapfile = PcapFile(pcapfilename)
         pcapfile.info()
+        attach_stats(self.job, pcapfile.last_stats)
         self.data = [['Start time', str(pcapfile.starttime)],
                      ['End time', str(pcapfile.endtime)],
                      ['Number of packets', pcapfile.numpackets]]
@@ -239,23 +399,18 @@ class WiresharkPcapTable(AnalysisTable):
 class WiresharkPcapQuery(AnalysisQuery):
 
     def split_pcap(self):
-        cpu_num = multiprocessing.cpu_count()
-        per_file = int(math.ceil(self.pkt_num/cpu_num))
-
-        if not os.path.exists(SPLIT_DIR):
-            os.mkdir(SPLIT_DIR)
-        os.mkdir(self.output_dir)
+        """Return a list of ``(start, end, first_packet)`` byte ranges
+        splitting the file into one packet-aligned part per cpu.
 
-        cmd = 'editcap -c %s %s %s/' % (per_file, self.filename,
-                                        self.output_dir)
-        subprocess.Popen(cmd, shell=True, env=popen_env).wait()
-
-    @property
-    def file_handle(self):
-        """Return the basename of the path without extension.
-        If filename is 'a/b/c.d', return 'c'.
+        The parts are read straight from the original file, nothing is
+        copied.
         """
-        return os.path.basename(self.filename).rsplit('.', 1)[0]
+        cpu_num = multiprocessing.cpu_count()
+        index = PcapFile(self.filename).index()
+        if index is None:
+            return []
+        return [(c.start, c.end, c.first_packet)
+                for c in index.chunks(cpu_num)]
 
     def analyze(self, jobs=None):
 
@@ -277,6 +432,7 @@ class WiresharkPcapQuery(AnalysisQuery):
             pcap_info = pcap.info()
         except ValueError:
             raise AnalysisException("No packets in %s" % self.filename)
+        attach_stats(self.job, pcap.last_stats)
 
         logger.debug("%s: File info %s" % (self.__class__.__name__, pcap_info))
 
@@ -299,22 +455,16 @@ class WiresharkPcapQuery(AnalysisQuery):
             logger.debug("%s starting single job" % self.__class__.__name__)
             return QueryContinue(self.collect, depjobs)
 
-        self.output_dir = os.path.join(SPLIT_DIR, self.file_handle)
-        self.split_pcap()
+        splits = self.split_pcap()
 
-        split_files = os.listdir(self.output_dir)
+        if not splits:
+            raise AnalysisException('Could not split %s' % self.filename)
 
-        if not split_files:
-            raise AnalysisException('No pcap file found after splitting %s'
-                                    % self.filename)
-
-        for split in split_files:
+        for split in splits:
             # use wireshark table
             ws_criteria = copy.copy(criteria)
-            ws_criteria.pcapfilename = os.path.join(self.output_dir, split)
-
-            # for ease of removing the split directory in collect func
-            ws_criteria.output_dir = self.output_dir
+            ws_criteria.pcapfilename = self.filename
+            ws_criteria.pcapbyterange = list(split)
 
             job = Job.create(table=wt, criteria=ws_criteria,
                              update_progress=False, parent=self.job)
@@ -328,12 +478,7 @@ class WiresharkPcapQuery(AnalysisQuery):
     def collect(self, jobs=None):
         dfs = []
 
-        # Removing the temporary split directory if it exists
-        output_dir = getattr(list(jobs.values())[0].criteria, 'output_dir', None)
-        if output_dir and os.path.exists(output_dir):
-            shutil.rmtree(output_dir)
-
-        for jid, job in jobs.items():
+        for jid, job in sorted(jobs.items(), key=self._split_order):
             if job.status == Job.ERROR:
                 raise AnalysisException("%s for pcap file %s failed: %s"
                                         % (job, job.criteria.pcapfilename,
@@ -352,3 +497,8 @@ class WiresharkPcapQuery(AnalysisQuery):
         logger.debug("%s: Query ended." % self.__class__.__name__)
 
         return QueryComplete(df)
+
+    @staticmethod
+    def _split_order(item):
+        byterange = getattr(item[1].criteria, 'pcapbyterange', None)
+        return byterange[0] if byterange else 0
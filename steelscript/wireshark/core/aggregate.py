@@ -0,0 +1,215 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Streaming aggregation of query results into time buckets.
+
+Batches of rows are grouped by time bucket as they arrive and folded into
+one partial result per bucket, so memory grows with the number of buckets
+rather than the number of packets.  Operations that cannot be combined
+from partial results, such as 'median', are computed by
+:py:func:`aggregate_frames` over all rows at once instead.
+
+Buckets are aligned to multiples of the resolution counted from the Unix
+epoch in UTC, whatever timezone the result is shown in.  Buckets of an
+hour or less therefore start at the same wall-clock minutes in any
+timezone with a whole-hour offset, but daily buckets start at midnight
+UTC rather than local midnight.
+"""
+
+import logging
+
+import numpy
+import pandas
+
+logger = logging.getLogger(__name__)
+
+
+# How partial results for the same bucket are combined
+OPERATIONS = {'sum': 'sum',
+              'min': 'min',
+              'max': 'max',
+              'count': 'sum'}
+
+# Operations BucketAggregator can stream, 'mean' is kept as a sum and count
+STREAMED = set(OPERATIONS) | {'mean'}
+
+
+def check_operation(op):
+    """Raise ValueError unless ``op`` is a pandas groupby reduction such
+    as 'sum', 'median' or 'std'."""
+    if not (isinstance(op, str) and not op.startswith('_') and
+            callable(getattr(pandas.core.groupby.SeriesGroupBy, op, None))):
+        raise ValueError('Unsupported operation: %s' % op)
+
+
+def check_resolution(resolution):
+    """Return ``resolution`` as a Timedelta, raising ValueError unless it
+    is positive."""
+    resolution = pandas.Timedelta(resolution)
+    if resolution <= pandas.Timedelta(0):
+        raise ValueError('Invalid resolution: %s' % resolution)
+    return resolution
+
+
+def _floor(times, resolution):
+    """Return the valid-time mask of ``times`` and the UTC bucket of each
+    valid time."""
+    times = pandas.Series(times)
+    valid = times.notnull().values
+    utc = times[valid].dt.tz_convert('UTC')
+    return valid, utc.dt.floor(resolution).values
+
+
+def _index(buckets, tz):
+    index = pandas.DatetimeIndex(buckets).tz_localize('UTC')
+    if tz is not None:
+        index = index.tz_convert(tz)
+    return index
+
+
+def _reduce(group, op):
+    if op == 'sum':
+        # All missing values give NaN rather than 0
+        return group.sum(min_count=1)
+    return getattr(group, op)()
+
+
+class BucketAggregator(object):
+    """Accumulates values per time bucket.
+
+    :param resolution: bucket size, a timedelta or string such as '1m'
+    :param list operations: one of 'sum', 'min', 'max', 'count' or 'mean'
+        per value column
+    :param list names: name of each value column
+
+    Buckets are floored in UTC, see the module documentation.
+    """
+
+    def __init__(self, resolution, operations, names):
+        self.resolution = check_resolution(resolution)
+
+        for op in operations:
+            if op not in STREAMED:
+                raise ValueError('Unsupported operation: %s' % op)
+
+        self.operations = list(operations)
+        self.names = list(names)
+
+        # 'mean' is accumulated as a sum and a count
+        self._parts = []
+        for i, op in enumerate(self.operations):
+            if op == 'mean':
+                self._parts.append(('%d.sum' % i, 'sum'))
+                self._parts.append(('%d.count' % i, 'count'))
+            else:
+                self._parts.append(('%d.%s' % (i, op), op))
+
+        self._acc = None
+
+    def add(self, times, columns):
+        """Fold a batch into the running totals.
+
+        :param times: tz-aware datetime Series of packet times
+        :param list columns: one Series of values per value column, aligned
+            with ``times``
+        """
+        valid, buckets = _floor(times, self.resolution)
+        if not valid.any():
+            return
+
+        data = {}
+        for name, op in self._parts:
+            i = int(name.split('.')[0])
+            values = pandas.Series(columns[i]).values[valid]
+            if op != 'count':
+                values = pandas.to_numeric(values)
+            data[name] = values
+        frame = pandas.DataFrame(data)
+        frame['bucket'] = buckets
+
+        grouped = frame.groupby('bucket')
+        partial = pandas.DataFrame(
+            {name: _reduce(grouped[name], op) for name, op in self._parts})
+
+        if self._acc is not None:
+            grouped = pandas.concat([self._acc, partial]).groupby(level=0)
+            partial = pandas.DataFrame(
+                {name: _reduce(grouped[name], OPERATIONS[op])
+                 for name, op in self._parts})
+        self._acc = partial
+
+    def __len__(self):
+        return 0 if self._acc is None else len(self._acc)
+
+    def result(self, timename, tz=None):
+        """Return a DataFrame with the bucket start time in column
+        ``timename`` followed by one column per value column, or None if
+        nothing was added."""
+        if self._acc is None:
+            return None
+
+        acc = self._acc.sort_index()
+        columns = {timename: _index(acc.index, tz)}
+        order = [timename]
+        for i, (name, op) in enumerate(zip(self.names, self.operations)):
+            key = '%d' % i
+            if op == 'mean':
+                total = acc[key + '.sum'].values.astype(numpy.float64)
+                count = acc[key + '.count'].values
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    values = numpy.where(count > 0, total / count, numpy.nan)
+            else:
+                values = acc['%s.%s' % (key, op)].values
+            columns[name] = values
+            order.append(name)
+
+        return pandas.DataFrame(columns, columns=order)
+
+
+def aggregate_frames(frames, timename, fieldnames, resolution, operations,
+                     names, tz=None):
+    """Aggregate all rows of the DataFrames in ``frames`` into time
+    buckets at once.
+
+    Used for operations BucketAggregator cannot stream, any operation
+    accepted by :py:func:`check_operation` may be given.  Returns a
+    DataFrame laid out as :py:meth:`BucketAggregator.result`, or None if
+    no row has a time.
+    """
+    resolution = check_resolution(resolution)
+    for op in operations:
+        check_operation(op)
+
+    if not frames:
+        return None
+    frame = pandas.concat(frames, ignore_index=True)
+    valid, buckets = _floor(frame[timename], resolution)
+    if not valid.any():
+        return None
+
+    data = {}
+    for i, (field, op) in enumerate(zip(fieldnames, operations)):
+        values = frame[field].values[valid]
+        if op in STREAMED and op != 'count':
+            values = pandas.to_numeric(values)
+        data['%d' % i] = values
+    grouped = pandas.DataFrame(data).groupby(buckets)
+
+    columns = {}
+    order = [timename]
+    for i, (name, op) in enumerate(zip(names, operations)):
+        key = '%d' % i
+        if op == 'sum':
+            values = _reduce(grouped[key], op)
+        else:
+            values = grouped[key].agg(op)
+        columns[name] = values
+        order.append(name)
+
+    result = pandas.DataFrame(columns).sort_index()
+    result.insert(0, timename, _index(result.index, tz))
+    return result.reset_index(drop=True)[order]
@@ -0,0 +1,90 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Sharing one tshark dissection between queries made by separate threads.
+"""
+
+import logging
+import threading
+
+from steelscript.wireshark.core.pcap import PcapFile
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch(object):
+
+    def __init__(self):
+        self.queries = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class QueryBatcher(object):
+    """Combines queries of the same capture and time range submitted
+    from several threads into a single :py:meth:`PcapFile.multi_query`.
+
+    The first thread to submit a query waits up to ``window`` seconds for
+    others to join, then runs the combined query while the others wait
+    for their results::
+
+        batcher = QueryBatcher()
+        # in each thread
+        rows = batcher.submit('/tmp/trace.pcap',
+                              dict(fieldnames=['ip.src'], filterexpr='tcp'))
+
+    :param float window: seconds to wait for other queries
+    """
+
+    def __init__(self, window=0.5):
+        self.window = window
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def submit(self, filename, query, starttime=None, endtime=None,
+               duration=None, byterange=None, expected=None):
+        """Run ``query`` (a dict of :py:meth:`PcapFile.query` arguments as
+        accepted by :py:meth:`PcapFile.multi_query`) together with any
+        other queries submitted for the same capture and time range, and
+        return its result.
+
+        :param int expected: number of queries expected in the batch, it
+            is run as soon as that many have been submitted
+        """
+        key = (filename, starttime, endtime, duration, byterange)
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = _Batch()
+            index = len(batch.queries)
+            batch.queries.append(query)
+            if expected is not None and len(batch.queries) >= expected:
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                del self._batches[key]
+            logger.info("Running %d queries of %s together"
+                        % (len(batch.queries), filename))
+            try:
+                batch.results = PcapFile(filename).multi_query(
+                    batch.queries, starttime=starttime, endtime=endtime,
+                    duration=duration, byterange=byterange)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
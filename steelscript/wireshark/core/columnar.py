@@ -0,0 +1,271 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Column-at-a-time conversion of tshark field output into pandas DataFrames.
+
+Rows of raw strings are collected into one buffer per field and each
+buffer is converted with a single numpy/pandas operation, instead of
+calling the field datatype on every cell.  The resulting values are the
+same as those produced by the row-by-row conversion in
+:py:meth:`PcapFile.query <steelscript.wireshark.core.pcap.PcapFile.query>`.
+
+With ``compact`` the DataFrame uses the smallest dtypes that hold the
+field's values instead: nullable integers sized from the field type
+(``FT_UINT16`` gives ``UInt16``), float64, datetime64 for times, and
+categoricals for string columns with many repeated values such as
+addresses and protocol names.
+"""
+
+import re
+import datetime
+import logging
+
+import numpy
+import pandas
+import tzlocal
+
+from dateutil.parser import parse as dateutil_parse
+
+from steelscript.wireshark.core import metrics
+
+logger = logging.getLogger(__name__)
+
+local_tz = tzlocal.get_localzone()
+
+# Number of rows buffered before a batch is converted
+BATCHSIZE = 100000
+
+
+def _null_mask(values):
+    """Return a boolean array that is True for missing cells."""
+    return pandas.isnull(values) | (values == '')
+
+
+def _epoch_to_datetime(values, mask):
+    """Convert epoch seconds strings to tz-aware datetimes."""
+    floats = numpy.where(mask, 'nan', values).astype(numpy.float64)
+    return seconds_to_datetime(floats, mask)
+
+
+def seconds_to_datetime(floats, mask):
+    """Convert epoch seconds to tz-aware datetimes, NaT where ``mask``.
+
+    Rounding to microseconds mirrors ``datetime.utcfromtimestamp`` so the
+    values match the row-by-row conversion exactly.
+    """
+    frac, whole = numpy.modf(floats)
+    us = numpy.rint(frac * 1e6)
+
+    over = us >= 1000000
+    whole[over] += 1
+    us[over] -= 1000000
+    under = us < 0
+    whole[under] -= 1
+    us[under] += 1000000
+
+    us = numpy.where(mask, 0, whole * 1000000 + us).astype(numpy.int64)
+    result = pandas.to_datetime(us, unit='us', utc=True)
+    result = pandas.Series(result).dt.tz_convert(local_tz)
+    result[mask] = pandas.NaT
+    return result.array
+
+
+def _absolute_time(values, mask):
+    """Parse absolute time strings, once per distinct value."""
+    parsed = {}
+    for v in pandas.unique(values[~mask]):
+        parsed[v] = dateutil_parse(v).replace(tzinfo=local_tz)
+    return pandas.Series([None if m else parsed[v]
+                          for v, m in zip(values, mask)]).array
+
+
+def _integers(values, mask):
+    """Parse integers, detecting the base once for the whole column."""
+    valid = values[~mask]
+    try:
+        # Decimal strings convert in a single pass.  astype() would read
+        # '010' as 10 and fail on '0x10', so values with a leading zero
+        # go through int(v, base=0) below like every value used to.
+        digits = numpy.char.lstrip(valid.astype(str), '+-')
+        if (numpy.char.startswith(digits, '0') &
+                (numpy.char.str_len(digits) > 1)).any():
+            raise ValueError('prefixed integers')
+        ints = valid.astype(numpy.int64)
+    except (ValueError, OverflowError):
+        # Hex/octal values (e.g. tcp.flags), parse the distinct values
+        lookup = {v: int(v, base=0) for v in pandas.unique(valid)}
+        ints = numpy.array([lookup[v] for v in valid])
+
+    if not mask.any():
+        return ints
+
+    result = numpy.full(len(values), numpy.nan)
+    result[~mask] = ints
+    return result
+
+
+def _floats(values, mask):
+    return numpy.where(mask, 'nan', values).astype(numpy.float64)
+
+
+def _strings(values, mask):
+    result = values.copy()
+    result[mask] = None
+    return result
+
+
+_INT_TYPE = re.compile(r'FT_(U?)INT(\d+)$')
+
+# String columns with at most this fraction of distinct values are
+# returned as categoricals
+CATEGORY_RATIO = 0.5
+
+
+def int_dtype(field):
+    """Return the pandas nullable integer dtype for an integer field."""
+    t = field.datatype_str
+    if t == 'FT_FRAMENUM':
+        return 'UInt32'
+
+    m = _INT_TYPE.match(t)
+    if m is None:
+        return 'Int64'
+    bits = int(m.group(2))
+    for size in (8, 16, 32, 64):
+        if bits <= size:
+            break
+    return '%sInt%d' % ('U' if m.group(1) else '', size)
+
+
+def _compact_integers(field, values, mask):
+    valid = values[~mask]
+    ints = _integers(valid, numpy.zeros(len(valid), dtype=bool))
+    dtype = int_dtype(field)
+    if not mask.any():
+        return pandas.array(ints, dtype=dtype)
+
+    result = numpy.zeros(len(values), dtype=numpy.dtype(dtype.lower()))
+    result[~mask] = ints
+    return pandas.arrays.IntegerArray(result, mask.copy())
+
+
+def _compact_absolute_time(values, mask):
+    return pandas.DatetimeIndex(_absolute_time(values, mask)).array
+
+
+def _categories(values, mask):
+    return pandas.Categorical(_strings(values, mask))
+
+
+def convert_column(field, values, compact=False):
+    """Convert an array of tshark output strings for one field.
+
+    :param field: the TSharkField describing the column
+    :param values: numpy object array of strings (or None)
+    :param bool compact: use nullable sized integers, datetime64 and
+        categorical strings
+    """
+    mask = _null_mask(values)
+    t = field.datatype
+
+    if compact:
+        if t == datetime.datetime:
+            return _compact_absolute_time(values, mask)
+        elif field.name == 'frame.time_epoch':
+            return _epoch_to_datetime(values, mask)
+        elif t == int:
+            return _compact_integers(field, values, mask)
+        elif t == float:
+            return _floats(values, mask)
+        else:
+            return _categories(values, mask)
+
+    if t == datetime.datetime:
+        return _absolute_time(values, mask)
+    elif field.name == 'frame.time_epoch':
+        return _epoch_to_datetime(values, mask)
+    elif t == int:
+        return _integers(values, mask)
+    elif t == float:
+        return _floats(values, mask)
+    else:
+        return _strings(values, mask)
+
+
+def rows_to_dataframe(fields, fieldnames, rows, compact=False):
+    """Convert a list of rows of strings into a DataFrame."""
+    columns = {}
+    for i, name in enumerate(fieldnames):
+        values = numpy.empty(len(rows), dtype=object)
+        values[:] = [row[i] for row in rows]
+        columns[name] = convert_column(fields[i], values, compact)
+    return pandas.DataFrame(columns, columns=fieldnames)
+
+
+def _concat_compact(frames, fieldnames):
+    """Concatenate compact batches, merging the categories of each
+    string column."""
+    from pandas.api.types import union_categoricals
+
+    columns = {}
+    for i, name in enumerate(fieldnames):
+        parts = [frame.iloc[:, i] for frame in frames]
+        if isinstance(parts[0].dtype, pandas.CategoricalDtype):
+            columns[name] = union_categoricals(parts)
+        else:
+            columns[name] = pandas.concat(parts, ignore_index=True)
+    return pandas.DataFrame(columns, columns=fieldnames)
+
+
+def _uncategorize(df):
+    """Turn categorical columns with mostly distinct values back into
+    object columns.  The values still share the category strings, so
+    repeated values are not duplicated in memory."""
+    for i in range(df.shape[1]):
+        column = df.iloc[:, i]
+        if (isinstance(column.dtype, pandas.CategoricalDtype) and
+                len(column.cat.categories) > CATEGORY_RATIO * len(column)):
+            df.isetitem(i, column.astype(object))
+    return df
+
+
+def to_dataframe(fields, fieldnames, rows, batchsize=BATCHSIZE,
+                 compact=False):
+    """Build a DataFrame from an iterable of rows of tshark strings.
+
+    Rows are buffered ``batchsize`` at a time and each batch is converted
+    column by column.  Returns None if there are no rows.
+
+    :param bool compact: use the compact dtypes described above
+    """
+    frames = []
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batchsize:
+            with metrics.phase('convert'):
+                frames.append(rows_to_dataframe(fields, fieldnames, batch,
+                                                compact))
+            batch = []
+    if batch:
+        with metrics.phase('convert'):
+            frames.append(rows_to_dataframe(fields, fieldnames, batch,
+                                            compact))
+
+    if not frames:
+        return None
+    with metrics.phase('dataframe'):
+        if len(frames) == 1:
+            df = frames[0]
+        elif compact:
+            df = _concat_compact(frames, fieldnames)
+        else:
+            df = pandas.concat(frames, ignore_index=True)
+
+        if compact:
+            df = _uncategorize(df)
+    return df
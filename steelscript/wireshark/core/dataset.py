@@ -0,0 +1,333 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Time-indexed queries across many capture files, such as the files
+written by a ring buffer.
+
+The start and end time of every file is taken from
+:py:meth:`PcapFile.info` and cached in ``~/.steelscript/pcap_dataset.json``
+keyed by path, size and modification time, so re-opening a dataset only
+reads new or modified files.  Entries of files that were removed from
+the dataset's paths are dropped when it is refreshed.
+"""
+
+import os
+import glob
+import json
+import fnmatch
+import heapq
+import logging
+import itertools
+import threading
+import subprocess
+import collections
+import concurrent.futures
+
+from steelscript.wireshark.core.exceptions import WiresharkException
+from steelscript.wireshark.core.pcap import (PcapFile, _resolve_timerange,
+                                             _to_ns, _lookup_fields,
+                                             _convert_row, _result)
+
+logger = logging.getLogger(__name__)
+
+
+DatasetFile = collections.namedtuple(
+    'DatasetFile', 'filename starttime endtime numpackets')
+
+
+class PcapDataset(object):
+    """A set of capture files queried as one capture.
+
+    Usage::
+
+        ds = PcapDataset('/data/ring/*.pcap')
+        df = ds.query(['frame.time_epoch', 'ip.src', 'ip.len'],
+                      starttime='2024-03-01 10:00', duration='5min',
+                      as_dataframe=True)
+
+    :param paths: a directory, a glob pattern or a list of them
+    :param bool recursive: include files in subdirectories of
+        directories, and let ``**`` in patterns match any depth
+    :param int workers: threads used to read file info and to run
+        queries, one tshark per file
+    """
+
+    CACHEFILE = os.path.join(os.path.expanduser('~'), '.steelscript',
+                             'pcap_dataset.json')
+
+    # File extensions considered when a directory is given
+    EXTENSIONS = ('.pcap', '.pcapng', '.cap', '.pcap.gz', '.pcapng.gz')
+
+    _cache_lock = threading.Lock()
+
+    def __init__(self, paths, recursive=False, workers=4):
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = list(paths)
+        self.recursive = recursive
+        self.workers = workers
+        self.files = []
+        self.refresh()
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    @property
+    def starttime(self):
+        """Time of the first packet of the dataset, in ns."""
+        return min(f.starttime for f in self.files) if self.files else None
+
+    @property
+    def endtime(self):
+        """Time of the last packet of the dataset, in ns."""
+        return max(f.endtime for f in self.files) if self.files else None
+
+    def _filenames(self):
+        names = set()
+        for path in self.paths:
+            if os.path.isdir(path):
+                if self.recursive:
+                    walk = os.walk(path)
+                else:
+                    walk = [(path, [], os.listdir(path))]
+                for dirpath, _, filenames in walk:
+                    for name in filenames:
+                        if name.lower().endswith(self.EXTENSIONS):
+                            names.add(os.path.join(dirpath, name))
+            else:
+                names.update(f for f in glob.glob(path,
+                                                  recursive=self.recursive)
+                             if os.path.isfile(f))
+        return sorted(os.path.abspath(n) for n in names)
+
+    def _covers(self, filename):
+        """True if ``filename`` would be part of the dataset if it
+        existed."""
+        for path in self.paths:
+            path = os.path.abspath(path)
+            if glob.escape(path) != path:
+                if fnmatch.fnmatch(filename, path):
+                    return True
+            elif filename == path:
+                return True
+            elif filename.lower().endswith(self.EXTENSIONS) and (
+                    os.path.dirname(filename) == path or
+                    (self.recursive and
+                     filename.startswith(os.path.join(path, '')))):
+                return True
+        return False
+
+    def refresh(self):
+        """Rescan the paths, reading the info of new or modified files
+        and forgetting the files that are gone."""
+        cache = self._load_cache()
+        filenames = self._filenames()
+        removed = set(cache) - set(filenames)
+        removed = [f for f in removed if self._covers(f)]
+        for filename in removed:
+            del cache[filename]
+
+        files = []
+        todo = []
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            ident = [st.st_size, st.st_mtime_ns]
+            entry = cache.get(filename)
+            if entry is not None and entry[:2] == ident:
+                if entry[2] is not None:
+                    files.append(DatasetFile(filename, *entry[2:]))
+            else:
+                todo.append((filename, ident))
+
+        if todo:
+            logger.info("Reading info of %d capture files" % len(todo))
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                for (filename, ident), info in zip(
+                        todo, pool.map(_file_info, [t[0] for t in todo])):
+                    cache[filename] = ident + list(info)
+                    if info[0] is not None:
+                        files.append(DatasetFile(filename, *info))
+        if todo or removed:
+            self._save_cache(dict((f, cache[f]) for f, _ in todo), removed)
+
+        files.sort(key=lambda f: (f.starttime, f.filename))
+        self.files = files
+        return self.files
+
+    def _load_cache(self):
+        try:
+            with open(self.CACHEFILE) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cache, removed=()):
+        with self._cache_lock:
+            # Merge with entries written by other datasets meanwhile
+            current = self._load_cache()
+            current.update(cache)
+            for filename in removed:
+                current.pop(filename, None)
+            dirname = os.path.dirname(self.CACHEFILE)
+            try:
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                tmp = '%s.%d.tmp' % (self.CACHEFILE, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(current, f)
+                os.replace(tmp, self.CACHEFILE)
+            except (IOError, OSError) as e:
+                logger.warning("Could not save dataset cache: %s" % e)
+
+    def select(self, starttime=None, endtime=None, duration=None):
+        """Return the files with packets in ``[starttime, endtime)``."""
+        starttime, endtime = _resolve_timerange(starttime, endtime,
+                                                duration)
+        start_ns = _to_ns(starttime)
+        end_ns = _to_ns(endtime)
+        return [f for f in self.files
+                if (end_ns is None or f.starttime < end_ns) and
+                (start_ns is None or f.endtime >= start_ns)]
+
+    def iter_query(self, fieldnames, filterexpr=None,
+                   starttime=None, endtime=None, duration=None,
+                   use_tshark_fields=True,
+                   occurrence=PcapFile.OCCURRENCE_ALL,
+                   aggregator=',',
+                   explode=None):
+        """Generate the rows of all files with packets in the time range,
+        merged in packet time order.
+
+        Only the overlapping files are read.  Files entirely inside the
+        range are read whole and the files at its edges are trimmed to
+        it.  Up to ``workers`` files are queried in parallel ahead of the
+        rows being consumed.  Files whose time ranges overlap are merged
+        by ``frame.time_epoch``; packets out of order within a file are
+        returned as tshark reports them.
+
+        Arguments have the same meaning as for :py:meth:`PcapFile.query`.
+        """
+        starttime, endtime = _resolve_timerange(starttime, endtime,
+                                                duration)
+        start_ns = _to_ns(starttime)
+        end_ns = _to_ns(endtime)
+        files = self.select(starttime, endtime)
+        logger.info("Querying %d of %d files" % (len(files), len(self)))
+
+        queried = list(fieldnames)
+        if 'frame.time_epoch' not in queried:
+            queried.append('frame.time_epoch')
+        ti = queried.index('frame.time_epoch')
+        fields = _lookup_fields(fieldnames, use_tshark_fields)
+
+        def rows(entry):
+            trim = ((start_ns is not None and entry.starttime < start_ns) or
+                    (end_ns is not None and entry.endtime >= end_ns))
+            return list(PcapFile(entry.filename).iter_query(
+                queried, filterexpr=filterexpr,
+                starttime=starttime if trim else None,
+                endtime=endtime if trim else None,
+                use_tshark_fields=False,
+                occurrence=occurrence, aggregator=aggregator,
+                explode=explode))
+
+        def key(row):
+            t = row[ti]
+            if isinstance(t, list):
+                # explode='list'
+                t = t[0]
+            return float(t) if t else 0.0
+
+        n = len(fieldnames)
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            groups = iter(_overlapping(files))
+            pending = collections.deque()
+            for group in itertools.islice(groups, self.workers):
+                pending.append([pool.submit(rows, f) for f in group])
+
+            while pending:
+                futures = pending.popleft()
+                group = next(groups, None)
+                if group is not None:
+                    pending.append([pool.submit(rows, f) for f in group])
+
+                results = [future.result() for future in futures]
+                if len(results) == 1:
+                    merged = results[0]
+                else:
+                    merged = heapq.merge(*results, key=key)
+
+                for row in merged:
+                    row = row[:n]
+                    if fields is not None:
+                        row = _convert_row(fields, row)
+                    yield row
+
+    def query(self, fieldnames, filterexpr=None,
+              starttime=None, endtime=None, duration=None,
+              use_tshark_fields=True,
+              occurrence=PcapFile.OCCURRENCE_ALL,
+              aggregator=',',
+              as_dataframe=False,
+              columnar=False,
+              compact=False,
+              explode=None):
+        """Query all files with packets in the time range, see
+        :py:meth:`iter_query`.  Returns a list or DataFrame like
+        :py:meth:`PcapFile.query`."""
+        columnar = as_dataframe and (columnar or compact) and \
+            use_tshark_fields and explode != 'list'
+        rows = self.iter_query(fieldnames, filterexpr=filterexpr,
+                               starttime=starttime, endtime=endtime,
+                               duration=duration,
+                               use_tshark_fields=(use_tshark_fields and
+                                                  not columnar),
+                               occurrence=occurrence,
+                               aggregator=aggregator,
+                               explode=explode)
+        return _result(rows, fieldnames, use_tshark_fields, as_dataframe,
+                       columnar, compact)
+
+
+def _file_info(filename):
+    """Return ``(starttime, endtime, numpackets)`` of a capture, with the
+    times in ns, or Nones if it cannot be read."""
+    pcap = PcapFile(filename)
+    try:
+        pcap.info()
+    except (ValueError, WiresharkException, subprocess.CalledProcessError,
+            IOError, OSError) as e:
+        logger.warning("Skipping %s: %s" % (filename, e))
+        return None, None, None
+    if pcap.starttime is None:
+        # No packets
+        return None, None, None
+    # info() times have microsecond resolution, round the end up
+    return (_to_ns(pcap.starttime), _to_ns(pcap.endtime) + 999,
+            int(pcap.numpackets))
+
+
+def _overlapping(files):
+    """Group files sorted by start time into runs whose time ranges
+    overlap."""
+    group = []
+    end = None
+    for f in files:
+        if group and f.starttime > end:
+            yield group
+            group = []
+            end = None
+        group.append(f)
+        end = f.endtime if end is None else max(end, f.endtime)
+    if group:
+        yield group
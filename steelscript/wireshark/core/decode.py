@@ -0,0 +1,253 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Native decoding of common frame, IP and transport fields.
+
+:py:meth:`PcapFile.query <steelscript.wireshark.core.pcap.PcapFile.query>`
+answers queries using only the fields in :py:data:`FIELDS` without
+running tshark.  The headers are decoded straight from the memory-mapped
+capture by :py:mod:`~steelscript.wireshark.core.headers` into numpy
+structured arrays::
+
+    values, present = decode('trace.pcap', ['ip.src', 'tcp.dstport'],
+                             'tcp.flags == 0x002')
+    values['tcp.dstport']       # array([443, 80, ...], dtype=uint16)
+
+The filter, if any, must only use what
+:py:mod:`~steelscript.wireshark.core.prefilter` evaluates.  Results are
+the same as tshark's.  Packets that cannot carry IP, such as ARP or
+802.3 LLC frames like STP and CDP, have the IP and transport fields
+absent.  When a packet's fields could differ from what tshark reports,
+such as IP fragments, tunnels, ICMP errors, truncated headers or frames
+that are neither Ethernet, Linux cooked nor raw IP, decoding gives up
+and the query runs with tshark instead.  ``frame.time_epoch``
+is rounded to microseconds like the tshark output conversion.  Set
+``PcapFile.NATIVE_DECODE = False`` to always run tshark.
+"""
+
+import ipaddress
+import logging
+
+import numpy
+
+from steelscript.wireshark.core import headers, prefilter
+from steelscript.wireshark.core.exceptions import DisplayFilterError
+
+logger = logging.getLogger(__name__)
+
+# Field -> (dtype, Headers mask of packets that have it, or None if all
+# packets do, Headers value attribute)
+FIELDS = {'frame.time_epoch': ('i8', 'has_timestamp', 'timestamp'),
+          'frame.len': ('u4', None, 'origlen'),
+          'frame.cap_len': ('u4', None, 'caplen'),
+          'frame.number': ('u4', None, None),
+          'ip.src': ('u4', 'ip', 'ip_src'),
+          'ip.dst': ('u4', 'ip', 'ip_dst'),
+          'ip.len': ('u2', 'ip', 'ip_len'),
+          'ip.proto': ('u1', 'ip', 'ip_proto'),
+          'ip.ttl': ('u1', 'ip', 'ip_ttl'),
+          'tcp.srcport': ('u2', 'tcp', 'srcport'),
+          'tcp.dstport': ('u2', 'tcp', 'dstport'),
+          'tcp.flags': ('u2', 'tcp', 'tcp_flags'),
+          'udp.srcport': ('u2', 'udp', 'srcport'),
+          'udp.dstport': ('u2', 'udp', 'dstport'),
+          'udp.length': ('u2', 'udp', 'udp_length')}
+
+# Fields holding IPv4 addresses, returned as strings
+ADDRESS_FIELDS = ('ip.src', 'ip.dst')
+
+
+def covers(fieldnames):
+    """True if every one of ``fieldnames`` can be decoded natively.
+    Fields listed more than once are left to tshark, the columns of a
+    structured array must have distinct names."""
+    return (bool(fieldnames) and len(set(fieldnames)) == len(fieldnames)
+            and all(n in FIELDS for n in fieldnames))
+
+
+def supports_filter(filterexpr):
+    """True if ``filterexpr`` can be evaluated on decoded headers."""
+    try:
+        return prefilter.complete(prefilter.parse(filterexpr))
+    except DisplayFilterError as e:
+        logger.debug("Cannot decode filter %r natively: %s"
+                     % (filterexpr, e))
+        return False
+
+
+def decode(filename, fieldnames, filterexpr=None, start=None, end=None,
+           section=None, first_packet=None, start_ns=None, end_ns=None,
+           batchsize=headers.BATCH):
+    """Decode ``fieldnames`` for the packets of ``filename`` matching
+    ``filterexpr``.
+
+    Returns ``(values, present)``, two structured arrays with one entry
+    per packet and a column per field: the values, and masks of the
+    packets that have the field.  Returns None if some selected packet
+    cannot be decoded exactly, see :py:mod:`headers`, or if the filter
+    is not supported.
+
+    :param int start: offset of the first record, defaults to the first
+        one in the file
+    :param int end: offset after the last record
+    :param int section: pcapng section of ``start``
+    :param int first_packet: 0-based number of the packet at ``start``,
+        for ``frame.number``
+    :param int start_ns: only packets at or after this time
+    :param int end_ns: only packets before this time
+    """
+    node = None
+    if filterexpr:
+        node = prefilter.parse(filterexpr)
+        if not prefilter.complete(node):
+            return None
+
+    # Frame fields are always what tshark reports
+    exact = any(FIELDS[n][1] not in (None, 'has_timestamp')
+                for n in fieldnames)
+    timed = start_ns is not None or end_ns is not None
+    first = first_packet or 0
+
+    dtype = numpy.dtype([(n, FIELDS[n][0]) for n in fieldnames])
+    masks = numpy.dtype([(n, bool) for n in fieldnames])
+    values = []
+    present = []
+    total = 0
+    for h in headers.scan(filename, start, end, section, batchsize):
+        keep = numpy.ones(len(h), dtype=bool)
+        if timed:
+            if not h.has_timestamp.all():
+                return None
+            if start_ns is not None:
+                keep &= h.timestamp >= start_ns
+            if end_ns is not None:
+                keep &= h.timestamp < end_ns
+
+        if node is not None:
+            true, false = prefilter.evaluate(node, h, True)
+            if (keep & ~true & ~false).any():
+                return None
+            keep &= true
+
+        if exact and (keep & ~h.exact).any():
+            return None
+
+        selected = numpy.flatnonzero(keep)
+        batch = numpy.zeros(len(selected), dtype=dtype)
+        batch_present = numpy.ones(len(selected), dtype=masks)
+        for name in fieldnames:
+            _, has, attr = FIELDS[name]
+            if attr is None:
+                batch[name] = first + total + selected + 1
+            else:
+                batch[name] = getattr(h, attr)[selected]
+            if has is not None:
+                batch_present[name] = getattr(h, has)[selected]
+        values.append(batch)
+        present.append(batch_present)
+        total += len(h)
+
+    if not values:
+        return (numpy.zeros(0, dtype=dtype), numpy.zeros(0, dtype=masks))
+    return numpy.concatenate(values), numpy.concatenate(present)
+
+
+def _addresses(values, present):
+    """Dotted quad strings of ``uint32`` addresses, None where absent."""
+    result = numpy.empty(len(values), dtype=object)
+    unique, inverse = numpy.unique(values[present], return_inverse=True)
+    names = numpy.array([str(ipaddress.IPv4Address(int(v)))
+                         for v in unique], dtype=object)
+    result[present] = names[inverse]
+    return result
+
+
+def _times(values, present):
+    """tz-aware datetimes in the local timezone, as converted from
+    tshark's output."""
+    from steelscript.wireshark.core.columnar import seconds_to_datetime
+
+    ns = numpy.where(present, values, 0)
+    if (ns % 1000 == 0).all():
+        # Any float this close gives the same microseconds
+        seconds = ns / 1e9
+    else:
+        # The nearest float to the decimal seconds tshark prints, for
+        # the same rounding of sub-microsecond times
+        seconds = numpy.array([n / 1000000000 for n in ns.tolist()],
+                              dtype=numpy.float64)
+    seconds[~present] = numpy.nan
+    return seconds_to_datetime(seconds, ~present)
+
+
+def _column(field, values, present, columnar, compact):
+    """DataFrame column for one field, with the dtypes of
+    :py:func:`~steelscript.wireshark.core.columnar.convert_column`, or
+    those pandas infers from rows unless ``columnar``."""
+    import pandas
+    from steelscript.wireshark.core.columnar import int_dtype
+
+    name = field.name
+    if not columnar and not present.any():
+        return numpy.full(len(values), None, dtype=object)
+    if name == 'frame.time_epoch':
+        return _times(values, present)
+    if name in ADDRESS_FIELDS:
+        strings = _addresses(values, present)
+        return pandas.Categorical(strings) if compact else strings
+
+    if compact:
+        dtype = int_dtype(field)
+        ints = numpy.where(present, values, 0).astype(dtype.lower())
+        return pandas.arrays.IntegerArray(ints, ~present)
+    if present.all():
+        return values.astype(numpy.int64)
+    return numpy.where(present, values, numpy.nan)
+
+
+def _objects(name, values, present):
+    """Python values of one field for list results."""
+    if name == 'frame.time_epoch':
+        result = _times(values, present).to_pydatetime()
+    elif name in ADDRESS_FIELDS:
+        return _addresses(values, present).tolist()
+    else:
+        result = values.astype(numpy.int64).astype(object)
+    result[~present] = None
+    return result.tolist()
+
+
+def to_result(values, present, fields, as_dataframe, columnar=False,
+              compact=False):
+    """Build the result of :py:meth:`PcapFile.query` from
+    :py:func:`decode` output, with the values, types and missing values
+    the tshark output conversion gives.
+
+    :param list fields: the TSharkField of each column
+    :param bool columnar: match the DataFrame dtypes of the ``columnar``
+        and ``compact`` query options
+    """
+    fieldnames = list(values.dtype.names)
+    if not as_dataframe:
+        columns = [_objects(name, values[name], present[name])
+                   for name in fieldnames]
+        return [list(row) for row in zip(*columns)]
+
+    if not len(values):
+        return None
+
+    import pandas
+    from steelscript.wireshark.core.columnar import _uncategorize
+
+    columns = {}
+    for field, name in zip(fields, fieldnames):
+        columns[name] = _column(field, values[name], present[name],
+                                columnar or compact, compact)
+    df = pandas.DataFrame(columns, columns=fieldnames)
+    if compact:
+        df = _uncategorize(df)
+    return df
@@ -0,0 +1,399 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Parser and evaluator for a subset of the Wireshark display filter syntax.
+
+Filters are evaluated against the field values tshark printed for a
+packet, which lets one tshark pass serve several queries with different
+filters.  Only constructs whose result can be reproduced exactly from
+``-T fields`` output are accepted:
+
+* protocol tests (``tcp``), field existence (``tcp.port``)
+* comparisons ``== != > < >= <=`` (and ``eq ne gt lt ge le``) of a field
+  with a literal, ``contains`` and ``matches`` on string fields, and
+  ``in {...}`` sets
+* ``&& || !`` (and ``and or not``) and parentheses
+
+Comparisons follow Wireshark 3.6+ semantics: ``==`` is true if any
+occurrence of the field matches, ``!=`` if the field is present and no
+occurrence matches.  Anything else raises
+:py:class:`~steelscript.wireshark.core.exceptions.DisplayFilterError`
+so the caller can let tshark apply the filter instead.
+"""
+
+import re
+import ipaddress
+
+from steelscript.wireshark.core.exceptions import DisplayFilterError
+
+
+# Field used to test for protocols
+PROTOCOLS_FIELD = 'frame.protocols'
+
+_TOKEN = re.compile(r'''
+    \s*(?:
+      (?P<string>"(?:[^"\\]|\\.)*")
+    | (?P<op>==|!=|>=|<=|&&|\|\||[()!<>{},~])
+    | (?P<word>[A-Za-z0-9_.:/-]+)
+    | (?P<bad>\S)
+    )''', re.VERBOSE)
+
+_OPERATORS = {'==': '==', 'eq': '==', '!=': '!=', 'ne': '!=',
+              '>': '>', 'gt': '>', '<': '<', 'lt': '<',
+              '>=': '>=', 'ge': '>=', '<=': '<=', 'le': '<=',
+              'contains': 'contains', 'matches': 'matches', '~': 'matches',
+              'in': 'in'}
+
+_INT_TYPES = re.compile(r'FT_(U?INT\d*|FRAMENUM|CHAR)$')
+_FLOAT_TYPES = re.compile(r'FT_(FLOAT|DOUBLE|RELATIVE_TIME)$')
+_STRING_TYPES = re.compile(r'FT_(STRING|STRINGZ|STRINGZPAD|STRINGZTRUNC|'
+                           r'UINT_STRING)$')
+
+
+def _unescape(literal):
+    return re.sub(r'\\(x[0-9a-fA-F]{2}|.)',
+                  lambda m: (chr(int(m.group(1)[1:], 16))
+                             if len(m.group(1)) == 3 else m.group(1)),
+                  literal[1:-1])
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if m.group('bad') is not None:
+            raise DisplayFilterError('Unsupported character %r in filter %r'
+                                     % (m.group('bad'), text))
+        kind = m.lastgroup
+        tokens.append((kind, m.group(kind)))
+        pos = m.end()
+    return tokens
+
+
+class Value(object):
+    """How the printed values of a field are compared with literals."""
+
+    def __init__(self, field):
+        self.field = field
+        t = field.datatype_str
+        if _INT_TYPES.match(t):
+            self.kind = 'int'
+        elif _FLOAT_TYPES.match(t):
+            self.kind = 'float'
+        elif t == 'FT_BOOLEAN':
+            self.kind = 'bool'
+        elif t in ('FT_IPv4', 'FT_IPv6'):
+            self.kind = 'ip'
+        elif t == 'FT_ETHER':
+            self.kind = 'ether'
+        elif _STRING_TYPES.match(t):
+            self.kind = 'string'
+        elif t in ('FT_NONE', 'FT_PROTOCOL'):
+            # Printed as an empty string, presence cannot be told apart
+            raise DisplayFilterError('Cannot test %s (%s)' % (field.name, t))
+        else:
+            self.kind = None
+
+    def packet(self, value):
+        """Convert a printed value."""
+        kind = self.kind
+        if kind == 'int':
+            return int(value, 0)
+        elif kind == 'float':
+            return float(value)
+        elif kind == 'bool':
+            return value in ('1', 'True', 'true')
+        elif kind == 'ip':
+            return ipaddress.ip_address(value)
+        elif kind == 'ether':
+            return re.sub('[^0-9a-f]', '', value.lower())
+        return value
+
+    def literal(self, literal, quoted, op):
+        """Convert a filter literal for comparison with ``op``."""
+        name = self.field.name
+        kind = self.kind
+        if kind is None:
+            raise DisplayFilterError('Cannot compare %s (%s)'
+                                     % (name, self.field.datatype_str))
+        if op in ('contains', 'matches'):
+            if kind != 'string' or not quoted:
+                raise DisplayFilterError('Unsupported %s on %s' % (op, name))
+            if op == 'matches':
+                return re.compile(literal, re.IGNORECASE)
+            return literal
+        if kind == 'string':
+            return literal
+        if quoted:
+            raise DisplayFilterError('Unsupported string literal for %s'
+                                     % name)
+        try:
+            if kind == 'int':
+                return int(literal, 0)
+            elif kind == 'float':
+                return float(literal)
+            elif kind == 'bool':
+                if literal.lower() not in ('1', '0', 'true', 'false'):
+                    raise ValueError(literal)
+                return literal.lower() in ('1', 'true')
+            elif kind == 'ip':
+                if '/' in literal:
+                    if op not in ('==', '!=', 'in'):
+                        raise ValueError(literal)
+                    return ipaddress.ip_network(literal, strict=False)
+                return ipaddress.ip_address(literal)
+            elif kind == 'ether':
+                value = re.sub('[:.-]', '', literal.lower())
+                if (op not in ('==', '!=', 'in') or
+                        not re.match('^[0-9a-f]{12}$', value)):
+                    raise ValueError(literal)
+                return value
+        except ValueError:
+            raise DisplayFilterError('Unsupported value %r for %s'
+                                     % (literal, name))
+
+
+def _equal(value, literal):
+    if isinstance(literal, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+        return value in literal
+    return value == literal
+
+
+class Node(object):
+
+    def fields(self):
+        """Names of the fields the node needs."""
+        return set()
+
+
+class Protocol(Node):
+
+    def __init__(self, name):
+        self.name = name
+
+    def fields(self):
+        return set([PROTOCOLS_FIELD])
+
+    def evaluate(self, packet):
+        protocols = packet.get(PROTOCOLS_FIELD)
+        if not protocols:
+            return False
+        return any(self.name in p.split(':') for p in protocols)
+
+
+class Exists(Node):
+
+    def __init__(self, value):
+        self.value = value
+
+    def fields(self):
+        return set([self.value.field.name])
+
+    def evaluate(self, packet):
+        return bool(packet.get(self.value.field.name))
+
+
+class Compare(Node):
+
+    def __init__(self, value, op, literal):
+        self.value = value
+        self.op = op
+        self.literal = literal
+
+    def fields(self):
+        return set([self.value.field.name])
+
+    def evaluate(self, packet):
+        printed = packet.get(self.value.field.name)
+        if not printed:
+            return False
+        try:
+            values = [self.value.packet(v) for v in printed]
+        except ValueError:
+            return False
+
+        op = self.op
+        literal = self.literal
+        if op == '==':
+            return any(_equal(v, literal) for v in values)
+        elif op == '!=':
+            return not any(_equal(v, literal) for v in values)
+        elif op == 'in':
+            return any(_equal(v, lit) for v in values for lit in literal)
+        elif op == 'contains':
+            return any(literal in v for v in values)
+        elif op == 'matches':
+            return any(literal.search(v) for v in values)
+        elif op == '>':
+            return any(v > literal for v in values)
+        elif op == '<':
+            return any(v < literal for v in values)
+        elif op == '>=':
+            return any(v >= literal for v in values)
+        elif op == '<=':
+            return any(v <= literal for v in values)
+        raise DisplayFilterError('Unsupported operator %s' % op)
+
+
+class Not(Node):
+
+    def __init__(self, node):
+        self.node = node
+
+    def fields(self):
+        return self.node.fields()
+
+    def evaluate(self, packet):
+        return not self.node.evaluate(packet)
+
+
+class Logical(Node):
+
+    def __init__(self, op, nodes):
+        self.op = op
+        self.nodes = nodes
+
+    def fields(self):
+        return set().union(*[n.fields() for n in self.nodes])
+
+    def evaluate(self, packet):
+        if self.op == 'and':
+            return all(n.evaluate(packet) for n in self.nodes)
+        return any(n.evaluate(packet) for n in self.nodes)
+
+
+class _Parser(object):
+
+    def __init__(self, text, catalog):
+        self.text = text
+        self.catalog = catalog
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def error(self, msg):
+        raise DisplayFilterError('%s in filter %r' % (msg, self.text))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def accept(self, *values):
+        kind, value = self.peek()
+        if kind in ('op', 'word') and value in values:
+            self.pos += 1
+            return True
+        return False
+
+    def parse(self):
+        if not self.tokens:
+            self.error('Empty expression')
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            self.error('Unexpected %r' % self.peek()[1])
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.accept('||', 'or'):
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else Logical('or', nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.accept('&&', 'and'):
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else Logical('and', nodes)
+
+    def parse_not(self):
+        if self.accept('!', 'not'):
+            return Not(self.parse_not())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        if self.accept('('):
+            node = self.parse_or()
+            if not self.accept(')'):
+                self.error('Missing )')
+            return node
+
+        kind, name = self.next()
+        if kind != 'word':
+            self.error('Expected a field, got %r' % name)
+
+        kind, op = self.peek()
+        op = _OPERATORS.get(op) if kind in ('op', 'word') else None
+
+        if op is None:
+            if name in self.catalog.protocols and \
+                    name not in self.catalog.fields:
+                return Protocol(name)
+            return Exists(Value(self.field(name)))
+
+        self.pos += 1
+        value = Value(self.field(name))
+        if op == 'in':
+            return Compare(value, op, self.parse_set(value))
+        return Compare(value, op, self.parse_literal(value, op))
+
+    def field(self, name):
+        if name in self.catalog.fields:
+            return self.catalog.fields[name]
+        self.error('Unknown field %s' % name)
+
+    def parse_literal(self, value, op):
+        kind, literal = self.next()
+        if kind == 'string':
+            return value.literal(_unescape(literal), True, op)
+        if kind != 'word':
+            self.error('Expected a value, got %r' % literal)
+        if literal in self.catalog.fields or literal in self.catalog.protocols:
+            # Could be a field reference, let tshark decide
+            self.error('Unsupported comparison with %s' % literal)
+        return value.literal(literal, False, op)
+
+    def parse_set(self, value):
+        if not self.accept('{'):
+            self.error('Expected {')
+        members = []
+        while not self.accept('}'):
+            if self.peek()[0] is None:
+                self.error('Missing }')
+            self.accept(',')
+            if self.peek()[0] == 'word' and '..' in self.peek()[1]:
+                self.error('Unsupported range in set')
+            members.append(self.parse_literal(value, 'in'))
+            self.accept(',')
+        if not members:
+            self.error('Empty set')
+        return members
+
+
+def parse(text, catalog):
+    """Parse a display filter, returning a node with ``evaluate(packet)``
+    and ``fields()``.
+
+    :param str text: display filter
+    :param catalog: TSharkFields used to look up fields and protocols
+    :raises DisplayFilterError: if the filter uses syntax that is not
+        supported
+    """
+    return _Parser(text, catalog).parse()
+
+
+def packet_values(fieldnames, values, aggregator):
+    """Build the ``packet`` dict for ``evaluate`` from one line of
+    ``-E occurrence=a`` output split into ``values``."""
+    return dict((name, v.split(aggregator) if v else [])
+                for name, v in zip(fieldnames, values))
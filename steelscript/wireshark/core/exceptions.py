@@ -15,3 +15,15 @@ class InvalidField(WiresharkException):
 
     def __str__(self):
         return "Invalid Wireshark field: %s" % self.name
+
+
+class CaptureFormatError(WiresharkException):
+    pass
+
+
+class DisplayFilterError(WiresharkException):
+    pass
+
+
+class SharkdError(WiresharkException):
+    pass
@@ -0,0 +1,124 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Expansion of multi-valued fields printed with ``-E occurrence=a``.
+
+The packets of a batch that have several values in some field are
+expanded at once: the values of each column are split and flattened
+into one array, and the row and position of every output cell is
+computed with numpy, so no Python loop runs per output row.  Other
+packets are passed through unchanged.  The modes are:
+
+* ``'zip'``: the n-th values of the multi-valued columns form the n-th
+  row.  Shorter columns are padded with empty values, and
+  single-valued columns are repeated on every row.
+* ``'product'``: one row for every combination of the values of the
+  multi-valued columns.
+* ``'list'``: one row per packet, with the list of values of each
+  field, or None if it has none.
+
+No packet is dropped; a packet without any value gives a single row.
+"""
+
+import numpy
+
+# Supported ``explode`` modes
+MODES = ('zip', 'product', 'list')
+
+
+def _split(rows, i, aggregator):
+    """Return the values of column ``i`` flattened, and the number of
+    values of each row."""
+    flat = []
+    lengths = numpy.zeros(len(rows), dtype=numpy.int64)
+    for r, row in enumerate(rows):
+        cell = row[i]
+        if cell:
+            values = cell.split(aggregator)
+            flat.extend(values)
+            lengths[r] = len(values)
+    values = numpy.empty(len(flat), dtype=object)
+    values[:] = flat
+    return values, lengths
+
+
+def explode_rows(rows, ncols, aggregator, mode):
+    """Expand a batch of split tshark output lines.
+
+    :param list rows: lists of ``ncols`` cells, each with the values of
+        one field joined by ``aggregator``, or empty
+    :param str mode: one of :py:data:`MODES`
+    :returns: list of rows of single values, with ``''`` where a field
+        has no value, or for ``'list'`` rows of lists with None where a
+        field has no value
+    """
+    if mode not in MODES:
+        raise ValueError('Unsupported explode mode: %s' % mode)
+    if not rows:
+        return []
+
+    if mode == 'list':
+        return [[cell.split(aggregator) if cell else None for cell in row]
+                for row in rows]
+
+    # Packets without multiple values are passed through as they are
+    multi = [i for i, row in enumerate(rows)
+             if any(aggregator in cell for cell in row if cell)]
+    if not multi:
+        return rows
+
+    expanded, sizes = _expand([rows[i] for i in multi], ncols, aggregator,
+                              mode)
+    out = []
+    last = 0
+    start = 0
+    for i, size in zip(multi, sizes):
+        out.extend(rows[last:i])
+        out.extend(expanded[start:start + size])
+        last = i + 1
+        start += size
+    out.extend(rows[last:])
+    return out
+
+
+def _expand(rows, ncols, aggregator, mode):
+    """Expand rows for the 'zip' or 'product' modes, returning the new
+    rows and the number of rows for each packet."""
+    columns = [_split(rows, i, aggregator) for i in range(ncols)]
+
+    # Number of output rows of each packet
+    sizes = numpy.ones(len(rows), dtype=numpy.int64)
+    for _, lengths in columns:
+        if mode == 'zip':
+            sizes = numpy.maximum(sizes, lengths)
+        else:
+            sizes *= numpy.maximum(lengths, 1)
+
+    total = int(sizes.sum())
+    packet = numpy.repeat(numpy.arange(len(rows)), sizes)
+    # Position of each output row within its packet
+    position = numpy.arange(total) - numpy.repeat(numpy.cumsum(sizes) -
+                                                  sizes, sizes)
+
+    out = []
+    stride = numpy.ones(len(rows), dtype=numpy.int64)
+    for values, lengths in reversed(columns):
+        starts = numpy.cumsum(lengths) - lengths
+        n = lengths[packet]
+        if mode == 'zip':
+            # A single value is repeated, missing values are padded
+            index = numpy.where(n == 1, 0, position)
+        else:
+            index = (position // stride[packet]) % numpy.maximum(n, 1)
+            stride *= numpy.maximum(lengths, 1)
+        present = index < n
+
+        cells = numpy.full(total, '', dtype=object)
+        cells[present] = values[(starts[packet] + index)[present]]
+        out.append(cells)
+    out.reverse()
+    return [list(row) for row in zip(*out)], sizes.tolist()
@@ -0,0 +1,385 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+SQLite-backed store for the tshark protocol and field catalog.
+
+The output of ``tshark -G fields`` is saved in an SQLite database keyed
+by field name, so a process can look up the few fields it needs without
+loading the whole catalog.  The database records the identity of the
+tshark binary (path, size and modification time) it was built from and
+is rebuilt automatically when tshark is upgraded.
+"""
+
+import os
+import re
+import shutil
+import sqlite3
+import logging
+import threading
+import subprocess
+from urllib.request import pathname2url
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA_VERSION = '2'
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE protocols (name TEXT PRIMARY KEY, desc TEXT);
+CREATE TABLE fields (name TEXT PRIMARY KEY, desc TEXT, datatype TEXT,
+                     protocol TEXT);
+CREATE TABLE desc_tokens (token TEXT, field INTEGER);
+"""
+
+INDEXES = """
+CREATE INDEX fields_protocol ON fields (protocol);
+CREATE INDEX fields_desc ON fields (desc);
+CREATE INDEX desc_tokens_token ON desc_tokens (token);
+"""
+
+# Characters with a special meaning in a regular expression
+REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+REGEX_QUANTIFIERS = set('*+?{')
+
+
+def tshark_identity(env):
+    """Return a string identifying the installed tshark binary, or None if
+    it cannot be found.  Changes whenever tshark is upgraded."""
+    path = shutil.which('tshark', path=env.get('PATH'))
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return '%s:%d:%d' % (path, st.st_size, st.st_mtime_ns)
+
+
+def tshark_catalog(env, protocols=None):
+    """Run ``tshark -G fields`` and generate ``('P', name, desc)`` and
+    ``('F', name, desc, datatype, protocol)`` tuples."""
+    cmd = ['tshark', '-G', 'fields']
+
+    logger.info('subprocess: %s' % ' '.join(cmd))
+    proc = subprocess.Popen(cmd,
+                            stdout=subprocess.PIPE,
+                            env=env,
+                            universal_newlines=True)
+    try:
+        for line in proc.stdout:
+            line = line.rstrip()
+            if not line:
+                continue
+            fields = line.split('\t')
+            if fields[0] == 'P':
+                (t, desc, name) = fields[:3]
+                if protocols is not None and name not in protocols:
+                    continue
+                yield ('P', name, desc)
+            elif fields[0] == 'F':
+                (t, desc, name, datatype, protocol) = fields[:5]
+                if protocols is not None and protocol not in protocols:
+                    continue
+                yield ('F', name, desc, datatype, protocol)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+
+
+def tshark_version(env):
+    """Return the first line of ``tshark -v``."""
+    try:
+        out = subprocess.check_output(['tshark', '-v'], env=env,
+                                      universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.split('\n')[0]
+
+
+def regex_prefix(pattern):
+    """Return the literal text every match of ``pattern`` must start
+    with, if ``pattern`` is anchored with ``^``, otherwise ''."""
+    if not pattern.startswith('^') or '|' in pattern:
+        return ''
+    prefix = []
+    for c in pattern[1:]:
+        if c in REGEX_SPECIAL:
+            if c in REGEX_QUANTIFIERS and prefix:
+                # The preceding character is optional or repeated
+                prefix.pop()
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+
+def regex_literal(pattern):
+    """Return ``pattern`` if it contains no special characters, meaning
+    ``re.search`` is a plain substring test, otherwise None."""
+    if any(c in REGEX_SPECIAL for c in pattern):
+        return None
+    return pattern
+
+
+def required_tokens(literal):
+    """Words that any text containing ``literal`` must contain as whole
+    words: those with a non-word character on both sides inside
+    ``literal``."""
+    return [m.group() for m in re.finditer(r'\w+', literal)
+            if m.start() > 0 and m.end() < len(literal)]
+
+
+def prefix_range(column, prefix):
+    """SQL condition and arguments selecting ``column`` values starting
+    with ``prefix`` using the column index."""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return '%s >= ? AND %s < ?' % (column, column), [prefix, upper]
+
+
+class FieldCatalog(object):
+    """An SQLite database holding the tshark protocols and fields.
+
+    :param str filename: path of the database
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # sqlite connections must not be shared across a fork
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(
+                'file:%s?mode=ro' % pathname2url(self.filename), uri=True,
+                check_same_thread=False)
+            self._pid = os.getpid()
+        return self._conn
+
+    def execute(self, sql, args=()):
+        """Run a read-only query, returning all rows."""
+        with self._lock:
+            return self._connect().execute(sql, args).fetchall()
+
+    def meta(self, key):
+        rows = self.execute('SELECT value FROM meta WHERE key = ?', (key,))
+        return rows[0][0] if rows else None
+
+    def is_valid(self, identity):
+        """True if the database exists, has the current schema and was
+        built from the tshark binary described by ``identity``.  If
+        ``identity`` is None (tshark not installed) any complete database
+        is accepted."""
+        if not os.path.exists(self.filename):
+            return False
+        try:
+            if self.meta('schema') != SCHEMA_VERSION:
+                logger.info("Field catalog schema mismatch")
+                return False
+            if identity is not None and self.meta('tshark') != identity:
+                logger.info("Field catalog built for a different tshark")
+                return False
+            return self.meta('complete') == '1'
+        except sqlite3.Error as e:
+            logger.warning("Cannot read field catalog %s: %s"
+                           % (self.filename, e))
+            return False
+
+    def find_rows(self, name=None, name_re=None,
+                  desc=None, desc_re=None,
+                  protocol=None, protocol_re=None):
+        """Return the fields table rows that may match the given criteria,
+        in catalog order.
+
+        Exact values and the literal parts of the regular expressions
+        (anchored prefixes, plain substrings and the whole words they
+        contain) are turned into indexed SQL conditions.  The regular
+        expressions themselves must still be applied to the result.
+        """
+        where = []
+        args = []
+
+        for column, value in (('name', name), ('desc', desc),
+                              ('protocol', protocol)):
+            if value is not None:
+                where.append('%s = ?' % column)
+                args.append(value)
+
+        for column, pattern in (('name', name_re), ('desc', desc_re),
+                                ('protocol', protocol_re)):
+            if pattern is None:
+                continue
+            prefix = regex_prefix(pattern)
+            if prefix:
+                cond, cond_args = prefix_range(column, prefix)
+                where.append(cond)
+                args.extend(cond_args)
+                continue
+            literal = regex_literal(pattern)
+            if not literal:
+                continue
+            where.append('instr(%s, ?) > 0' % column)
+            args.append(literal)
+            if column == 'desc':
+                for token in required_tokens(literal):
+                    where.append('rowid IN (SELECT field FROM desc_tokens '
+                                 'WHERE token = ?)')
+                    args.append(token)
+
+        sql = 'SELECT * FROM fields'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY rowid'
+        return self.execute(sql, args)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @classmethod
+    def build(cls, filename, entries, identity=None, version=None):
+        """Create the database from ``entries`` as generated by
+        :py:func:`tshark_catalog`, replacing any existing one atomically.
+        """
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+        conn = sqlite3.connect(tmp)
+        try:
+            conn.executescript(SCHEMA)
+            protocols = []
+            fields = []
+            for entry in entries:
+                if entry[0] == 'P':
+                    protocols.append(entry[1:])
+                else:
+                    fields.append(entry[1:])
+            # Later duplicates replace earlier ones, keeping the position
+            # of the first, like assigning into a dict
+            conn.executemany(
+                'INSERT INTO protocols VALUES (?, ?) ON CONFLICT(name) '
+                'DO UPDATE SET desc = excluded.desc', protocols)
+            conn.executemany(
+                'INSERT INTO fields VALUES (?, ?, ?, ?) ON CONFLICT(name) '
+                'DO UPDATE SET desc = excluded.desc, '
+                'datatype = excluded.datatype, '
+                'protocol = excluded.protocol', fields)
+            conn.executemany(
+                'INSERT INTO desc_tokens VALUES (?, ?)',
+                ((token, rowid)
+                 for rowid, desc in conn.execute(
+                     'SELECT rowid, desc FROM fields')
+                 for token in set(re.findall(r'\w+', desc or ''))))
+            conn.executescript(INDEXES)
+            conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                             [('schema', SCHEMA_VERSION),
+                              ('tshark', identity),
+                              ('tshark_version', version),
+                              ('complete', '1')])
+            conn.commit()
+        finally:
+            conn.close()
+
+        os.replace(tmp, filename)
+        return cls(filename)
+
+
+class CatalogMapping(Mapping):
+    """Read-only dict-like view of one catalog table.
+
+    Values are created on first access and kept for later lookups, as
+    are names that are not in the table: the catalog does not change
+    while it is open, a rebuilt one gets a new mapping.
+
+    :param catalog: the FieldCatalog
+    :param str table: 'protocols' or 'fields'
+    :param factory: called with the table row to create a value
+    """
+
+    def __init__(self, catalog, table, factory):
+        self.catalog = catalog
+        self.table = table
+        self.factory = factory
+        self._cache = {}
+        self._missing = set()
+        self._complete = False
+        self._len = None
+
+    def __getitem__(self, name):
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        if self._complete or name in self._missing:
+            raise KeyError(name)
+        rows = self.catalog.execute(
+            'SELECT * FROM %s WHERE name = ?' % self.table, (name,))
+        if not rows:
+            self._missing.add(name)
+            raise KeyError(name)
+        value = self._cache[name] = self.factory(rows[0])
+        return value
+
+    def __contains__(self, name):
+        try:
+            self[name]
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        if self._len is None:
+            self._len = self.catalog.execute(
+                'SELECT count(*) FROM %s' % self.table)[0][0]
+        return self._len
+
+    def __iter__(self):
+        for (name,) in self.catalog.execute(
+                'SELECT name FROM %s ORDER BY rowid' % self.table):
+            yield name
+
+    def _load_all(self):
+        """Materialize every value, in catalog order."""
+        if not self._complete:
+            values = {}
+            for row in self.catalog.execute(
+                    'SELECT * FROM %s ORDER BY rowid' % self.table):
+                name = row[0]
+                value = self._cache.get(name)
+                values[name] = (value if value is not None
+                                else self.factory(row))
+            self._cache = values
+            self._complete = True
+        return self._cache
+
+    def get_row(self, row):
+        """Return the value for a table row, reusing a cached one."""
+        value = self._cache.get(row[0])
+        if value is None:
+            value = self._cache[row[0]] = self.factory(row)
+        return value
+
+    def values(self):
+        return self._load_all().values()
+
+    def items(self):
+        return self._load_all().items()
+
+    def keys(self):
+        return self._load_all().keys()
@@ -0,0 +1,187 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Incremental queries of a capture file that is still being written.
+
+A :py:class:`PcapFollower` remembers how far into the file it has read.
+Each :py:meth:`~PcapFollower.poll` feeds tshark only the complete
+records appended since the previous one, as a
+:py:class:`~steelscript.wireshark.core.pcapreader.CaptureChunk` with the
+file header prepended.
+"""
+
+import os
+import time
+import logging
+
+from steelscript.wireshark.core.pcapreader import (PcapReader, CaptureChunk,
+                                                   PCAP_HEADER_LEN)
+from steelscript.wireshark.core.pcap import (PcapFile, _lookup_fields,
+                                             _result, _splittable, _batched,
+                                             local_tz)
+
+logger = logging.getLogger(__name__)
+
+
+class PcapFollower(object):
+    """Follows a growing capture file, see :py:meth:`PcapFile.follow`."""
+
+    def __init__(self, pcapfile, fieldnames, filterexpr=None,
+                 use_tshark_fields=True,
+                 occurrence=PcapFile.OCCURRENCE_ALL,
+                 aggregator=',',
+                 as_dataframe=False,
+                 resolution=None, operations=None,
+                 timefield='frame.time_epoch', names=None):
+        self.pcapfile = pcapfile
+        self.fieldnames = list(fieldnames)
+        self.filterexpr = filterexpr
+        self.use_tshark_fields = use_tshark_fields
+        self.occurrence = occurrence
+        self.aggregator = aggregator
+        self.as_dataframe = as_dataframe
+
+        self.resolution = resolution
+        self.timefield = timefield
+        if resolution is not None:
+            if operations is None:
+                operations = ['sum'] * len(self.fieldnames)
+            if names is None:
+                names = self.fieldnames
+            if not (len(operations) == len(names) == len(self.fieldnames)):
+                raise ValueError('fieldnames, operations and names must '
+                                 'have the same length')
+            self.operations = list(operations)
+            self.names = list(names)
+            self._queried = [timefield]
+            for f in self.fieldnames:
+                if f not in self._queried:
+                    self._queried.append(f)
+        else:
+            self._queried = self.fieldnames
+
+        if not _splittable(self._queried, filterexpr):
+            logger.warning("Fields or filter depend on earlier packets, "
+                           "values may differ from a full query of %s"
+                           % pcapfile.filename)
+
+        self.reset()
+
+    def __repr__(self):
+        return '<PcapFollower %s offset %s packets %d>' % (
+            self.pcapfile.filename, self.offset, self.numpackets)
+
+    def reset(self):
+        """Forget what has been read, the next poll starts over from the
+        first packet."""
+        # Offset just past the last complete record read
+        self.offset = None
+        # Number of packets read
+        self.numpackets = 0
+        self._identity = None
+        self._section = None
+        self._agg = None
+        if self.resolution is not None:
+            from steelscript.wireshark.core.aggregate import BucketAggregator
+            self._agg = BucketAggregator(self.resolution, self.operations,
+                                         self.names)
+
+    def _pending(self):
+        """Return a CaptureChunk of the records appended since the last
+        poll and the number of packets in it, or ``(None, 0)``."""
+        filename = self.pcapfile.filename
+        st = os.stat(filename)
+        if self._identity is not None and (
+                st.st_ino != self._identity or
+                (self.offset is not None and st.st_size < self.offset)):
+            logger.info("%s was replaced or truncated, starting over"
+                        % filename)
+            self.reset()
+        self._identity = st.st_ino
+        if st.st_size < PCAP_HEADER_LEN:
+            # File header not written yet
+            return None, 0
+
+        with PcapReader(filename) as reader:
+            if self.offset is None:
+                self.offset = reader.data_start
+            if reader.size <= self.offset:
+                return None, 0
+
+            start = self.offset
+            header = reader.header(start, self._section)
+            count = 0
+            for _ in reader.records(start, section=self._section):
+                count += 1
+            end = reader.position
+            if reader.format == 'pcapng':
+                self._section = list(reader.section_blocks)
+
+        if end <= start:
+            return None, 0
+        return CaptureChunk(filename, header, start, end,
+                            self.numpackets), count
+
+    def poll(self):
+        """Query the packets appended since the last poll.
+
+        Returns the new rows, as a list or DataFrame like
+        :py:meth:`PcapFile.query`, or when following with a
+        ``resolution`` the aggregates of all packets read so far, as a
+        DataFrame like :py:meth:`PcapFile.aggregate`.  A record still
+        being written is left for the next poll.
+        """
+        chunk, count = self._pending()
+        rows = []
+        if chunk is not None:
+            logger.info("Reading %d new packets from %s" % (count, chunk))
+            if self._agg is not None:
+                self._aggregate(chunk)
+            else:
+                rows = list(self.pcapfile._iter_tshark(
+                    self.fieldnames, self.filterexpr, self.use_tshark_fields,
+                    self.occurrence, self.aggregator, source=chunk))
+            self.offset = chunk.end
+            self.numpackets += count
+
+        if self._agg is not None:
+            return self._agg.result(self.timefield, tz=local_tz)
+        return _result(rows, self.fieldnames, self.use_tshark_fields,
+                       self.as_dataframe, False)
+
+    def _aggregate(self, chunk):
+        from steelscript.wireshark.core import columnar
+
+        fields = _lookup_fields(self._queried, True)
+        rows = self.pcapfile._iter_tshark(self._queried, self.filterexpr,
+                                          False, PcapFile.OCCURRENCE_FIRST,
+                                          ',', source=chunk)
+        for batch in _batched(rows, columnar.BATCHSIZE):
+            df = columnar.rows_to_dataframe(fields, self._queried, batch)
+            self._agg.add(df[self.timefield],
+                          [df[f] for f in self.fieldnames])
+
+    def __iter__(self):
+        return self.follow()
+
+    def follow(self, interval=1.0, timeout=None):
+        """Poll every ``interval`` seconds, yielding each result that has
+        new packets.
+
+        :param float timeout: stop after this many seconds without new
+            packets, by default follow forever
+        """
+        idle_since = time.time()
+        while True:
+            before = self.numpackets
+            result = self.poll()
+            if self.numpackets != before:
+                idle_since = time.time()
+                yield result
+            elif timeout is not None and time.time() - idle_since >= timeout:
+                return
+            time.sleep(interval)
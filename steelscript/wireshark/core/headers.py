@@ -0,0 +1,298 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Vectorized decoding of link, network and transport headers.
+
+The first :py:data:`SNAP` bytes of each packet in a batch from
+:py:meth:`PcapReader.record_batches
+<steelscript.wireshark.core.pcapreader.PcapReader.record_batches>` are
+gathered into one numpy array and decoded with array operations, without
+a Python loop over the packets.  Ethernet (with up to two VLAN tags and
+802.3 LLC frames), Linux cooked captures and raw IP are understood, then
+IPv4 or IPv6, its hop-by-hop, routing and destination options headers,
+and the TCP, UDP or ICMP header that follows.
+
+Besides the header fields each batch has an ``exact`` mask: packets
+where the outer headers are everything tshark could report for those
+layers, so a field missing here is missing from tshark's dissection too.
+Frames that cannot carry IP, such as ARP or STP, are exact.  Fragments,
+tunnels, ICMP errors quoting another packet, unknown link types and
+truncated headers are not exact.
+"""
+
+import numpy
+
+from steelscript.wireshark.core.pcapreader import PcapReader, NO_TIMESTAMP
+
+# Bytes of each packet decoded: Ethernet, two VLAN tags, an IPv4 header
+# with options and the start of the transport header
+SNAP = 96
+
+# Records decoded at once, the gathered bytes take about SNAP * 9 bytes
+# per record while decoding
+BATCH = 1 << 14
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101)
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+# Ethertypes that never carry an IP packet: ARP, RARP, AppleTalk, AARP,
+# IPX, slow protocols, EAPOL, PROFINET, EtherCAT, GOOSE, LLDP, PTP,
+# FCoE, FIP and Ethernet loopback
+ETHERTYPE_NOT_IP = (0x0806, 0x8035, 0x809b, 0x80f3, 0x8137, 0x8809,
+                    0x888e, 0x8892, 0x88a4, 0x88b8, 0x88cc, 0x88f7,
+                    0x8906, 0x8914, 0x9000)
+
+# 802.3 LLC service access points of IP and of SNAP, whose protocol ID
+# is an ethertype
+LLC_SAP_IP = 0x06
+LLC_SAP_SNAP = 0xaa
+
+IPPROTO_ICMP = 1
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+IPPROTO_ICMPV6 = 58
+
+# IP protocols whose payload tshark does not dissect as another IP packet
+IPPROTO_EXACT = (1, 2, 6, 17, 50, 58, 59, 89, 103, 112, 132)
+
+# IPv6 hop-by-hop, routing and destination options headers, followed to
+# the transport header up to IPV6_EXTENSIONS_MAX deep
+IPV6_EXTENSIONS = (0, 43, 60)
+IPV6_EXTENSIONS_MAX = 3
+
+# ICMP types quoting the IP header of the packet they are about
+ICMP_ERRORS = (3, 4, 5, 11, 12)
+
+# UDP ports dissected as tunnels or carrying sampled packets: L2TP,
+# GTP-U, Teredo, LISP, GRE in UDP, VXLAN, VXLAN-GPE, CAPWAP, MPLS in UDP,
+# Geneve, sFlow, OTV and TZSP
+UDP_TUNNEL_PORTS = (1701, 2152, 3544, 4341, 4754, 4789, 4790, 5246, 5247,
+                    6635, 6081, 6343, 8472, 37008)
+
+# TCP ports carrying packets: OpenFlow
+TCP_TUNNEL_PORTS = (6633, 6653)
+
+# tshark dissects TCP and UDP payloads by the lower port first, and only
+# tries the higher port if nothing claims the lower one.  Ports below
+# this are assumed to be claimed, so a client port that happens to be a
+# tunnel port talking to such a server is not a tunnel
+WELL_KNOWN_PORTS = 1024
+
+
+class Headers(object):
+    """Decoded headers of one batch of packets.
+
+    Every attribute is a numpy array with one entry per packet, values
+    are 0 where the header is not present.
+
+    :ivar offset: file offset of each record
+    :ivar timestamp: nanoseconds since the epoch, or ``NO_TIMESTAMP``
+    :ivar caplen: captured bytes
+    :ivar origlen: original length on the wire (frame.len)
+    :ivar ip: mask of packets with an IPv4 header
+    :ivar ipv6: mask of packets with an IPv6 header
+    :ivar ip_src, ip_dst: IPv4 addresses as ``uint32``
+    :ivar ip_len, ip_proto, ip_ttl: IPv4 total length, protocol and TTL
+    :ivar tcp, udp, icmp: masks of packets with those headers
+    :ivar srcport, dstport: TCP or UDP ports
+    :ivar tcp_flags: the 12 TCP flag bits
+    :ivar udp_length: UDP length
+    :ivar icmp_type: ICMP or ICMPv6 type
+    :ivar exact: mask of packets whose dissection has no other
+        network or transport layers than decoded here
+    """
+
+    def __init__(self, batch):
+        self.offset = batch['offset']
+        self.timestamp = batch['timestamp']
+        self.caplen = batch['caplen']
+        self.origlen = batch['origlen']
+
+    def __len__(self):
+        return len(self.offset)
+
+    @property
+    def has_timestamp(self):
+        return self.timestamp != NO_TIMESTAMP
+
+
+def _gather(reader, batch):
+    """The first SNAP bytes of each packet, zero padded past caplen."""
+    n = len(batch['offset'])
+    columns = numpy.arange(SNAP)
+    idx = batch['data'][:, None] + columns
+    valid = columns < batch['caplen'][:, None]
+    numpy.minimum(idx, reader.size - 1, out=idx)
+
+    view = reader.view()
+    try:
+        data = view[idx]
+    finally:
+        del view
+    data[~valid] = 0
+    return data.reshape(n, SNAP)
+
+
+class _Bytes(object):
+    """Reads big endian values at per-packet offsets of gathered bytes."""
+
+    def __init__(self, data, caplen):
+        self.data = data
+        self.caplen = caplen
+        self.rows = numpy.arange(len(data))
+
+    def have(self, offset, size):
+        """Mask of packets with ``size`` bytes captured at ``offset``."""
+        return (offset + size <= self.caplen) & (offset + size <= SNAP)
+
+    def u8(self, offset):
+        offset = numpy.minimum(offset, SNAP - 1)
+        return self.data[self.rows, offset].astype(numpy.int64)
+
+    def u16(self, offset):
+        return (self.u8(offset) << 8) | self.u8(offset + 1)
+
+    def u32(self, offset):
+        return (self.u16(offset) << 16) | self.u16(offset + 2)
+
+
+def decode(reader, batch):
+    """Decode the headers of a batch from ``reader.record_batches()``,
+    returning :py:class:`Headers`."""
+    h = Headers(batch)
+    n = len(h)
+    zero = numpy.zeros(n, dtype=numpy.int64)
+    b = _Bytes(_gather(reader, batch), batch['caplen'])
+    linktype = batch['linktype']
+
+    # Link layer: find the ethertype and the offset of the network header
+    ethertype = zero.copy()
+    l3 = zero.copy()
+    known = numpy.zeros(n, dtype=bool)
+
+    eth = (linktype == LINKTYPE_ETHERNET) & b.have(zero, 14)
+    ethertype[eth] = b.u16(zero + 12)[eth]
+    l3[eth] = 14
+    for _ in range(2):
+        vlan = eth & numpy.isin(ethertype, ETHERTYPE_VLAN) & b.have(l3, 4)
+        ethertype[vlan] = b.u16(l3 + 2)[vlan]
+        l3[vlan] += 4
+    # An unparsed third tag or an 802.3 length field
+    known |= eth & ~numpy.isin(ethertype, ETHERTYPE_VLAN) & \
+        (ethertype > 1500)
+
+    # 802.3 frames carry IP only with the IP SAP or SNAP with an IP or
+    # VLAN protocol ID, others such as STP or CDP have no network layer
+    llc = eth & (ethertype <= 1500) & b.have(l3, 3)
+    dsap = b.u8(l3)
+    snap_ip = ((dsap == LLC_SAP_SNAP) &
+               ~(b.have(l3, 8) &
+                 ~numpy.isin(b.u16(l3 + 6), (ETHERTYPE_IPV4,
+                                             ETHERTYPE_IPV6) +
+                             ETHERTYPE_VLAN)))
+    llc_not_ip = llc & (dsap != LLC_SAP_IP) & ~snap_ip
+    known |= llc
+
+    sll = (linktype == LINKTYPE_LINUX_SLL) & b.have(zero, 16)
+    ethertype[sll] = b.u16(zero + 14)[sll]
+    l3[sll] = 16
+    sll2 = (linktype == LINKTYPE_LINUX_SLL2) & b.have(zero, 20)
+    ethertype[sll2] = b.u16(zero)[sll2]
+    l3[sll2] = 20
+    known |= sll | sll2
+
+    version = b.u8(zero) >> 4
+    raw = numpy.isin(linktype, LINKTYPE_RAW) & b.have(zero, 1)
+    ethertype[raw & (version == 4)] = ETHERTYPE_IPV4
+    ethertype[raw & (version == 6)] = ETHERTYPE_IPV6
+    ethertype[linktype == LINKTYPE_IPV4] = ETHERTYPE_IPV4
+    ethertype[linktype == LINKTYPE_IPV6] = ETHERTYPE_IPV6
+    known |= raw | numpy.isin(linktype, (LINKTYPE_IPV4, LINKTYPE_IPV6))
+
+    # Network layer
+    first = b.u8(l3)
+    ip = ((ethertype == ETHERTYPE_IPV4) & b.have(l3, 20) &
+          ((first >> 4) == 4))
+    ihl = (first & 0x0f) * 4
+    ip &= ihl >= 20
+    h.ip = ip
+    h.ip_len = numpy.where(ip, b.u16(l3 + 2), 0)
+    fragment = ip & ((b.u16(l3 + 6) & 0x3fff) != 0)
+    h.ip_ttl = numpy.where(ip, b.u8(l3 + 8), 0)
+    ip_proto = numpy.where(ip, b.u8(l3 + 9), 0)
+    h.ip_proto = ip_proto
+    h.ip_src = numpy.where(ip, b.u32(l3 + 12), 0).astype(numpy.uint32)
+    h.ip_dst = numpy.where(ip, b.u32(l3 + 16), 0).astype(numpy.uint32)
+
+    ipv6 = ((ethertype == ETHERTYPE_IPV6) & b.have(l3, 40) &
+            ((first >> 4) == 6))
+    h.ipv6 = ipv6
+
+    # Transport layer, only following headers that are not fragments.
+    # IPv6 fragment headers and unfollowed extension headers are left in
+    # proto, which makes the packet not exact
+    proto = numpy.where(ipv6, b.u8(l3 + 6), ip_proto)
+    l4 = numpy.where(ipv6, l3 + 40, l3 + ihl)
+    for _ in range(IPV6_EXTENSIONS_MAX):
+        ext = ipv6 & numpy.isin(proto, IPV6_EXTENSIONS) & b.have(l4, 2)
+        if not ext.any():
+            break
+        proto, l4 = (numpy.where(ext, b.u8(l4), proto),
+                     numpy.where(ext, l4 + (b.u8(l4 + 1) + 1) * 8, l4))
+    whole = (ip & ~fragment) | ipv6
+
+    h.tcp = whole & (proto == IPPROTO_TCP) & b.have(l4, 14)
+    h.udp = whole & (proto == IPPROTO_UDP) & b.have(l4, 8)
+    ports = h.tcp | h.udp
+    h.srcport = numpy.where(ports, b.u16(l4), 0)
+    h.dstport = numpy.where(ports, b.u16(l4 + 2), 0)
+    h.tcp_flags = numpy.where(h.tcp, ((b.u8(l4 + 12) & 0x0f) << 8) |
+                              b.u8(l4 + 13), 0)
+    h.udp_length = numpy.where(h.udp, b.u16(l4 + 4), 0)
+    h.icmp = whole & (((proto == IPPROTO_ICMP) & ip) |
+                      ((proto == IPPROTO_ICMPV6) & ipv6)) & b.have(l4, 1)
+    h.icmp_type = numpy.where(h.icmp, b.u8(l4), 0)
+
+    # Packets with nothing more below the decoded headers
+    low = numpy.minimum(h.srcport, h.dstport)
+    high = numpy.maximum(h.srcport, h.dstport)
+    tunnel = numpy.zeros(n, dtype=bool)
+    for mask, tunnel_ports in ((h.udp, UDP_TUNNEL_PORTS),
+                               (h.tcp, TCP_TUNNEL_PORTS)):
+        tunnel |= mask & (numpy.isin(low, tunnel_ports) |
+                          (numpy.isin(high, tunnel_ports) &
+                           (low >= WELL_KNOWN_PORTS)))
+    icmp_error = h.icmp & numpy.where(ipv6, h.icmp_type < 128,
+                                      numpy.isin(h.icmp_type, ICMP_ERRORS))
+    transport = (h.tcp | h.udp | h.icmp |
+                 (whole & ~numpy.isin(proto, (IPPROTO_TCP, IPPROTO_UDP,
+                                              IPPROTO_ICMP, IPPROTO_ICMPV6))))
+    h.exact = known & (
+        numpy.isin(ethertype, ETHERTYPE_NOT_IP) | llc_not_ip |
+        (whole & numpy.isin(proto, IPPROTO_EXACT) & transport &
+         ~tunnel & ~icmp_error))
+    return h
+
+
+def scan(filename, start=None, end=None, section=None, batchsize=BATCH):
+    """Generate the :py:class:`Headers` of the packets in bytes
+    ``[start, end)`` of ``filename``, ``batchsize`` packets at a time.
+
+    :param int section: pcapng section of ``start``, see
+        :py:meth:`PcapReader.records`
+    """
+    with PcapReader(filename) as reader:
+        for batch in reader.record_batches(start, end, section, batchsize):
+            yield decode(reader, batch)
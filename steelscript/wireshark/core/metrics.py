@@ -0,0 +1,274 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Timings and resource usage of :py:class:`PcapFile
+<steelscript.wireshark.core.pcap.PcapFile>` operations.
+
+:py:meth:`PcapFile.query`, :py:meth:`~PcapFile.aggregate`,
+:py:meth:`~PcapFile.export` and :py:meth:`~PcapFile.info` record a
+:py:class:`QueryStats` in ``pcapfile.last_stats`` and pass it to each
+callable in ``PcapFile.STATS_HOOKS``::
+
+    PcapFile.STATS_HOOKS.append(LoggingHook())
+    PcapFile.STATS_HOOKS.append(StatsdHook(statsd.StatsClient()))
+
+    df = pcap.query(['ip.src', 'ip.len'], as_dataframe=True)
+    print(pcap.last_stats.phases)
+    # {'tshark': 2.81, 'parse': 0.64, 'dataframe': 0.05}
+
+Phase times are exclusive: time spent waiting on tshark output is
+counted under 'tshark' and not under the 'parse' phase reading it.
+Process CPU and subprocess CPU are the ``getrusage`` differences over
+the operation, so they include other threads of the process and any
+subprocess they wait for meanwhile.  Peak RSS values are the high-water
+marks of this process and of its largest waited for subprocess so far.
+"""
+
+import sys
+import time
+import logging
+import contextlib
+import contextvars
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('steelscript_wireshark_stats',
+                                  default=None)
+
+
+class QueryStats(object):
+    """Timings, sizes and resource usage of one operation.
+
+    :ivar str operation: 'query', 'aggregate', 'export' or 'info'
+    :ivar str filename: the capture file
+    :ivar str backend: what answered a query: 'cache', 'native',
+        'ss_packets', 'sharkd', 'parallel' or 'tshark'
+    :ivar dict phases: seconds spent in each phase, in the order the
+        phases were first entered
+    :ivar int rows: rows returned
+    :ivar int bytes_read: capture bytes read or given to tshark
+    :ivar int output_bytes: characters of tshark output parsed
+    :ivar float wall: seconds for the whole operation
+    :ivar float cpu: user and system CPU seconds of this process
+    :ivar float child_cpu: user and system CPU seconds of the
+        subprocesses (tshark, editcap, capinfos, parallel workers)
+    :ivar int peak_rss_kb: peak RSS of this process in KiB
+    :ivar int peak_child_rss_kb: peak RSS of the largest subprocess in KiB
+    :ivar str error: the exception raised, if the operation failed
+    """
+
+    def __init__(self, operation, filename=None):
+        self.operation = operation
+        self.filename = filename
+        self.backend = None
+        self.phases = {}
+        self.rows = None
+        self.bytes_read = 0
+        self.output_bytes = 0
+        self.wall = None
+        self.cpu = None
+        self.child_cpu = None
+        self.peak_rss_kb = None
+        self.peak_child_rss_kb = None
+        self.error = None
+
+        # [start, seconds of nested phases] of each open phase
+        self._stack = []
+
+    def __repr__(self):
+        return '<QueryStats %s %s>' % (self.operation, self.filename)
+
+    def __str__(self):
+        msg = '%s of %s' % (self.operation, self.filename)
+        if self.backend:
+            msg += ' by %s' % self.backend
+        if self.rows is not None:
+            msg += ': %d rows' % self.rows
+        if self.wall is not None:
+            msg += ' in %.3fs' % self.wall
+        if self.phases:
+            msg += ' (%s)' % ', '.join('%s %.3fs' % (name, seconds)
+                                       for name, seconds
+                                       in self.phases.items())
+        if self.child_cpu:
+            msg += ', subprocess cpu %.3fs' % self.child_cpu
+        if self.error:
+            msg += ', failed: %s' % self.error
+        return msg
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager adding the time spent in the block to phase
+        ``name``, less the time of phases nested in it."""
+        entry = [time.perf_counter(), 0.0]
+        self._stack.append(entry)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - entry[0]
+            self._record(name, elapsed - entry[1], elapsed)
+
+    def add(self, name, seconds):
+        """Add ``seconds`` to phase ``name``, for time measured outside
+        a :py:meth:`phase` block."""
+        self._record(name, seconds, seconds)
+
+    def _record(self, name, own, elapsed):
+        self.phases[name] = self.phases.get(name, 0.0) + own
+        if self._stack:
+            self._stack[-1][1] += elapsed
+
+    def as_dict(self):
+        """Return the stats as a dict of plain values."""
+        return {'operation': self.operation,
+                'filename': self.filename,
+                'backend': self.backend,
+                'phases': dict(self.phases),
+                'rows': self.rows,
+                'bytes_read': self.bytes_read,
+                'output_bytes': self.output_bytes,
+                'wall': self.wall,
+                'cpu': self.cpu,
+                'child_cpu': self.child_cpu,
+                'peak_rss_kb': self.peak_rss_kb,
+                'peak_child_rss_kb': self.peak_child_rss_kb,
+                'error': self.error}
+
+
+def _usage():
+    if resource is None:
+        return None
+    return (resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+def _cpu(ru):
+    return ru.ru_utime + ru.ru_stime
+
+
+def _kb(maxrss):
+    # ru_maxrss is in bytes on macOS and KiB elsewhere
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+
+def current():
+    """Return the QueryStats of the operation running in this thread or
+    task, or None."""
+    return _current.get()
+
+
+def phase(name):
+    """:py:meth:`QueryStats.phase` of the current operation, doing
+    nothing if none is being tracked."""
+    stats = _current.get()
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.phase(name)
+
+
+def update(**kwargs):
+    """Set attributes of the current QueryStats, if any."""
+    stats = _current.get()
+    if stats is not None:
+        for k, v in kwargs.items():
+            setattr(stats, k, v)
+
+
+@contextlib.contextmanager
+def track(pcapfile, operation):
+    """Context manager recording a QueryStats for ``operation`` on
+    ``pcapfile``.  On exit the stats are saved in
+    ``pcapfile.last_stats`` and passed to ``pcapfile.STATS_HOOKS``."""
+    stats = QueryStats(operation, pcapfile.filename)
+    token = _current.set(stats)
+    before = _usage()
+    start = time.perf_counter()
+    try:
+        yield stats
+    except Exception as e:
+        stats.error = '%s: %s' % (e.__class__.__name__, e)
+        raise
+    finally:
+        stats.wall = time.perf_counter() - start
+        _current.reset(token)
+
+        after = _usage()
+        if after is not None:
+            stats.cpu = _cpu(after[0]) - _cpu(before[0])
+            stats.child_cpu = _cpu(after[1]) - _cpu(before[1])
+            stats.peak_rss_kb = _kb(after[0].ru_maxrss)
+            stats.peak_child_rss_kb = _kb(after[1].ru_maxrss)
+
+        pcapfile.last_stats = stats
+        emit(stats, pcapfile.STATS_HOOKS)
+
+
+def emit(stats, hooks):
+    """Call each of ``hooks`` with ``stats``.  Errors raised by a hook
+    are logged and do not affect the operation."""
+    for hook in hooks:
+        try:
+            hook(stats)
+        except Exception:
+            logger.exception("Stats hook %r failed" % hook)
+
+
+class LoggingHook(object):
+    """Stats hook logging one line per operation.
+
+    :param logger: logger to use, defaults to this module's
+    :param int level: logging level
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def __call__(self, stats):
+        self.logger.log(self.level, '%s', stats)
+
+
+class StatsdHook(object):
+    """Stats hook sending timers, counters and gauges to a StatsD-style
+    client, one with ``timing(name, ms)``, ``incr(name, count)`` and
+    ``gauge(name, value)`` methods such as ``statsd.StatsClient``.
+
+    Metric names are ``<prefix>.<operation>.wall``,
+    ``<prefix>.<operation>.phase.<phase>``, ``.rows``, ``.bytes_read``,
+    ``.child_cpu``, ``.peak_rss_kb`` and ``.errors``.
+
+    :param client: the StatsD client
+    :param str prefix: prefix of the metric names
+    """
+
+    def __init__(self, client, prefix='steelscript.wireshark'):
+        self.client = client
+        self.prefix = prefix
+
+    def __call__(self, stats):
+        name = '%s.%s' % (self.prefix, stats.operation)
+        client = self.client
+
+        client.timing(name + '.wall', stats.wall * 1000)
+        for phase, seconds in stats.phases.items():
+            client.timing('%s.phase.%s' % (name, phase), seconds * 1000)
+        if stats.child_cpu is not None:
+            client.timing(name + '.child_cpu', stats.child_cpu * 1000)
+        if stats.rows:
+            client.incr(name + '.rows', stats.rows)
+        if stats.bytes_read:
+            client.incr(name + '.bytes_read', stats.bytes_read)
+        if stats.peak_rss_kb is not None:
+            client.gauge(name + '.peak_rss_kb', stats.peak_rss_kb)
+        if stats.error:
+            client.incr(name + '.errors', 1)
@@ -0,0 +1,264 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Columnar Parquet store of dissected capture fields.
+
+:py:meth:`PcapFile.to_parquet
+<steelscript.wireshark.core.pcap.PcapFile.to_parquet>` runs tshark once
+and writes its output to a Parquet file, one row group at a time, with a
+column type per field taken from the field's ``TSharkField.datatype``:
+
+* integer fields are stored as int64 (uint64 for ``FT_UINT64``)
+* float and relative time fields as float64
+* ``frame.time_epoch`` as a nanosecond UTC timestamp, without rounding
+* absolute time fields as microsecond timestamps
+* everything else as strings
+
+Missing values are stored as nulls.  :py:func:`query_parquet` then
+answers column and time-range selections from the file, reading only
+the columns asked for and skipping row groups whose statistics rule out
+the time range or ``filters``.
+
+Requires the optional ``pyarrow`` package.
+"""
+
+import os
+import json
+import datetime
+import logging
+
+import numpy
+import pandas
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+from steelscript.wireshark.core import columnar
+
+logger = logging.getLogger(__name__)
+
+
+# Rows written per row group
+ROW_GROUP_SIZE = 100000
+
+# Schema metadata key describing how the file was made
+METADATA_KEY = b'steelscript.wireshark'
+
+TIMEFIELD = 'frame.time_epoch'
+
+
+def _require_pyarrow():
+    if not HAVE_PYARROW:
+        raise ImportError('pyarrow is required for Parquet support, '
+                          'install it with "pip install pyarrow"')
+
+
+def arrow_type(field):
+    """Return the Arrow type used to store a TSharkField."""
+    t = field.datatype
+    if field.name == TIMEFIELD:
+        return pyarrow.timestamp('ns', tz='UTC')
+    elif t == datetime.datetime:
+        return pyarrow.timestamp('us', tz='UTC')
+    elif t == int:
+        if field.datatype_str.startswith('FT_UINT64'):
+            return pyarrow.uint64()
+        return pyarrow.int64()
+    elif t == float:
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+def schema(fields, metadata=None):
+    """Return the Arrow schema for a list of TSharkFields."""
+    return pyarrow.schema([pyarrow.field(f.name, arrow_type(f))
+                           for f in fields], metadata=metadata)
+
+
+def _epoch_ns(values, mask):
+    """Parse ``seconds.fraction`` strings to integer nanoseconds."""
+    result = numpy.zeros(len(values), dtype=numpy.int64)
+    for i, v in enumerate(values):
+        if mask[i]:
+            continue
+        sec, _, frac = v.partition('.')
+        result[i] = int(sec) * 1000000000 + int((frac + '000000000')[:9])
+    return result
+
+
+def _arrow_column(field, values):
+    """Convert an object array of tshark strings to an Arrow array."""
+    mask = numpy.asarray(columnar._null_mask(values), dtype=bool)
+    atype = arrow_type(field)
+
+    if field.name == TIMEFIELD:
+        data = _epoch_ns(values, mask)
+    elif field.datatype == int:
+        data = numpy.zeros(len(values), dtype=object)
+        valid = values[~mask]
+        data[~mask] = list(columnar._integers(valid,
+                                              numpy.zeros(len(valid),
+                                                          dtype=bool)))
+        data[mask] = 0
+    elif field.datatype == datetime.datetime:
+        data = numpy.asarray(columnar._absolute_time(values, mask),
+                             dtype=object)
+        data[mask] = None
+    elif field.datatype == float:
+        data = columnar._floats(values, mask)
+    else:
+        data = values
+    return pyarrow.array(data, type=atype, mask=mask)
+
+
+def rows_to_table(fields, rows, tableschema):
+    """Convert a list of rows of tshark strings into an Arrow table."""
+    arrays = []
+    for i, field in enumerate(fields):
+        values = numpy.empty(len(rows), dtype=object)
+        values[:] = [row[i] for row in rows]
+        arrays.append(_arrow_column(field, values))
+    return pyarrow.Table.from_arrays(arrays, schema=tableschema)
+
+
+def write_parquet(pcapfile, path, fieldnames, filterexpr=None,
+                  starttime=None, endtime=None, duration=None,
+                  occurrence='a', aggregator=',',
+                  row_group_size=ROW_GROUP_SIZE, compression='snappy'):
+    """Stream the output of one tshark run into a Parquet file, see
+    :py:meth:`PcapFile.to_parquet
+    <steelscript.wireshark.core.pcap.PcapFile.to_parquet>`."""
+    _require_pyarrow()
+    from steelscript.wireshark.core.pcap import _lookup_fields
+
+    fields = _lookup_fields(fieldnames, True)
+    st = os.stat(pcapfile.filename)
+    info = {'filename': os.path.abspath(pcapfile.filename),
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'fieldnames': list(fieldnames),
+            'filterexpr': filterexpr,
+            'occurrence': occurrence}
+    tableschema = schema(fields, {METADATA_KEY: json.dumps(info)})
+
+    rows = pcapfile.iter_query(fieldnames, filterexpr=filterexpr,
+                               starttime=starttime, endtime=endtime,
+                               duration=duration,
+                               use_tshark_fields=False,
+                               occurrence=occurrence, aggregator=aggregator,
+                               batchsize=row_group_size)
+
+    # Written next to the destination and renamed once complete
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    numrows = 0
+    try:
+        with pyarrow.parquet.ParquetWriter(tmp, tableschema,
+                                           compression=compression) as w:
+            for batch in rows:
+                w.write_table(rows_to_table(fields, batch, tableschema),
+                              row_group_size=row_group_size)
+                numrows += len(batch)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    logger.info("Wrote %d rows of %s to %s"
+                % (numrows, pcapfile.filename, path))
+    return path
+
+
+def parquet_info(path):
+    """Return the dict describing how a Parquet file was written by
+    :py:func:`write_parquet`, or None if it was not."""
+    _require_pyarrow()
+    metadata = pyarrow.parquet.read_schema(path).metadata or {}
+    if METADATA_KEY not in metadata:
+        return None
+    return json.loads(metadata[METADATA_KEY])
+
+
+def _timestamp(t):
+    from steelscript.wireshark.core.pcap import _to_ns
+    return pyarrow.scalar(_to_ns(t), type=pyarrow.timestamp('ns', tz='UTC'))
+
+
+def query_parquet(path, fieldnames=None, filters=None,
+                  starttime=None, endtime=None, duration=None,
+                  as_dataframe=True):
+    """Read fields of a Parquet file written by
+    :py:meth:`PcapFile.to_parquet
+    <steelscript.wireshark.core.pcap.PcapFile.to_parquet>`.
+
+    Only the columns in ``fieldnames`` are read, and row groups are
+    skipped when their min/max statistics show that no row can match the
+    time range or ``filters``.
+
+    :param str path: Parquet file
+    :param list fieldnames: columns to return, defaults to all
+    :param filters: row filter in pyarrow's format, such as
+        ``[('ip.proto', '==', 6), ('tcp.dstport', 'in', [80, 443])]``
+    :param starttime: only return rows with ``frame.time_epoch`` at or
+        after this time
+    :param endtime: only return rows before this time
+    :param duration: see :py:meth:`PcapFile.query
+        <steelscript.wireshark.core.pcap.PcapFile.query>`
+    :param bool as_dataframe: return a DataFrame with time columns in
+        local time, rather than a list of rows
+
+    Returns None for a DataFrame with no rows, like
+    :py:meth:`PcapFile.query
+    <steelscript.wireshark.core.pcap.PcapFile.query>`.
+    """
+    _require_pyarrow()
+    import pyarrow.dataset
+    from steelscript.wireshark.core.pcap import _resolve_timerange
+
+    dataset = pyarrow.dataset.dataset(path, format='parquet')
+    if fieldnames is None:
+        fieldnames = dataset.schema.names
+
+    expr = None
+    if filters:
+        expr = pyarrow.parquet.filters_to_expression(filters)
+
+    starttime, endtime = _resolve_timerange(starttime, endtime, duration)
+    if starttime is not None or endtime is not None:
+        if TIMEFIELD not in dataset.schema.names:
+            raise ValueError('%s has no %s column, cannot select a time '
+                             'range' % (path, TIMEFIELD))
+        column = pyarrow.dataset.field(TIMEFIELD)
+        for t, op in ((starttime, '__ge__'), (endtime, '__lt__')):
+            if t is not None:
+                cond = getattr(column, op)(_timestamp(t))
+                expr = cond if expr is None else expr & cond
+
+    table = dataset.to_table(columns=list(fieldnames), filter=expr)
+    logger.info("Read %d rows from %s" % (table.num_rows, path))
+
+    if not as_dataframe:
+        columns = []
+        for name in fieldnames:
+            values = table.column(name).to_pylist()
+            if pyarrow.types.is_timestamp(table.schema.field(name).type):
+                values = [v if v is None else v.astimezone(columnar.local_tz)
+                          for v in values]
+            columns.append(values)
+        return [list(row) for row in zip(*columns)]
+
+    if table.num_rows == 0:
+        return None
+    df = table.to_pandas()
+    for name in df.columns:
+        if isinstance(df[name].dtype, pandas.DatetimeTZDtype):
+            df[name] = df[name].dt.tz_convert(columnar.local_tz)
+    return df
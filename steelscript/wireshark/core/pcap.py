@@ -7,18 +7,35 @@
 import os
 import re
 import sys
-import pickle
+import time
+import itertools
+import asyncio
 import logging
+import weakref
+import threading
+import concurrent.futures
 import subprocess
 import datetime
-import tempfile
 import pytz
 import tzlocal
 
 from dateutil.parser import parse as dateutil_parse
 
 from steelscript.common.timeutils import parse_timedelta
-from steelscript.wireshark.core.exceptions import InvalidField
+from steelscript.wireshark.core.exceptions import (InvalidField,
+                                                   CaptureFormatError,
+                                                   DisplayFilterError,
+                                                   SharkdError)
+from steelscript.wireshark.core.pcapreader import (PcapReader, CaptureChunk,
+                                                   RecordSelection,
+                                                   pcap_summary)
+from steelscript.wireshark.core.pcapindex import PcapIndex
+from steelscript.wireshark.core import metrics
+from steelscript.wireshark.core.fieldcatalog import (FieldCatalog,
+                                                    CatalogMapping,
+                                                    tshark_catalog,
+                                                    tshark_identity,
+                                                    tshark_version)
 
 ## Try to load method from SteelScript Packets module
 try:
@@ -50,6 +67,36 @@ class PcapFile(object):
     OCCURRENCE_LAST = 'l'
     OCCURRENCE_ALL = 'a'
 
+    # QueryCache used by query(), caching is disabled if None
+    QUERY_CACHE = None
+
+    # Number of chunks per worker for parallel queries
+    CHUNKS_PER_WORKER = 2
+
+    # SharkdPool answering query() from long-lived sharkd sessions,
+    # disabled if None
+    SHARKD_POOL = None
+
+    # Maximum number of tshark/capinfos processes started by aquery() and
+    # ainfo() running at once on each event loop, read when the loop first
+    # uses them
+    ASYNC_LIMIT = 16
+
+    # Separates multiple occurrences in multi_query() tshark output
+    MULTI_AGGREGATOR = '\x1f'
+
+    # Callables passed the QueryStats of each query(), aggregate(),
+    # export() and info(), see steelscript.wireshark.core.metrics
+    STATS_HOOKS = []
+
+    # Leave packets a filter certainly rejects out of what tshark reads,
+    # see steelscript.wireshark.core.prefilter
+    PREFILTER = True
+
+    # Answer queries of common frame, IP and transport fields by decoding
+    # the headers without tshark, see steelscript.wireshark.core.decode
+    NATIVE_DECODE = True
+
     def __init__(self, filename):
         self.filename = filename
 
@@ -58,15 +105,36 @@ class PcapFile(object):
         self.endtime = None
         self.numpackets = None
 
+        # QueryStats of the last query(), aggregate(), export() or info()
+        self.last_stats = None
+
     def info(self):
-        """Returns info on pcap file, uses ``capinfos -A -m -T`` or
-        steelscript's pcap library internally depending on environment."""
+        """Returns info on pcap file.  Classic pcap and pcapng files are
+        read natively by walking the record headers; other formats fall
+        back to ``capinfos -A -m -T`` or steelscript's pcap library
+        depending on environment."""
+        if self._info is None:
+            with metrics.track(self, 'info'):
+                self._load_info()
+
+        return self._info
+
+    def _load_info(self):
+        try:
+            with metrics.phase('read'):
+                self._native_info()
+            metrics.update(backend='native')
+        except CaptureFormatError as e:
+            logger.debug("PcapFile.info() native reader failed: %s" % e)
+
         if self._info is None:
             if PcapFile.HAVE_STEELSCRIPT_PACKETS:
                 logger.debug("PcapFile.info() run using steelscript pcap library.")
-                
+                metrics.update(backend='ss_packets')
+
                 # pcap_info is expecting a filename
-                pfile_info = pcap_info(self.filename)
+                with metrics.phase('ss_packets'):
+                    pfile_info = pcap_info(self.filename)
 
                 self._info = {'Start time': pfile_info['first_timestamp'],
                               'End time': pfile_info['last_timestamp'],
@@ -87,27 +155,88 @@ class PcapFile(object):
                 logger.debug(
                     "PcapFile.info() run using Wireshark capinfos subprocess "
                     "call.")
+                metrics.update(backend='capinfos')
                 cmd = ['capinfos', '-A', '-m', '-T', self.filename]
                 logger.info('subprocess: %s' % ' '.join(cmd))
-                capinfos = subprocess.check_output(cmd,
-                                                   env=popen_env,
-                                                   universal_newlines=True)
-                hdrs, vals = (capinfos.split('\n')[:2])
-                self._info = dict(zip(hdrs.split(','), vals.split(',')))
-
-                self.starttime = (dateutil_parse(self._info['Start time'])
-                                  .replace(tzinfo=local_tz))
-                self.endtime = (dateutil_parse(self._info['End time'])
-                                .replace(tzinfo=local_tz))
-
-                self.numpackets = int(self._info['Number of packets'])
-
-        return self._info
+                with metrics.phase('capinfos'):
+                    capinfos = subprocess.check_output(
+                        cmd, env=popen_env, universal_newlines=True)
+                self._capinfos(capinfos)
+
+    def _capinfos(self, capinfos):
+        """Fill in info from the output of ``capinfos -A -m -T``."""
+        hdrs, vals = (capinfos.split('\n')[:2])
+        self._info = dict(zip(hdrs.split(','), vals.split(',')))
+
+        self.starttime = (dateutil_parse(self._info['Start time'])
+                          .replace(tzinfo=local_tz))
+        self.endtime = (dateutil_parse(self._info['End time'])
+                        .replace(tzinfo=local_tz))
+
+        self.numpackets = int(self._info['Number of packets'])
+
+    async def ainfo(self):
+        """Asynchronous :py:meth:`info`.  The record headers are read
+        in the default executor and ``capinfos`` is run as an asyncio
+        subprocess, counting towards ``ASYNC_LIMIT``."""
+        if self._info is None:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self._native_info)
+            except CaptureFormatError as e:
+                logger.debug("PcapFile.ainfo() native reader failed: %s" % e)
+
+        if self._info is None and not PcapFile.HAVE_STEELSCRIPT_PACKETS:
+            cmd = ['capinfos', '-A', '-m', '-T', self.filename]
+            async with _async_semaphore():
+                logger.info('subprocess: %s' % ' '.join(cmd))
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd, stdout=subprocess.PIPE, env=popen_env)
+                out, _ = await proc.communicate()
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+            self._capinfos(out.decode())
+
+        return self.info()
+
+    def _native_info(self):
+        """Fill in info from the pcap/pcapng record headers."""
+        logger.debug("PcapFile.info() run using native pcap reader.")
+        summary = pcap_summary(self.filename)
+
+        if summary['starttime'] is None:
+            # Left to capinfos, which reports an empty capture
+            raise CaptureFormatError('No packets in %s' % self.filename)
+
+        self._info = {'File name': self.filename,
+                      'File type': summary['format'],
+                      'File encapsulation': ','.join(
+                          str(t) for t in summary['linktypes']),
+                      'File time precision': ('nanoseconds'
+                                              if summary['nanosecond']
+                                              else 'microseconds'),
+                      'Packet size limit': summary['snaplen'],
+                      'Number of packets': summary['numpackets'],
+                      'File size (bytes)': summary['size'],
+                      'Data size (bytes)': summary['caplen'],
+                      'Capture duration (seconds)': (
+                          (summary['endtime'] - summary['starttime']) / 1e9),
+                      'Start time': summary['starttime'] / 1e9,
+                      'End time': summary['endtime'] / 1e9,
+                      'Strict time order': summary['in_order'],
+                      'Number of interfaces in file': summary['interfaces']}
+
+        self.starttime = _ns_to_datetime(summary['starttime'])
+        self.endtime = _ns_to_datetime(summary['endtime'])
+        self.numpackets = summary['numpackets']
 
     def export(self, filename,
                starttime=None, endtime=None, duration=None):
         """Returns a PCAP file, potentially including your specified starttime,
-        endtime or duration. Internally uses editcap
+        endtime or duration. Internally copies the packets located through
+        the :py:meth:`index`, building it in memory if there is no saved
+        one, or uses editcap for captures that cannot be indexed or are
+        not in time order
 
         :param str filename: the name of the new PCAP file to be
             created/exported from the existing PCAP file
@@ -116,45 +245,69 @@ class PcapFile(object):
         :param str duration: defines a duration filter
 
         """
+        with metrics.track(self, 'export'):
+            return self._export(filename, starttime, endtime, duration)
 
+    def _export(self, filename, starttime, endtime, duration):
         cmd = ['editcap']
 
-        if starttime is not None:
-            if isinstance(starttime, str):
-                starttime = dateutil_parse(starttime)
-
-        if endtime is not None:
-            if isinstance(endtime, str):
-                endtime = dateutil_parse(endtime)
-
-        if duration is not None:
-            if isinstance(duration, str):
-                duration = parse_timedelta(duration)
-
-            if starttime:
-                endtime = starttime + duration
-            elif endtime:
-                starttime = endtime - duration
-            else:
-                raise ValueError("Must specify either starttime or "
-                                 "endtime with duration")
+        starttime, endtime = _resolve_timerange(starttime, endtime, duration)
+
+        # Without a sidecar the index is built in memory, not saved, so
+        # the result does not depend on whether an earlier call left one
+        # behind and exporting writes nothing next to the capture
+        with metrics.phase('index'):
+            index = self.index(build=False)
+            if index is None:
+                try:
+                    index = PcapIndex.build(self.filename)
+                except CaptureFormatError as e:
+                    logger.debug("Cannot index %s: %s" % (self.filename, e))
+        if index is not None and index.ordered:
+            # Copy just the packets in range, located through the index
+            chunk = index.chunk(_to_ns(starttime), _to_ns(endtime))
+            logger.info("Exporting %s using pcap index" % chunk)
+            metrics.update(backend='index', bytes_read=chunk.size)
+            with metrics.phase('export'):
+                chunk.write(filename)
+            return PcapFile(filename)
 
         if starttime is not None:
-            cmd.extend(['-A', (starttime
-                               .strftime('%Y-%m-%d %H:%M:%S'))])
+            cmd.extend(['-A', _editcap_time(starttime)])
 
         if endtime is not None:
-            cmd.extend(['-B', (endtime
-                               .strftime('%Y-%m-%d %H:%M:%S'))])
+            cmd.extend(['-B', _editcap_time(endtime)])
 
         cmd.append(self.filename)
         cmd.append(filename)
 
+        metrics.update(backend='editcap',
+                       bytes_read=os.path.getsize(self.filename))
         logger.info('subprocess: %s' % ' '.join(cmd))
-        subprocess.check_output(cmd, env=popen_env, universal_newlines=True)
+        with metrics.phase('export'):
+            subprocess.check_output(cmd, env=popen_env,
+                                    universal_newlines=True)
 
         return PcapFile(filename)
 
+    def index(self, every=None, build=True):
+        """Returns the :py:class:`PcapIndex` of packet offsets and
+        timestamps for this file, loading it from its sidecar file if it
+        is up to date.
+
+        :param int every: record every Nth packet when building the index,
+            defaults to ``PcapIndex.DEFAULT_EVERY``
+        :param bool build: if the index does not exist or is stale,
+            build and save it.  Otherwise return None.
+        """
+        if every is None:
+            every = PcapIndex.DEFAULT_EVERY
+        try:
+            return PcapIndex.get(self.filename, every=every, build=build)
+        except CaptureFormatError as e:
+            logger.debug("Cannot index %s: %s" % (self.filename, e))
+            return None
+
     def delete(self):
         """Removes the filename from PcapFile object and deletes the file"""
         if os.path.exists(self.filename):
@@ -168,11 +321,22 @@ class PcapFile(object):
               occurrence=OCCURRENCE_ALL,
               aggregator=',',
               as_dataframe=False,
-              use_ss_packets=True):
+              use_ss_packets=True,
+              columnar=False,
+              use_cache=True,
+              workers=1,
+              byterange=None,
+              compact=False,
+              explode=None):
         """Parses the PCAP file, returning the data in a tabular format.
         NOTE: When using OCCURRENCE_ALL you can generate an exception if there
         are multiple fields that have multiple values.
 
+        Queries of only the frame, IP and transport fields listed in
+        :py:data:`steelscript.wireshark.core.decode.FIELDS` are decoded
+        without tshark when possible, see :py:meth:`explain` for the
+        backend chosen.
+
         :param list fieldnames: a list of field names for the desired values.
             Use the aggregator string for seperating columns
         :param str filterexpr: the filter expression used by tshark for
@@ -196,180 +360,1486 @@ class PcapFile(object):
             to false.
         :param bool use_ss_packets: if allows the use of steelscript.packets
             pcap_query. Forces use of tshark if false.
+        :param bool columnar: with ``as_dataframe`` and
+            ``use_tshark_fields``, convert values a column at a time
+            using numpy/pandas rather than cell by cell.  The resulting
+            values are the same.
+        :param bool use_cache: look up and store the result in
+            ``PcapFile.QUERY_CACHE`` if one is configured
+        :param int workers: number of tshark processes to run in parallel.
+            The capture is split into packet-aligned chunks (building the
+            packet index if needed) and results are merged in packet
+            order, with ``frame.number`` relative to the whole file.
+            Queries using fields that depend on earlier packets (streams,
+            TCP analysis, relative times, request/response links) run in a
+            single process.  PDUs reassembled across a chunk boundary are
+            not reported.
+        :param tuple byterange: ``(start, end, first_packet)`` to only
+            query the packets in that part of the file, see
+            :py:meth:`chunk`
+        :param bool compact: with ``as_dataframe`` and
+            ``use_tshark_fields``, build the DataFrame column by column
+            with compact dtypes: nullable integers sized from the field
+            type, float64, datetime64 and categoricals for strings with
+            many repeated values.  Missing integers are ``pandas.NA``
+            rather than NaN.
+        :param str explode: with OCCURRENCE_ALL, how packets with several
+            values in more than one field are expanded, instead of being
+            skipped:
+
+                - 'zip' - the n-th values of each field form the n-th row,
+                  padding shorter fields with missing values
+                - 'product' - one row per combination of values
+                - 'list' - one row per packet holding a list of values
+                  per field (``columnar`` and ``compact`` do not apply)
+
+            See :py:mod:`steelscript.wireshark.core.explode`.
+        """
+        if not self.filename:
+            raise ValueError('No filename')
+
+        params = dict(fieldnames=tuple(fieldnames), filterexpr=filterexpr,
+                      starttime=starttime, endtime=endtime,
+                      duration=duration,
+                      use_tshark_fields=use_tshark_fields,
+                      occurrence=occurrence, aggregator=aggregator,
+                      as_dataframe=as_dataframe,
+                      use_ss_packets=use_ss_packets, columnar=columnar,
+                      byterange=byterange, compact=compact,
+                      explode=explode)
+
+        params['workers'] = workers
+
+        with metrics.track(self, 'query') as stats:
+            cache = PcapFile.QUERY_CACHE if use_cache else None
+            if cache is None:
+                result = self._query(**params)
+            else:
+                from steelscript.wireshark.core.planner import cache_key
+                key = cache_key(cache, self.filename, params)
+                with stats.phase('cache'):
+                    found, result = cache.get(key)
+                if found:
+                    stats.backend = 'cache'
+                else:
+                    result = self._query(**params)
+                    with stats.phase('cache'):
+                        cache.put(key, result)
+
+            stats.rows = len(result) if result is not None else 0
+        return result
+
+    def explain(self, fieldnames, filterexpr=None,
+                starttime=None, endtime=None, duration=None,
+                use_tshark_fields=True,
+                occurrence=OCCURRENCE_ALL,
+                aggregator=',',
+                as_dataframe=False,
+                use_ss_packets=True,
+                columnar=False,
+                use_cache=True,
+                workers=1,
+                byterange=None,
+                compact=False,
+                explode=None):
+        """Returns the :py:class:`~steelscript.wireshark.core.planner.
+        QueryPlan` that :py:meth:`query` would run with the same
+        arguments, without running it::
+
+            >>> print(pcap.explain(['ip.src', 'http.host'], 'tcp'))
+            Query plan for trace.pcap: tshark, estimated 2.310s
+              1. tshark     fields: ip.src, http.host; filter: tcp; ...
+
+        The plan lists the backends used, the fields and filter given to
+        each, how the time range is applied and the estimated cost.  A
+        'native' plan is tentative: whether every packet can be decoded
+        exactly is only known while reading it, so its fallback plan is
+        listed too.
         """
+        from steelscript.wireshark.core.planner import plan_query
+
         if not self.filename:
             raise ValueError('No filename')
 
+        params = dict(fieldnames=tuple(fieldnames), filterexpr=filterexpr,
+                      starttime=starttime, endtime=endtime,
+                      duration=duration,
+                      use_tshark_fields=use_tshark_fields,
+                      occurrence=occurrence, aggregator=aggregator,
+                      as_dataframe=as_dataframe,
+                      use_ss_packets=use_ss_packets, columnar=columnar,
+                      byterange=byterange, compact=compact,
+                      explode=explode, workers=workers)
+        cache = PcapFile.QUERY_CACHE if use_cache else None
+        return plan_query(self, params, cache=cache)
+
+    async def aquery(self, fieldnames, filterexpr=None,
+                     starttime=None, endtime=None, duration=None,
+                     use_tshark_fields=True,
+                     occurrence=OCCURRENCE_ALL,
+                     aggregator=',',
+                     as_dataframe=False,
+                     columnar=False,
+                     use_cache=True,
+                     byterange=None,
+                     compact=False,
+                     explode=None):
+        """Asynchronous :py:meth:`query` using an asyncio subprocess, so
+        one event loop can run many queries at once::
+
+            results = await asyncio.gather(
+                *[PcapFile(f).aquery(['ip.src']) for f in files])
+
+        At most ``PcapFile.ASYNC_LIMIT`` tshark processes run at the same
+        time, further queries wait for one to finish.  Output is read and
+        parsed a batch of lines at a time as it arrives.  Arguments have
+        the same meaning as for :py:meth:`query`.  Field lookups, cache
+        access and reading the packet index run in the default executor.
         """
-        Test if we can use the pcap lib query. This is true if we only have
-        supported fields and, optionally, a start and end time. All other
-        arguments must be default and we can't have a filterexpr.
+        from steelscript.wireshark.core.planner import cache_key
+
+        if not self.filename:
+            raise ValueError('No filename')
+
+        loop = asyncio.get_running_loop()
+        cache = PcapFile.QUERY_CACHE if use_cache else None
+        if cache is not None:
+            # Only tshark is run, so the result is shared with query()
+            # whenever steelscript.packets could not answer it either
+            params = dict(fieldnames=tuple(fieldnames),
+                          filterexpr=filterexpr, starttime=starttime,
+                          endtime=endtime, duration=duration,
+                          use_tshark_fields=use_tshark_fields,
+                          occurrence=occurrence, aggregator=aggregator,
+                          as_dataframe=as_dataframe, use_ss_packets=False,
+                          columnar=columnar, byterange=byterange,
+                          compact=compact, explode=explode)
+            key = cache_key(cache, self.filename, params)
+            found, result = await loop.run_in_executor(None, cache.get, key)
+            if found:
+                return result
+
+        columnar = as_dataframe and (columnar or compact) and \
+            use_tshark_fields and explode != 'list'
+        convert = use_tshark_fields and not columnar
+
+        def prepare():
+            return (_lookup_fields(fieldnames, convert),
+                    self._source(filterexpr, starttime, endtime, duration,
+                                 byterange))
+
+        fields, (source, filterexpr) = await loop.run_in_executor(None,
+                                                                  prepare)
+        cmd = self._tshark_cmd(fieldnames, filterexpr, occurrence,
+                               aggregator, source)
+
+        rows = []
+        async for lines in _atshark_lines(cmd, source):
+            rows.extend(_parse_lines(lines, fields, fieldnames, occurrence,
+                                     aggregator, cmd, explode))
+
+        if (source is not None and source.first_packet and
+                'frame.number' in fieldnames):
+            rows = _renumber(rows, fieldnames.index('frame.number'),
+                             source.first_packet, convert)
+
+        result = _result(rows, fieldnames, use_tshark_fields, as_dataframe,
+                         columnar, compact)
+        if cache is not None:
+            await loop.run_in_executor(None, cache.put, key, result)
+        return result
+
+    def multi_query(self, queries, starttime=None, endtime=None,
+                    duration=None, byterange=None):
+        """Runs several queries over the same packets with a single
+        tshark dissection.
+
+        tshark is run once with the union of the fields and the OR of the
+        filters, and each query's filter is then evaluated on the shared
+        per-packet output (see :py:mod:`dfilter
+        <steelscript.wireshark.core.dfilter>`).  Queries whose filter
+        uses syntax the evaluator does not support run separately.
+
+        :param list queries: each a dict of :py:meth:`query` arguments
+            (``fieldnames``, ``filterexpr``, ``use_tshark_fields``,
+            ``occurrence``, ``aggregator``, ``as_dataframe``,
+            ``columnar``), or a ``(fieldnames, filterexpr)`` tuple
+
+        Other arguments apply to all queries and have the same meaning as
+        for :py:meth:`query`.  Returns a list with the result of each
+        query, in order, as :py:meth:`query` would return it.
         """
-        pq = None
-
-        # Use steelscript-packets if available and requested
-        if PcapFile.HAVE_STEELSCRIPT_PACKETS and use_ss_packets:
-            pq = PcapQuery(filename=self.filename,wshark_fields=fieldnames)
-            if pq.fields_supported(fieldnames) and filterexpr in [None, ''] and duration is None and occurrence == self.OCCURRENCE_ALL and aggregator == ',':
-                stime = 0.0
-                etime = 0.0
-                rdf = 1 if as_dataframe else 0
-                if starttime is not None:
-                    if isinstance(starttime, str):
-                        stime = dateutil_parse(starttime)
-                if endtime is not None:
-                    if isinstance(endtime, str):
-                        etime = dateutil_parse(endtime)
-
-                logger.debug("PcapFile.query() run using PcapQuery.pcap_query().")
-                return pq.query(starttime=stime, endtime=etime, num_packets=0, dataframe=rdf)
+        from steelscript.wireshark.core import dfilter
+
+        specs = [_query_spec(q) for q in queries]
+        results = [None] * len(specs)
+
+        shared = []
+        catalog = TSharkFields.instance()
+        for i, spec in enumerate(specs):
+            node = None
+            if spec['filterexpr'] not in [None, '']:
+                try:
+                    node = dfilter.parse(spec['filterexpr'], catalog)
+                except DisplayFilterError as e:
+                    logger.info("Running query %d on its own: %s" % (i, e))
+                    continue
+            shared.append((i, spec, node))
+
+        if len(shared) < 2:
+            shared = []
+        done = set(i for i, _, _ in shared)
+
+        for i, spec in enumerate(specs):
+            if i not in done:
+                results[i] = self.query(starttime=starttime,
+                                        endtime=endtime, duration=duration,
+                                        byterange=byterange, **spec)
+
+        if not shared:
+            return results
+
+        fieldnames = []
+        for _, spec, node in shared:
+            needed = list(spec['fieldnames'])
+            if node is not None:
+                needed.extend(sorted(node.fields()))
+            for n in needed:
+                if n not in fieldnames:
+                    fieldnames.append(n)
+
+        filters = [spec['filterexpr'] for _, spec, _ in shared]
+        if any(f in [None, ''] for f in filters):
+            filterexpr = None
+        else:
+            filterexpr = ' || '.join('(%s)' % f for f in filters)
+
+        source, filterexpr = self._source(filterexpr, starttime, endtime,
+                                          duration, byterange)
+        agg = self.MULTI_AGGREGATOR
+        cmd = self._tshark_cmd(fieldnames, filterexpr, self.OCCURRENCE_ALL,
+                               agg, source)
+        logger.info("Running %d queries in one pass" % len(shared))
+
+        columns = [[fieldnames.index(n) for n in spec['fieldnames']]
+                   for _, spec, _ in shared]
+        lines = [[] for _ in shared]
+        for line in _tshark_lines(cmd, source):
+            values = line.split('\t')
+            if len(values) < len(fieldnames):
+                # Trailing empty fields are stripped
+                values.extend([''] * (len(fieldnames) - len(values)))
+            elif len(values) > len(fieldnames):
+                logger.error("Could not parse line: '%s'" % line)
+                continue
+            packet = dfilter.packet_values(fieldnames, values, agg)
+            for k, (_, spec, node) in enumerate(shared):
+                if node is None or node.evaluate(packet):
+                    lines[k].append('\t'.join(
+                        _occurrences(packet[fieldnames[c]], spec)
+                        for c in columns[k]))
+
+        for k, (i, spec, _) in enumerate(shared):
+            names = spec['fieldnames']
+            columnar = (spec['as_dataframe'] and spec['use_tshark_fields']
+                        and (spec['columnar'] or spec['compact'])
+                        and spec['explode'] != 'list')
+            convert = spec['use_tshark_fields'] and not columnar
+            rows = _parse_lines(lines[k], _lookup_fields(names, convert),
+                                names, spec['occurrence'],
+                                spec['aggregator'], cmd, spec['explode'])
+            if (source is not None and source.first_packet and
+                    'frame.number' in names):
+                rows = _renumber(rows, names.index('frame.number'),
+                                 source.first_packet, convert)
+            results[i] = _result(rows, names, spec['use_tshark_fields'],
+                                 spec['as_dataframe'], columnar,
+                                 spec['compact'])
+            lines[k] = None
+        return results
+
+    def _query(self, fieldnames, filterexpr, starttime, endtime, duration,
+               use_tshark_fields, occurrence, aggregator, as_dataframe,
+               use_ss_packets, columnar, byterange, workers, compact,
+               explode):
+        """Run the query with the backends chosen by
+        :py:func:`~steelscript.wireshark.core.planner.plan_query`."""
+        from steelscript.wireshark.core.planner import plan_query
+
+        params = dict(
+            fieldnames=fieldnames, filterexpr=filterexpr,
+            starttime=starttime, endtime=endtime, duration=duration,
+            use_tshark_fields=use_tshark_fields, occurrence=occurrence,
+            aggregator=aggregator, as_dataframe=as_dataframe,
+            use_ss_packets=use_ss_packets, columnar=columnar,
+            byterange=byterange, workers=workers, compact=compact,
+            explode=explode)
+        plan = plan_query(self, params)
+        logger.debug(plan.explain())
+
+        if plan.method == 'native':
+            decoded = self._native_decode(fieldnames, filterexpr, starttime,
+                                          endtime, duration, byterange)
+            if decoded is not None:
+                from steelscript.wireshark.core.decode import to_result
+
+                metrics.update(backend='native')
+                fields = _lookup_fields(fieldnames, True)
+                with metrics.phase('convert'):
+                    return to_result(decoded[0], decoded[1], fields,
+                                     as_dataframe, columnar, compact)
+
+            logger.info("Cannot decode %s natively, running the fallback "
+                        "plan" % self.filename)
+            plan = plan.fallback
+            logger.debug(plan.explain())
+
+        if plan.method == 'ss_packets':
+            logger.debug("PcapFile.query() run using PcapQuery.pcap_query().")
+            metrics.update(backend='ss_packets')
+            return self._ss_query(plan.steps[0], len(fieldnames),
+                                  starttime, endtime, duration, as_dataframe)
+
+        if plan.method == 'hybrid':
+            metrics.update(backend='hybrid')
+            rows = self._hybrid_rows(plan, fieldnames, filterexpr,
+                                     starttime, endtime, duration,
+                                     occurrence, aggregator)
+            return _result(rows, fieldnames, use_tshark_fields, as_dataframe,
+                           False)
 
         # Continue with native tshark query instead
-        cmd = ['tshark', '-r', self.filename,
+        columnar = as_dataframe and (columnar or compact) and \
+            use_tshark_fields and explode != 'list'
+        convert = use_tshark_fields and not columnar
+
+        rows = None
+        if plan.method == 'sharkd':
+            rows = self._sharkd_rows(fieldnames, filterexpr,
+                                     starttime, endtime, duration,
+                                     convert, occurrence, explode)
+
+        if plan.method == 'parallel':
+            rows = self._parallel_rows(fieldnames, filterexpr,
+                                       starttime, endtime, duration,
+                                       convert, occurrence, aggregator,
+                                       workers, explode)
+
+        if rows is None:
+            metrics.update(backend='tshark')
+            rows = self.iter_query(fieldnames, filterexpr=filterexpr,
+                                   starttime=starttime, endtime=endtime,
+                                   duration=duration,
+                                   use_tshark_fields=convert,
+                                   occurrence=occurrence,
+                                   aggregator=aggregator,
+                                   byterange=byterange,
+                                   explode=explode)
+
+        return _result(rows, fieldnames, use_tshark_fields, as_dataframe,
+                       columnar, compact)
+
+    def _native_decode(self, fieldnames, filterexpr, starttime, endtime,
+                       duration, byterange):
+        """Decode the fields of a query from the packet headers, returning
+        ``(values, present)`` structured arrays or None if tshark has to
+        answer it, see :py:func:`~steelscript.wireshark.core.decode.decode`.
+        """
+        from steelscript.wireshark.core.decode import decode
+
+        # The index chunk narrows what is read, times are still compared
+        # exactly as the chunk is only aligned to the index entries
+        source, _ = self._source(None, starttime, endtime, duration,
+                                 byterange)
+        start_ns = end_ns = None
+        if starttime or endtime:
+            start_ns, end_ns = [_to_ns(t) for t in _resolve_timerange(
+                starttime, endtime, duration)]
+
+        kwargs = {}
+        if source is not None:
+            index = self.index(build=False)
+            kwargs = dict(start=source.start, end=source.end,
+                          section=(index.section_at(source.start)
+                                   if index is not None else None),
+                          first_packet=source.first_packet)
+
+        metrics.update(bytes_read=(source.size if source is not None
+                                   else os.path.getsize(self.filename)))
+        try:
+            with metrics.phase('decode'):
+                return decode(self.filename, fieldnames, filterexpr,
+                              start_ns=start_ns, end_ns=end_ns, **kwargs)
+        except CaptureFormatError as e:
+            logger.debug("Cannot decode %s: %s" % (self.filename, e))
+            return None
+
+    def _ss_rows(self, fieldnames, starttime, endtime, duration,
+                 as_dataframe=False):
+        """Query steelscript.packets, which takes the time range as
+        seconds since the epoch, 0 meaning no limit."""
+        starttime, endtime = _resolve_timerange(starttime, endtime, duration)
+        stime = _to_epoch(starttime) if starttime is not None else 0.0
+        etime = _to_epoch(endtime) if endtime is not None else 0.0
+
+        pq = PcapQuery(filename=self.filename, wshark_fields=fieldnames)
+        with metrics.phase('ss_packets'):
+            return pq.query(starttime=stime, endtime=etime, num_packets=0,
+                            dataframe=1 if as_dataframe else 0)
+
+    def _ss_query(self, step, ncols, starttime, endtime, duration,
+                  as_dataframe):
+        """Answer a query from steelscript.packets alone, evaluating the
+        filter, if any, on its output."""
+        if step.predicate is None:
+            return self._ss_rows(step.fieldnames, starttime, endtime,
+                                 duration, as_dataframe)
+
+        from steelscript.wireshark.core.planner import filter_rows
+
+        rows = self._ss_rows(step.fieldnames, starttime, endtime, duration)
+        rows = filter_rows(rows, step.fieldnames, step.predicate, ncols)
+        return _result(rows, step.fieldnames[:ncols], True, as_dataframe,
+                       False)
+
+    def _hybrid_rows(self, plan, fieldnames, filterexpr, starttime, endtime,
+                     duration, occurrence, aggregator):
+        """Run the steelscript.packets and tshark steps of a hybrid plan
+        and join their rows on frame.number."""
+        from steelscript.wireshark.core.planner import (join_rows,
+                                                        convert_rows)
+
+        ss_step, tshark_step = plan.steps[:2]
+        ss_rows = convert_rows(self._ss_rows(ss_step.fieldnames, starttime,
+                                             endtime, duration),
+                               _lookup_fields(ss_step.fieldnames, True))
+
+        rows = None
+        if tshark_step.workers > 1:
+            rows = self._parallel_rows(tshark_step.fieldnames, filterexpr,
+                                       starttime, endtime, duration,
+                                       True, occurrence, aggregator,
+                                       tshark_step.workers)
+        if rows is None:
+            rows = self.iter_query(tshark_step.fieldnames,
+                                   filterexpr=filterexpr,
+                                   starttime=starttime, endtime=endtime,
+                                   duration=duration,
+                                   occurrence=occurrence,
+                                   aggregator=aggregator)
+
+        yield from join_rows(ss_rows, ss_step.fieldnames, rows,
+                             tshark_step.fieldnames, fieldnames)
+
+    def _sharkd_rows(self, fieldnames, filterexpr, starttime, endtime,
+                     duration, use_tshark_fields, occurrence, explode=None):
+        """Query through the sharkd session for this file, returning the
+        rows or None if sharkd is not available or fails."""
+        fields = _lookup_fields(fieldnames, use_tshark_fields)
+
+        if starttime or endtime:
+            timefilter = _timerange_filter(
+                *_resolve_timerange(starttime, endtime, duration))
+            if filterexpr in [None, '']:
+                filterexpr = timefilter
+            else:
+                filterexpr = '(%s) && (%s)' % (timefilter, filterexpr)
+
+        try:
+            with metrics.phase('sharkd'):
+                session = PcapFile.SHARKD_POOL.session(self.filename)
+                lines = ['\t'.join(values) for values in
+                         session.frames(fieldnames, filterexpr, occurrence)]
+        except SharkdError as e:
+            logger.warning("sharkd query failed, running tshark: %s" % e)
+            return None
+
+        logger.debug("PcapFile.query() answered by %s" % session)
+        metrics.update(backend='sharkd')
+        return list(_parse_lines(lines, fields, fieldnames, occurrence,
+                                 ',', ['sharkd', self.filename], explode))
+
+    def iter_query(self, fieldnames, filterexpr=None,
+                   starttime=None, endtime=None, duration=None,
+                   use_tshark_fields=True,
+                   occurrence=OCCURRENCE_ALL,
+                   aggregator=',',
+                   batchsize=None,
+                   byterange=None,
+                   explode=None):
+        """Parses the PCAP file with tshark, yielding rows as they are
+        produced instead of collecting them all in memory.
+
+        Arguments have the same meaning as for :py:meth:`query`.  The
+        tshark subprocess is terminated if the generator is closed before
+        all rows have been consumed.
+
+        :param int batchsize: if set, yield lists of up to ``batchsize``
+            rows rather than one row at a time
+        :param tuple byterange: ``(start, end, first_packet)`` to only
+            read the packets in that part of the file, see :py:meth:`chunk`
+        """
+        source, filterexpr = self._source(filterexpr, starttime, endtime,
+                                          duration, byterange)
+        source = self._prefilter(fieldnames, filterexpr, source)
+
+        rows = self._iter_tshark(fieldnames, filterexpr, use_tshark_fields,
+                                 occurrence, aggregator, source, explode)
+        if batchsize:
+            rows = _batched(rows, batchsize)
+
+        yield from rows
+
+    def _source(self, filterexpr, starttime, endtime, duration, byterange):
+        """Return the CaptureChunk to feed tshark instead of the whole
+        file, or None, and ``filterexpr`` with any time range filter
+        that could not be applied by reading a chunk."""
+        if not self.filename:
+            raise ValueError('No filename')
+
+        source = None
+        if byterange is not None:
+            source = self.chunk(*byterange)
+
+        if starttime or endtime:
+            starttime, endtime = _resolve_timerange(starttime, endtime,
+                                                    duration)
+            with metrics.phase('index'):
+                index = self.index(build=False)
+            if source is None and index is not None and index.ordered:
+                # Only feed tshark the packets in the time range
+                source = index.chunk(_to_ns(starttime), _to_ns(endtime))
+                logger.info("Reading timerange from %s" % source)
+            else:
+                # Filter on packet time in the same tshark pass rather
+                # than exporting the time range to a temporary file first
+                timefilter = _timerange_filter(starttime, endtime)
+                logger.info("Filtering on timerange: %s" % timefilter)
+                if filterexpr in [None, '']:
+                    filterexpr = timefilter
+                else:
+                    filterexpr = '(%s) && (%s)' % (timefilter, filterexpr)
+
+        return source, filterexpr
+
+    def _prefilter(self, fieldnames, filterexpr, source):
+        """Return a RecordSelection of the packets in ``source`` (or the
+        file) that ``filterexpr`` may match, or ``source`` if the filter
+        cannot reject enough packets from their headers."""
+        if (not self.PREFILTER or filterexpr in [None, ''] or
+                not _splittable(fieldnames, filterexpr)):
+            return source
+
+        from steelscript.wireshark.core import prefilter
+
+        try:
+            with metrics.phase('prefilter'):
+                selection = prefilter.select(self, source, fieldnames,
+                                             filterexpr)
+        except CaptureFormatError as e:
+            logger.debug("Cannot prefilter %s: %s" % (self.filename, e))
+            return source
+        return selection if selection is not None else source
+
+    def aggregate(self, fieldnames, resolution, operations=None,
+                  timefield='frame.time_epoch', names=None,
+                  filterexpr=None,
+                  starttime=None, endtime=None, duration=None,
+                  occurrence=OCCURRENCE_ALL,
+                  byterange=None, batchsize=None):
+        """Query fields and aggregate them into time buckets while tshark
+        output streams in.
+
+        Memory use is proportional to the number of buckets rather than
+        the number of packets.  Returns a DataFrame with the start of each
+        bucket in column ``timefield`` followed by one column per field, or
+        None if no packets match.  Buckets are aligned in UTC and shown in
+        the local timezone, see :py:mod:`~steelscript.wireshark.core.aggregate`.
+
+        :param list fieldnames: list of tshark field names to aggregate,
+            the same field may be listed more than once with different
+            operations
+        :param resolution: bucket size, a timedelta or string such as
+            '1min'
+        :param list operations: one of 'sum', 'min', 'max', 'count' or
+            'mean' per field, defaults to 'sum'.  Any other pandas groupby
+            reduction such as 'median' is also accepted, but then all rows
+            are kept until tshark finishes.
+        :param str timefield: field holding the packet time
+        :param list names: column names for the result, defaults to
+            ``fieldnames``
+        :param str occurrence: as for :py:meth:`query`.  With
+            OCCURRENCE_ALL every value of a multi-valued field is
+            aggregated, as in the rows :py:meth:`query` returns.
+
+        Other arguments have the same meaning as for :py:meth:`query`.
+        """
+        from steelscript.wireshark.core import aggregate, columnar
+
+        if operations is None:
+            operations = ['sum'] * len(fieldnames)
+        if names is None:
+            names = fieldnames
+        if not (len(operations) == len(names) == len(fieldnames)):
+            raise ValueError('fieldnames, operations and names must have '
+                             'the same length')
+
+        # Each field is only queried once
+        queried = [timefield]
+        for f in fieldnames:
+            if f not in queried:
+                queried.append(f)
+        fields = _lookup_fields(queried, True)
+
+        # Operations that cannot be combined from partial results are
+        # computed once all rows are read.  Check them all before tshark
+        # runs rather than failing part way through.
+        for op in operations:
+            aggregate.check_operation(op)
+        streamed = all(op in aggregate.STREAMED for op in operations)
+        if streamed:
+            agg = aggregate.BucketAggregator(resolution, operations, names)
+        else:
+            aggregate.check_resolution(resolution)
+            frames = []
+
+        with metrics.track(self, 'aggregate') as stats:
+            stats.backend = 'tshark'
+            rows = self.iter_query(queried, filterexpr=filterexpr,
+                                   starttime=starttime, endtime=endtime,
+                                   duration=duration,
+                                   use_tshark_fields=False,
+                                   occurrence=occurrence,
+                                   batchsize=batchsize or columnar.BATCHSIZE,
+                                   byterange=byterange)
+            with stats.phase('parse'):
+                for batch in rows:
+                    with stats.phase('convert'):
+                        df = columnar.rows_to_dataframe(fields, queried,
+                                                        batch)
+                    with stats.phase('aggregate'):
+                        if streamed:
+                            agg.add(df[timefield],
+                                    [df[f] for f in fieldnames])
+                        else:
+                            frames.append(df)
+
+            if streamed:
+                result = agg.result(timefield, tz=local_tz)
+            else:
+                with stats.phase('aggregate'):
+                    result = aggregate.aggregate_frames(
+                        frames, timefield, fieldnames, resolution, operations,
+                        names, tz=local_tz)
+            logger.info("Aggregated into %d buckets" %
+                        (len(result) if result is not None else 0))
+            stats.rows = len(result) if result is not None else 0
+        return result
+
+    def to_parquet(self, path, fieldnames, filterexpr=None,
+                   starttime=None, endtime=None, duration=None,
+                   occurrence=OCCURRENCE_ALL, aggregator=',',
+                   row_group_size=None, compression='snappy'):
+        """Dissect the file once and save the fields to a Parquet file
+        for repeated analysis with
+        :py:func:`~steelscript.wireshark.core.parquet.query_parquet`.
+
+        tshark output is converted and written ``row_group_size`` rows at
+        a time, with one typed column per field.  Requires ``pyarrow``.
+
+        :param str path: Parquet file to write
+        :param int row_group_size: rows per Parquet row group, smaller
+            groups let time-range queries skip more of the file
+        :param str compression: Parquet compression codec
+
+        Other arguments have the same meaning as for :py:meth:`query`.
+        Returns ``path``.
+        """
+        from steelscript.wireshark.core import parquet
+
+        return parquet.write_parquet(
+            self, path, fieldnames, filterexpr=filterexpr,
+            starttime=starttime, endtime=endtime, duration=duration,
+            occurrence=occurrence, aggregator=aggregator,
+            row_group_size=row_group_size or parquet.ROW_GROUP_SIZE,
+            compression=compression)
+
+    def follow(self, fieldnames, filterexpr=None,
+               use_tshark_fields=True,
+               occurrence=OCCURRENCE_ALL,
+               aggregator=',',
+               as_dataframe=False,
+               resolution=None, operations=None,
+               timefield='frame.time_epoch', names=None):
+        """Returns a
+        :py:class:`~steelscript.wireshark.core.follow.PcapFollower` that
+        queries only the packets appended to the file since its previous
+        poll::
+
+            follower = pcap.follow(['frame.time_epoch', 'ip.len'], 'tcp')
+            rows = follower.poll()        # packets so far
+            rows = follower.poll()        # packets written since
+            for rows in follower.follow(interval=5):
+                ...
+
+        The byte offset and number of packets read are remembered, so
+        ``frame.number`` counts from the start of the file.  Fields that
+        depend on earlier packets, such as ``tcp.stream`` or TCP
+        analysis, only see the packets of each poll.
+
+        :param resolution: if set, aggregate into time buckets as
+            :py:meth:`aggregate` does and return the updated aggregates
+            of all packets read so far on each poll
+        :param list operations: see :py:meth:`aggregate`
+        :param str timefield: see :py:meth:`aggregate`
+        :param list names: see :py:meth:`aggregate`
+
+        Other arguments have the same meaning as for :py:meth:`query`.
+        """
+        from steelscript.wireshark.core.follow import PcapFollower
+
+        return PcapFollower(self, fieldnames, filterexpr=filterexpr,
+                            use_tshark_fields=use_tshark_fields,
+                            occurrence=occurrence, aggregator=aggregator,
+                            as_dataframe=as_dataframe,
+                            resolution=resolution, operations=operations,
+                            timefield=timefield, names=names)
+
+    def conversations(self, proto='tcp', filterexpr=None,
+                      starttime=None, endtime=None, duration=None,
+                      byterange=None):
+        """Returns a DataFrame of the conversations of ``proto`` (for
+        example 'eth', 'ip', 'tcp' or 'udp') computed by tshark's
+        ``-z conv`` statistics.
+
+        Columns are ``address_a``, ``port_a``, ``address_b``, ``port_b``
+        (ports only for port based protocols), frame and byte counts for
+        each direction (``tx_*`` from A to B, ``rx_*`` from B to A) and in
+        total, and ``rel_start`` and ``duration`` in seconds.  Byte counts
+        tshark prints with a unit (``kB``) are rounded by tshark.
+
+        Other arguments have the same meaning as for :py:meth:`query`.
+        """
+        from steelscript.wireshark.core.tsharkstats import parse_conversations
+
+        source, filterexpr = self._source(filterexpr, starttime, endtime,
+                                          duration, byterange)
+        lines = self._tshark_stat(_tap('conv,%s' % proto, filterexpr),
+                                  source)
+        return parse_conversations(lines, proto)
+
+    def endpoints(self, proto='ip', filterexpr=None,
+                  starttime=None, endtime=None, duration=None,
+                  byterange=None):
+        """Returns a DataFrame of the endpoints of ``proto`` computed by
+        tshark's ``-z endpoints`` statistics, with columns ``address``,
+        ``port`` (port based protocols only), ``packets``, ``bytes`` and
+        the transmitted and received ``tx_*``/``rx_*`` counts.
+
+        Other arguments have the same meaning as for :py:meth:`query`.
+        """
+        from steelscript.wireshark.core.tsharkstats import parse_endpoints
+
+        source, filterexpr = self._source(filterexpr, starttime, endtime,
+                                          duration, byterange)
+        lines = self._tshark_stat(_tap('endpoints,%s' % proto, filterexpr),
+                                  source)
+        return parse_endpoints(lines, proto)
+
+    def io_stat(self, interval, exprs=None, filterexpr=None,
+                starttime=None, endtime=None, duration=None,
+                byterange=None):
+        """Returns a DataFrame of tshark's ``-z io,stat`` statistics.
+
+        Each row is one interval, with its ``time`` (a datetime), ``start``
+        and ``end`` in seconds since the first packet, then one column per
+        expression.  Without expressions the columns are ``frames`` and
+        ``bytes``.
+
+        :param interval: interval length, seconds or a timedelta
+        :param list exprs: io,stat expressions such as
+            ``'SUM(frame.len)frame.len'`` or display filters
+        :param str filterexpr: display filter applied to every expression
+
+        Other arguments have the same meaning as for :py:meth:`query`.
+        """
+        from steelscript.wireshark.core.tsharkstats import parse_io_stat
+        import pandas
+
+        if isinstance(interval, datetime.timedelta):
+            interval = interval.total_seconds()
+
+        # io,stat has no overall filter, it is added to each expression
+        source, filterexpr = self._source(filterexpr, starttime, endtime,
+                                          duration, byterange)
+        if exprs:
+            run_exprs = [_io_expr(e, filterexpr) for e in exprs]
+        elif filterexpr not in [None, '']:
+            run_exprs = [filterexpr]
+        else:
+            run_exprs = []
+
+        stat = ','.join(['io,stat,%g' % interval] +
+                        ['"%s"' % e for e in run_exprs])
+        df = parse_io_stat(self._tshark_stat(stat, source), exprs)
+        if df is None:
+            return None
+
+        first = self._first_time(source)
+        if first is not None:
+            df.insert(0, 'time', pandas.Timestamp(first) +
+                      pandas.to_timedelta(df['start'], unit='s'))
+        return df
+
+    def _tshark_stat(self, stat, source):
+        """Run ``tshark -q -z <stat>`` over the file or ``source`` and
+        return the output lines."""
+        cmd = ['tshark', '-r', '-' if source else self.filename,
+               '-n', '-q', '-z', stat]
+        return list(_tshark_lines(cmd, source))
+
+    def _first_time(self, source):
+        """Time of the first packet in ``source``, or of the file."""
+        if source is None:
+            self.info()
+            return self.starttime
+
+        index = self.index(build=False)
+        section = (index.section_at(source.start)
+                   if index is not None else None)
+        with PcapReader(self.filename) as reader:
+            for record in reader.records(source.start, source.end,
+                                         section=section):
+                if record.timestamp is not None:
+                    return _ns_to_datetime(record.timestamp)
+        return None
+
+    def _iter_tshark(self, fieldnames, filterexpr, use_tshark_fields,
+                     occurrence, aggregator, source=None, explode=None):
+        """Run tshark over the file, or over ``source`` (a CaptureChunk)
+        streamed to its stdin, and generate the parsed rows."""
+        if source is not None and source.empty:
+            return iter([])
+
+        fields = _lookup_fields(fieldnames, use_tshark_fields)
+        cmd = self._tshark_cmd(fieldnames, filterexpr, occurrence,
+                               aggregator, source)
+
+        stats = metrics.current()
+        if stats is not None:
+            stats.bytes_read += (source.size if source is not None
+                                 else os.path.getsize(self.filename))
+
+        rows = _parse_lines(_tshark_lines(cmd, source), fields, fieldnames,
+                            occurrence, aggregator, cmd, explode)
+
+        if source is not None and 'frame.number' in fieldnames:
+            i = fieldnames.index('frame.number')
+            if isinstance(source, RecordSelection):
+                rows = _renumber_selected(rows, i, source.numbers,
+                                          use_tshark_fields)
+            elif source.first_packet:
+                rows = _renumber(rows, i, source.first_packet,
+                                 use_tshark_fields)
+        return rows
+
+    def _tshark_cmd(self, fieldnames, filterexpr, occurrence, aggregator,
+                    source=None):
+        cmd = ['tshark', '-r', '-' if source else self.filename,
                '-T', 'fields',
                '-E', 'occurrence=%s' % occurrence]
 
         if occurrence == self.OCCURRENCE_ALL:
             cmd.extend(['-E', 'aggregator=%s' % aggregator])
 
-        if starttime or endtime:
-            logger.info("Creating temp pcap file for timerange: %s-%s" %
-                        (starttime, endtime))
-            (fd, filename) = tempfile.mkstemp(suffix='.pcap')
-            os.close(fd)
-            p = self.export(filename,
-                            starttime=starttime,
-                            endtime=endtime,
-                            duration=duration)
-            logger.info("Issuing query on temp pcap file")
-            res = p.query(fieldnames, filterexpr=filterexpr,
-                          use_tshark_fields=use_tshark_fields,
-                          occurrence=occurrence,
-                          as_dataframe=as_dataframe)
-            p.delete()
-            return res
-
         if filterexpr not in [None, '']:
             # use new '-Y' option since '-R' is deprecated
             cmd.extend(['-Y', filterexpr])
 
-        fields = []
         for n in fieldnames:
+            cmd.extend(['-e', n])
+        return cmd
+
+    def chunk(self, start, end, first_packet=None):
+        """Returns a :py:class:`CaptureChunk` reading the packets stored
+        in bytes ``[start, end)`` of this file as a standalone capture.
+        ``start`` and ``end`` must be on packet boundaries, for instance
+        from :py:meth:`PcapIndex.chunks`.
+
+        :param int first_packet: 0-based number of the first packet in the
+            range, used to renumber ``frame.number``
+        """
+        index = self.index(build=False)
+        section = index.section_at(start) if index is not None else None
+        with PcapReader(self.filename) as reader:
+            header = reader.header(start, section)
+        return CaptureChunk(self.filename, header, start, end, first_packet)
+
+    def _parallel_rows(self, fieldnames, filterexpr, starttime, endtime,
+                       duration, use_tshark_fields, occurrence, aggregator,
+                       workers, explode=None):
+        """Split the capture into packet-aligned chunks, query each one
+        in a separate process and return all rows in packet order."""
+        with metrics.phase('index'):
+            index = self.index(build=True)
+        if index is None:
+            logger.info("Cannot split %s, running a single query"
+                        % self.filename)
+            return None
+
+        start_ns = end_ns = None
+        if starttime or endtime:
+            starttime, endtime = _resolve_timerange(starttime, endtime,
+                                                    duration)
+            if index.ordered:
+                start_ns, end_ns = _to_ns(starttime), _to_ns(endtime)
+            else:
+                timefilter = _timerange_filter(starttime, endtime)
+                if filterexpr in [None, '']:
+                    filterexpr = timefilter
+                else:
+                    filterexpr = '(%s) && (%s)' % (timefilter, filterexpr)
+
+        # More chunks than workers to even out the load
+        chunks = index.chunks(workers * self.CHUNKS_PER_WORKER,
+                              start_ns, end_ns)
+        logger.info("Querying %s in %d chunks with %d workers"
+                    % (self.filename, len(chunks), workers))
+
+        metrics.update(backend='parallel',
+                       bytes_read=sum(c.end - c.start for c in chunks))
+        data = []
+        with metrics.phase('workers'), \
+                concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_query_chunk, self.filename, chunk,
+                                   fieldnames, filterexpr,
+                                   use_tshark_fields, occurrence, aggregator,
+                                   explode)
+                       for chunk in chunks]
+            for future in futures:
+                data.extend(future.result())
+        return data
+
+
+# Fields whose values depend on earlier packets in the capture
+_STATEFUL_FIELDS = re.compile(
+    r'\b(frame\.(number|time_relative|time_delta\w*|ref_time)|'
+    r'\w+\.stream\b|'
+    r'tcp\.(analysis|seq|ack|nxtseq|time_\w+|completeness)|'
+    r'(?!frame\.)[\w.]+\.(time|response_in|request_in|'
+    r'reassembled\w*|segments?|fragments?)\b)')
+
+
+def _splittable(fieldnames, filterexpr):
+    """True if a query gives the same result when run over separate
+    chunks of the capture.  frame.number is renumbered by the caller."""
+    for n in fieldnames:
+        if n != 'frame.number' and _STATEFUL_FIELDS.match(n):
+            return False
+    if filterexpr and _STATEFUL_FIELDS.search(filterexpr):
+        return False
+    return True
+
+
+def _query_chunk(filename, chunk, fieldnames, filterexpr,
+                 use_tshark_fields, occurrence, aggregator, explode=None):
+    """Process pool entry point, query one CaptureChunk."""
+    pcap = PcapFile(filename)
+    source = pcap._prefilter(fieldnames, filterexpr, chunk)
+    return list(pcap._iter_tshark(fieldnames, filterexpr, use_tshark_fields,
+                                  occurrence, aggregator, source=source,
+                                  explode=explode))
+
+
+def _result(rows, fieldnames, use_tshark_fields, as_dataframe, columnar,
+            compact=False):
+    """Collect query rows into the list or DataFrame returned by
+    :py:meth:`PcapFile.query`."""
+    if columnar:
+        from steelscript.wireshark.core.columnar import to_dataframe
+        fields = _lookup_fields(fieldnames, use_tshark_fields)
+        with metrics.phase('parse'):
+            return to_dataframe(fields, fieldnames, rows, compact=compact)
+
+    with metrics.phase('parse'):
+        data = list(rows)
+
+    if as_dataframe:
+        if len(data) > 0:
+            import pandas
+            with metrics.phase('dataframe'):
+                df = pandas.DataFrame(data, columns=fieldnames)
+            return df
+        else:
+            return None
+    else:
+        return data
+
+
+def _query_spec(query):
+    """Normalize one multi_query() query to a dict of query()
+    arguments."""
+    if isinstance(query, dict):
+        spec = dict(query)
+    else:
+        fieldnames, filterexpr = query
+        spec = dict(fieldnames=fieldnames, filterexpr=filterexpr)
+
+    unknown = set(spec) - set(['fieldnames', 'filterexpr',
+                               'use_tshark_fields', 'occurrence',
+                               'aggregator', 'as_dataframe', 'columnar',
+                               'compact', 'explode'])
+    if unknown:
+        raise ValueError('Unsupported query arguments: %s'
+                         % ', '.join(sorted(unknown)))
+
+    spec['fieldnames'] = list(spec['fieldnames'])
+    spec.setdefault('filterexpr', None)
+    spec.setdefault('use_tshark_fields', True)
+    spec.setdefault('occurrence', PcapFile.OCCURRENCE_ALL)
+    spec.setdefault('aggregator', ',')
+    spec.setdefault('as_dataframe', False)
+    spec.setdefault('columnar', False)
+    spec.setdefault('compact', False)
+    spec.setdefault('explode', None)
+    return spec
+
+
+def _occurrences(values, spec):
+    """Format the values of a field as tshark would for the query's
+    occurrence and aggregator."""
+    if not values:
+        return ''
+    occurrence = spec['occurrence']
+    if occurrence == PcapFile.OCCURRENCE_FIRST:
+        return values[0]
+    elif occurrence == PcapFile.OCCURRENCE_LAST:
+        return values[-1]
+    return spec['aggregator'].join(values)
+
+
+def _tap(stat, filterexpr):
+    """Append the optional filter argument of a ``-z`` statistic."""
+    if filterexpr in [None, '']:
+        return stat
+    return '%s,%s' % (stat, filterexpr)
+
+
+def _io_expr(expr, filterexpr):
+    """Restrict an io,stat expression, a display filter or
+    ``FUNC(field)filter``, to packets matching ``filterexpr``."""
+    if filterexpr in [None, '']:
+        return expr
+    m = re.match(r'^(\w+\([^)]*\))(.*)$', expr)
+    if m is None:
+        return '(%s) && (%s)' % (expr, filterexpr)
+    func, exprfilter = m.groups()
+    if not exprfilter.strip():
+        return '%s(%s)' % (func, filterexpr)
+    return '%s(%s) && (%s)' % (func, exprfilter, filterexpr)
+
+
+def _renumber(rows, i, first_packet, use_tshark_fields):
+    """Shift frame.number in column ``i`` of rows read from a chunk so
+    it counts from the start of the original file."""
+    for row in rows:
+        if isinstance(row[i], list):
+            # explode='list'
+            row[i] = [n + first_packet if use_tshark_fields
+                      else str(int(n) + first_packet) for n in row[i]]
+        elif row[i] is not None and row[i] != '':
             if use_tshark_fields:
-                tf = TSharkFields.instance()
-                if n in tf.protocols:
-                    # Allow protocols as a field, but convert to a string
-                    # rather than attempt to parse it
-                    fields.append(TSharkField(n, '', 'FT_STRING', n))
+                row[i] += first_packet
+            else:
+                row[i] = str(int(row[i]) + first_packet)
+        yield row
+
+
+def _renumber_selected(rows, i, numbers, use_tshark_fields):
+    """Replace frame.number in column ``i`` of rows read from a
+    RecordSelection by the number of the packet in the original file."""
+    def original(n):
+        return int(numbers[int(n) - 1]) + 1
+
+    for row in rows:
+        if isinstance(row[i], list):
+            row[i] = [original(n) if use_tshark_fields
+                      else str(original(n)) for n in row[i]]
+        elif row[i] is not None and row[i] != '':
+            if use_tshark_fields:
+                row[i] = original(row[i])
+            else:
+                row[i] = str(original(row[i]))
+        yield row
+
+
+def _ns_to_datetime(ns):
+    """Convert nanoseconds since the epoch to a local datetime."""
+    sec, rem = divmod(ns, 1000000000)
+    return ((datetime.datetime.utcfromtimestamp(sec) +
+             datetime.timedelta(microseconds=rem // 1000))
+            .replace(tzinfo=pytz.utc)
+            .astimezone(local_tz))
+
+
+def _resolve_timerange(starttime, endtime, duration):
+    """Parse start/end times and apply ``duration`` the way editcap
+    exports do, returning ``(starttime, endtime)``."""
+    if starttime is not None:
+        if isinstance(starttime, str):
+            starttime = dateutil_parse(starttime)
+
+    if endtime is not None:
+        if isinstance(endtime, str):
+            endtime = dateutil_parse(endtime)
+
+    if duration is not None:
+        if isinstance(duration, str):
+            duration = parse_timedelta(duration)
+
+        if starttime:
+            endtime = starttime + duration
+        elif endtime:
+            starttime = endtime - duration
+        else:
+            raise ValueError("Must specify either starttime or "
+                             "endtime with duration")
+
+    return starttime, endtime
 
-                elif n in tf.fields:
-                    fields.append(tf.fields[n])
 
+def _to_epoch(t):
+    """Seconds since the epoch for ``t``, treating naive datetimes as
+    local time as editcap does."""
+    if t.tzinfo is None:
+        if hasattr(local_tz, 'localize'):
+            t = local_tz.localize(t)
+        else:
+            t = t.replace(tzinfo=local_tz)
+    return t.timestamp()
+
+
+def _to_ns(t):
+    """Nanoseconds since the epoch for ``t``, or None."""
+    if t is None:
+        return None
+    return int(round(_to_epoch(t) * 1e6)) * 1000
+
+
+def _editcap_time(t):
+    """``t`` in the local time format of ``editcap -A/-B``, with the
+    same instant as :py:func:`_to_ns`."""
+    local = datetime.datetime.fromtimestamp(_to_epoch(t))
+    if local.microsecond:
+        return local.strftime('%Y-%m-%d %H:%M:%S.%f')
+    return local.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _timerange_filter(starttime, endtime):
+    """Display filter selecting packets from ``starttime`` (inclusive)
+    up to ``endtime`` (exclusive), matching ``editcap -A/-B``."""
+    exprs = []
+    if starttime is not None:
+        exprs.append('frame.time_epoch >= %.6f' % _to_epoch(starttime))
+    if endtime is not None:
+        exprs.append('frame.time_epoch < %.6f' % _to_epoch(endtime))
+    return ' && '.join(exprs)
+
+
+def _parse_lines(lines, fields, fieldnames, occurrence, aggregator, cmd,
+                 explode=None):
+    """Split tshark field output into rows, exploding multiple
+    occurrences and converting values when ``fields`` is not None."""
+    if occurrence == PcapFile.OCCURRENCE_ALL and explode is not None:
+        yield from _explode_lines(lines, fields, fieldnames, aggregator,
+                                  explode)
+        return
+
+    errors = 0
+
+    for line in lines:
+        cols = line.split('\t')
+        if len(cols) < len(fieldnames):
+            cols.extend([None]*(len(fieldnames) - len(cols)))
+            logger.debug("Line incomplete: '%s'" % line)
+        elif len(cols) > len(fieldnames):
+            logger.error("Could not parse line: '%s'" % line)
+            errors = errors + 1
+            if errors > 20:
+                return
+            continue
+
+        if occurrence == PcapFile.OCCURRENCE_ALL:
+            newcols = []
+            needs_dup = []
+            n = 0
+            multi_occur = False
+            for i, col in enumerate(cols):
+                if col and aggregator in col:
+                    if n:
+                        logger.warning('One packet has at least '
+                                       'two columns with multiple '
+                                       'occurrences, skip it. '
+                                       'cmd: %s' % ' '.join(cmd))
+                        multi_occur = True
+                        break
+                    # Split col data into an array
+                    newcol = col.split(aggregator)
+                    newcols.append(newcol)
+                    n = len(newcol)
                 else:
-                    raise InvalidField(n)
+                    # Single valued column, keep track of
+                    # the col index, as we need to dup it
+                    # below
+                    newcols.append(col)
+                    needs_dup.append(i)
+
+            if multi_occur:
+                # The above for loop exited due to multiple occurrences of
+                # at least two columns in the current packet. Skip this
+                # packet and keep processing the rest of the pcap file
+                continue
 
-            cmd.extend(['-e', n])
+            if n:
+                for i in needs_dup:
+                    newcols[i] = ([newcols[i]] * n)
+                rows = (list(map(list, zip(*newcols))))
+            else:
+                rows = [newcols]
+        else:
+            rows = [cols]
 
-        logger.info('subprocess: %s' % ' '.join(cmd))
-        proc = subprocess.Popen(cmd,
-                                stdout=subprocess.PIPE,
-                                env=popen_env,
-                                universal_newlines=True)
+        for row in rows:
+            if fields is not None:
+                row = _convert_row(fields, row)
+            yield row
+
+
+# Lines expanded at a time with an ``explode`` mode
+EXPLODE_BATCH = 10000
 
-        data = []
-        errors = 0
 
-        line = proc.stdout.readline().rstrip()
+def _explode_lines(lines, fields, fieldnames, aggregator, mode):
+    """Split tshark ``-E occurrence=a`` output into rows, expanding
+    multi-valued fields a batch of packets at a time."""
+    from steelscript.wireshark.core.explode import explode_rows
 
-        while proc.poll() is None or line:
+    ncols = len(fieldnames)
+    batch = []
+    for line in itertools.chain(lines, [None]):
+        if line is not None:
             cols = line.split('\t')
-            if len(cols) < len(fieldnames):
-                cols.extend([None]*(len(fieldnames) - len(cols)))
-                logger.debug("Line incomplete: '%s'" % line)
-            elif len(cols) > len(fieldnames):
+            if len(cols) > ncols:
                 logger.error("Could not parse line: '%s'" % line)
-                errors = errors + 1
-                if errors > 20:
-                    return
+                continue
+            if len(cols) < ncols:
+                cols.extend([''] * (ncols - len(cols)))
+            batch.append(cols)
+            if len(batch) < EXPLODE_BATCH:
                 continue
 
-            if occurrence == PcapFile.OCCURRENCE_ALL:
-                newcols = []
-                needs_dup = []
-                n = 0
-                multi_occur = False
-                for i, col in enumerate(cols):
-                    if col and ',' in col:
-                        if n:
-                            logger.warning('One packet has at least '
-                                           'two columns with multiple '
-                                           'occurrences, skip it. '
-                                           'cmd: %s' % ' '.join(cmd))
-                            multi_occur = True
-                            break
-                        # Split col data into an array
-                        newcol = col.split(',')
-                        newcols.append(newcol)
-                        n = len(newcol)
-                    else:
-                        # Single valued column, keep track of
-                        # the col index, as we need to dup it
-                        # below
-                        newcols.append(col)
-                        needs_dup.append(i)
-
-                if multi_occur:
-                    # The above for loop exited due to multiple occurrences of
-                    # at least two columns in the current packet. Skip this
-                    # packet and keep processing the rest of the pcap file
-                    continue
-
-                if n:
-                    for i in needs_dup:
-                        newcols[i] = ([newcols[i]] * n)
-                    rows = (list(map(list, zip(*newcols))))
+        for row in explode_rows(batch, ncols, aggregator, mode):
+            if fields is not None:
+                if mode == 'list':
+                    row = [None if v is None else
+                           _convert_row([f] * len(v), v)
+                           for f, v in zip(fields, row)]
                 else:
-                    rows = [newcols]
-            else:
-                rows = [cols]
+                    row = _convert_row(fields, row)
+            yield row
+        batch = []
 
-            if use_tshark_fields:
-                newrows = []
-                for row in rows:
-                    newcols = []
-                    for i, col in enumerate(row):
-                        t = fields[i].datatype
-                        if col == '' or col is None:
-                            col = None
-                        elif t == datetime.datetime:
-                            col = (dateutil_parse(col)
-                                   .replace(tzinfo=local_tz))
-                        elif fields[i].name == 'frame.time_epoch':
-                            col = (datetime.datetime.utcfromtimestamp(float(col))
-                                   .replace(tzinfo=pytz.utc)
-                                   .astimezone(local_tz))
-                        elif t in [int, int]:
-                            col = t(col, base=0)
-                        else:
-                            col = t(col)
-                        newcols.append(col)
-                    newrows.append(newcols)
-                rows = newrows
 
-            data.extend(rows)
+def _lookup_fields(fieldnames, use_tshark_fields):
+    """Return the TSharkField for each of ``fieldnames``, or None if
+    values are to be left as strings."""
+    if not use_tshark_fields:
+        return None
 
-            # grab next line
-            line = proc.stdout.readline().rstrip()
+    fields = []
+    tf = TSharkFields.instance()
+    for n in fieldnames:
+        if n in tf.protocols:
+            # Allow protocols as a field, but convert to a string
+            # rather than attempt to parse it
+            fields.append(TSharkField(n, '', 'FT_STRING', n))
+
+        elif n in tf.fields:
+            fields.append(tf.fields[n])
 
-        if as_dataframe:
-            if len(data) > 0:
-                import pandas
-                df = pandas.DataFrame(data, columns=fieldnames)
-                return df
-            else:
-                return None
         else:
-            return data
+            raise InvalidField(n)
+    return fields
+
+
+def _convert_row(fields, row):
+    """Convert the string values of one row to the field datatypes."""
+    newcols = []
+    for i, col in enumerate(row):
+        t = fields[i].datatype
+        if col == '' or col is None:
+            col = None
+        elif t == datetime.datetime:
+            col = (dateutil_parse(col)
+                   .replace(tzinfo=local_tz))
+        elif fields[i].name == 'frame.time_epoch':
+            col = (datetime.datetime.utcfromtimestamp(float(col))
+                   .replace(tzinfo=pytz.utc)
+                   .astimezone(local_tz))
+        elif t in [int, int]:
+            col = t(col, base=0)
+        else:
+            col = t(col)
+        newcols.append(col)
+    return newcols
+
+
+def _feed(proc, source):
+    """Stream a CaptureChunk to the stdin of ``proc``."""
+    try:
+        source.stream(proc.stdin.buffer)
+    except (IOError, OSError, ValueError):
+        # tshark exited or was killed before reading everything
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+
+
+def _tshark_lines(cmd, source=None):
+    """Run ``cmd`` and yield its stdout one line at a time.
+
+    If ``source`` is a CaptureChunk it is written to the stdin of the
+    subprocess from a separate thread.  The subprocess is killed if the
+    consumer stops iterating early.
+    """
+    logger.info('subprocess: %s' % ' '.join(cmd))
+    proc = subprocess.Popen(cmd,
+                            stdin=subprocess.PIPE if source else None,
+                            stdout=subprocess.PIPE,
+                            env=popen_env,
+                            universal_newlines=True)
+    feeder = None
+    if source is not None:
+        feeder = threading.Thread(target=_feed, args=(proc, source))
+        feeder.daemon = True
+        feeder.start()
+    stats = metrics.current()
+    try:
+        if stats is None:
+            for line in proc.stdout:
+                yield line.rstrip()
+        else:
+            yield from _timed_lines(proc.stdout, stats)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+        if feeder is not None:
+            feeder.join()
+
+
+# Characters of tshark output read at a time while timing a query
+READ_HINT = 1 << 16
+
+
+def _timed_lines(stdout, stats):
+    """Yield the lines of ``stdout``, adding the time spent waiting for
+    them to the 'tshark' phase of ``stats``.  Lines are read
+    ``READ_HINT`` characters at a time to keep the timing overhead low."""
+    while True:
+        start = time.perf_counter()
+        lines = stdout.readlines(READ_HINT)
+        stats.add('tshark', time.perf_counter() - start)
+        if not lines:
+            return
+        stats.output_bytes += sum(map(len, lines))
+        for line in lines:
+            yield line.rstrip()
+
+
+# Lines of tshark output parsed at a time by aquery()
+ASYNC_BATCH = 1000
+
+_async_semaphores = weakref.WeakKeyDictionary()
+
+
+def _async_semaphore():
+    """The semaphore limiting subprocesses on the running event loop."""
+    loop = asyncio.get_running_loop()
+    semaphore = _async_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(PcapFile.ASYNC_LIMIT)
+        _async_semaphores[loop] = semaphore
+    return semaphore
+
+
+async def _afeed(proc, source):
+    """Stream a CaptureChunk to the stdin of an asyncio subprocess."""
+    try:
+        for buf in source.blocks():
+            proc.stdin.write(buf)
+            await proc.stdin.drain()
+    except (IOError, OSError):
+        # tshark exited or was killed before reading everything
+        pass
+    finally:
+        proc.stdin.close()
+
+
+async def _atshark_lines(cmd, source=None):
+    """Run ``cmd`` as an asyncio subprocess and generate lists of up to
+    ASYNC_BATCH stdout lines.  The subprocess is killed if the consumer
+    stops early."""
+    async with _async_semaphore():
+        logger.info('subprocess: %s' % ' '.join(cmd))
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.PIPE if source else None,
+            stdout=subprocess.PIPE,
+            env=popen_env,
+            limit=1 << 24)
+        feeder = None
+        if source is not None:
+            feeder = asyncio.ensure_future(_afeed(proc, source))
+        complete = False
+        try:
+            batch = []
+            async for line in proc.stdout:
+                batch.append(line.decode().rstrip())
+                if len(batch) >= ASYNC_BATCH:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+            complete = True
+        finally:
+            # Only kill a process that may still be running, killing one
+            # that exited interferes with the event loop's child watcher
+            if not complete and proc.returncode is None:
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+            await proc.wait()
+            if feeder is not None:
+                feeder.cancel()
+                await asyncio.gather(feeder, return_exceptions=True)
+
+
+def _batched(rows, batchsize):
+    """Group an iterable of rows into lists of ``batchsize`` rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batchsize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 class TSharkField(object):
@@ -411,8 +1881,7 @@ class TSharkField(object):
 class TSharkFields(object):
 
     CACHEFILE = os.path.join(os.path.expanduser('~'), '.steelscript',
-                             'tshark_fields')
-    CACHEFILE_VERSION = 1
+                             'tshark_fields.db')
 
     _instance = None
 
@@ -428,56 +1897,66 @@ class TSharkFields(object):
         self.load()
 
     def load(self, force=False, ignore_cache=False, protocols=None):
-        """Load"""
+        """Load the protocol and field catalog.
+
+        The catalog is kept in an SQLite database (``CACHEFILE``) that is
+        rebuilt from ``tshark -G fields`` when missing or when the tshark
+        binary changes.  Fields are looked up by name on demand rather
+        than loaded all at once.
+
+        :param bool force: reload even if already loaded
+        :param bool ignore_cache: rebuild the database from tshark
+        :param list protocols: only load these protocols and their
+            fields, in memory without touching the database
+        """
         if self.protocols and not force:
             return
 
-        if not ignore_cache and os.path.exists(self.CACHEFILE):
-            with open(self.CACHEFILE, 'rb') as f:
-                version = pickle.load(f)
-                if version == self.CACHEFILE_VERSION:
-                    protos, fields = pickle.load(f)
-                    if protos.keys() and fields.keys():
-                        self.protocols, self.fields = protos, fields
-                        return
+        if protocols is not None:
+            self.protocols = {}
+            self.fields = {}
+            for entry in tshark_catalog(popen_env, protocols):
+                if entry[0] == 'P':
+                    self.protocols[entry[1]] = entry[2]
                 else:
-                    logger.info("Cache file version mistmatch")
-
-        cmd = ['tshark', '-G', 'fields']
-
-        logger.info('subprocess: %s' % ' '.join(cmd))
-        proc = subprocess.Popen(cmd,
-                                stdout=subprocess.PIPE,
-                                env=popen_env,
-                                universal_newlines=True)
-
-        self.protocols = {}
-        self.fields = {}
-        while proc.poll() is None:
-            line = proc.stdout.readline().rstrip()
-            if not line:
-                continue
-            fields = line.split('\t')
-            if fields[0] == 'P':
-                (t, desc, name) = fields[:3]
-                if protocols is not None and name not in protocols:
-                    continue
-                self.protocols[name] = desc
-            elif fields[0] == 'F':
-                (t, desc, name, datatype, protocol) = fields[:5]
-                if protocols is not None and protocol not in protocols:
-                    continue
-                self.fields[name] = TSharkField(name, desc, datatype, protocol)
+                    self.fields[entry[1]] = TSharkField(*entry[1:])
+            return
 
-        with open(self.CACHEFILE, 'wb', 2) as f:
-            pickle.dump(self.CACHEFILE_VERSION, f)
-            pickle.dump([self.protocols, self.fields], f)
+        catalog = FieldCatalog(self.CACHEFILE)
+        if ignore_cache or not catalog.is_valid(tshark_identity(popen_env)):
+            catalog.close()
+            logger.info("Building tshark field catalog %s" % self.CACHEFILE)
+            catalog = FieldCatalog.build(self.CACHEFILE,
+                                         tshark_catalog(popen_env),
+                                         identity=tshark_identity(popen_env),
+                                         version=tshark_version(popen_env))
+
+        self.catalog = catalog
+        self.protocols = CatalogMapping(catalog, 'protocols',
+                                        lambda row: row[1])
+        self.fields = CatalogMapping(catalog, 'fields',
+                                     lambda row: TSharkField(*row))
 
     def find(self, name=None, name_re=None,
              desc=None, desc_re=None,
              protocol=None, protocol_re=None):
+        """Return the list of fields matching all of the given criteria.
+
+        ``name``, ``desc`` and ``protocol`` must match exactly, the
+        ``*_re`` arguments are regular expressions searched for in the
+        corresponding attribute.  The catalog indexes narrow down the
+        candidate fields before any regular expression is applied.
+        """
+        if isinstance(self.fields, CatalogMapping):
+            candidates = [self.fields.get_row(row) for row in
+                          self.catalog.find_rows(name, name_re,
+                                                 desc, desc_re,
+                                                 protocol, protocol_re)]
+        else:
+            candidates = self.fields.values()
+
         fields = []
-        for field in self.fields.values():
+        for field in candidates:
             if ( (name is not None and name != field.name) or
                  (name_re is not None and not re.search(name_re, field.name)) or
                  (desc is not None and desc != field.desc) or
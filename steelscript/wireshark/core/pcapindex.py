@@ -0,0 +1,308 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Packet offset/time index for capture files.
+
+The index records the byte offset and timestamp of every Nth packet of a
+capture and is saved as a small sidecar file next to the capture (or
+under ``~/.steelscript/pcap_index`` if that directory is not writable).
+It is discarded automatically when the capture's size or modification
+time changes.
+"""
+
+import os
+import sys
+import json
+import array
+import struct
+import bisect
+import hashlib
+import logging
+import threading
+
+from steelscript.wireshark.core.pcapreader import PcapReader, CaptureChunk
+
+logger = logging.getLogger(__name__)
+
+
+class PcapIndex(object):
+    """Checkpoints of ``(packet number, byte offset, timestamp)`` taken
+    every ``every`` packets of a capture.
+
+    Usage::
+
+        index = PcapIndex.get('/tmp/trace.pcap')
+        chunk = index.chunk(starttime_ns, endtime_ns)
+
+    """
+
+    SUFFIX = '.ssidx'
+    CACHEDIR = os.path.join(os.path.expanduser('~'), '.steelscript',
+                            'pcap_index')
+    MAGIC = b'SSPIDX\x00\x00'
+    VERSION = 1
+    DEFAULT_EVERY = 1000
+
+    _HEADER = struct.Struct('<8sIIQQQQQI')
+
+    def __init__(self, filename, every=DEFAULT_EVERY):
+        self.filename = filename
+        self.every = every
+        self.size = None
+        self.mtime_ns = None
+        self.numpackets = 0
+        self.data_start = 0
+        # True if packet timestamps never go backwards
+        self.ordered = True
+
+        self.packets = array.array('q')
+        self.offsets = array.array('q')
+        self.timestamps = array.array('q')
+        # Per checkpoint, index into ``sections`` (pcapng only)
+        self.section_ids = array.array('q')
+        self.sections = []
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def sidecar(cls, filename):
+        """Return the path of the sidecar file for ``filename``."""
+        path = os.path.abspath(filename)
+        if os.access(os.path.dirname(path), os.W_OK):
+            return path + cls.SUFFIX
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return os.path.join(cls.CACHEDIR, name + cls.SUFFIX)
+
+    @classmethod
+    def get(cls, filename, every=DEFAULT_EVERY, build=True):
+        """Return the index for ``filename``, loading the sidecar if it is
+        still valid.  Otherwise builds and saves a new index, or returns
+        None if ``build`` is False."""
+        index = cls.load(filename)
+        if index is None and build:
+            index = cls.build(filename, every=every)
+            try:
+                index.save()
+            except (IOError, OSError) as e:
+                logger.warning("Could not save pcap index for %s: %s"
+                               % (filename, e))
+        return index
+
+    @classmethod
+    def build(cls, filename, every=DEFAULT_EVERY):
+        """Scan ``filename`` and return a new index."""
+        logger.info("Building pcap index for %s every %d packets"
+                    % (filename, every))
+        index = cls(filename, every)
+        st = os.stat(filename)
+        index.size = st.st_size
+        index.mtime_ns = st.st_mtime_ns
+
+        with PcapReader(filename) as reader:
+            index.data_start = reader.data_start
+            n = 0
+            last = None
+            for record in reader.records():
+                ts = record.timestamp
+                if ts is None:
+                    ts = last if last is not None else 0
+                elif last is not None and ts < last:
+                    index.ordered = False
+                last = ts
+
+                if n % every == 0:
+                    index._add(n, record.offset, ts, reader.section_blocks)
+                n += 1
+            index.numpackets = n
+
+        return index
+
+    def _add(self, packet, offset, timestamp, section):
+        if section and (not self.sections or self.sections[-1] is not section):
+            self.sections.append(section)
+        self.packets.append(packet)
+        self.offsets.append(offset)
+        self.timestamps.append(timestamp)
+        self.section_ids.append(len(self.sections) - 1)
+
+    @classmethod
+    def load(cls, filename):
+        """Load the sidecar index for ``filename``, returning None if there
+        is none or it is stale."""
+        path = cls.sidecar(filename)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            st = os.stat(filename)
+            with open(path, 'rb') as f:
+                (magic, version, every, size, mtime_ns, count, numpackets,
+                 data_start, ordered) = cls._HEADER.unpack(
+                     f.read(cls._HEADER.size))
+
+                if magic != cls.MAGIC or version != cls.VERSION:
+                    logger.info("Pcap index %s version mismatch" % path)
+                    return None
+                if size != st.st_size or mtime_ns != st.st_mtime_ns:
+                    logger.info("Pcap index %s is stale" % path)
+                    return None
+
+                index = cls(filename, every)
+                index.size = size
+                index.mtime_ns = mtime_ns
+                index.numpackets = numpackets
+                index.data_start = data_start
+                index.ordered = bool(ordered)
+                for arr in (index.packets, index.offsets,
+                            index.timestamps, index.section_ids):
+                    arr.fromfile(f, count)
+                    if sys.byteorder == 'big':
+                        arr.byteswap()
+                index.sections = [[tuple(b) for b in s]
+                                  for s in json.loads(f.read().decode())]
+        except (IOError, OSError, EOFError, ValueError, struct.error) as e:
+            logger.warning("Could not load pcap index %s: %s" % (path, e))
+            return None
+
+        return index
+
+    def save(self):
+        """Write the index to its sidecar file."""
+        path = self.sidecar(self.filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Processes or threads indexing the same file each write their
+        # own temporary file, the last rename wins
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(self._HEADER.pack(self.MAGIC, self.VERSION,
+                                          self.every, self.size,
+                                          self.mtime_ns, len(self),
+                                          self.numpackets, self.data_start,
+                                          int(self.ordered)))
+                for arr in (self.packets, self.offsets,
+                            self.timestamps, self.section_ids):
+                    if sys.byteorder == 'big':
+                        arr = array.array('q', arr)
+                        arr.byteswap()
+                    arr.tofile(f)
+                f.write(json.dumps(self.sections).encode())
+            os.rename(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _section(self, i):
+        sid = self.section_ids[i]
+        return self.sections[sid] if sid >= 0 else None
+
+    def section_at(self, offset):
+        """Return the pcapng section blocks in effect at ``offset``, or
+        None if unknown."""
+        section = None
+        for s in self.sections:
+            if s[0][0] > offset:
+                break
+            section = s
+        return section
+
+    def checkpoint(self, timestamp):
+        """Index of the last checkpoint at or before ``timestamp`` (ns)."""
+        return max(bisect.bisect_right(self.timestamps, timestamp) - 1, 0)
+
+    def chunk(self, starttime=None, endtime=None):
+        """Return a :py:class:`CaptureChunk` holding exactly the packets
+        with ``starttime <= timestamp < endtime`` (nanoseconds).
+
+        Only the packets between the two nearest checkpoints are read to
+        find the exact boundaries.  Requires an ordered capture.
+        """
+        if not self.ordered:
+            raise ValueError('%s is not in time order' % self.filename)
+
+        with PcapReader(self.filename) as reader:
+            if starttime is None or not len(self):
+                start = self.data_start
+                first = 0
+                section = None
+            else:
+                i = self.checkpoint(starttime)
+                start = None
+                first = self.packets[i]
+                section = self._section(i)
+                for record in reader.records(self.offsets[i],
+                                             section=section):
+                    if (record.timestamp is not None and
+                            record.timestamp >= starttime):
+                        start = record.offset
+                        break
+                    first += 1
+                if start is None:
+                    start = end = reader.size
+                    return CaptureChunk(self.filename, reader.header(),
+                                        start, end, first)
+
+            if endtime is None or not len(self):
+                end = self.size
+            else:
+                i = max(self.checkpoint(endtime), 0)
+                if self.offsets[i] < start:
+                    i_offset, i_section = start, section
+                else:
+                    i_offset, i_section = self.offsets[i], self._section(i)
+                end = None
+                for record in reader.records(i_offset, section=i_section):
+                    if (record.timestamp is not None and
+                            record.timestamp >= endtime):
+                        end = record.offset
+                        break
+                if end is None:
+                    end = reader.position
+
+            header = reader.header(start, section)
+
+        return CaptureChunk(self.filename, header, start, max(start, end),
+                            first)
+
+    def chunks(self, n, starttime=None, endtime=None):
+        """Split the capture, or the packets with ``starttime <=
+        timestamp < endtime`` (nanoseconds), into up to ``n``
+        packet-aligned chunks of roughly equal packet count."""
+        if starttime is not None or endtime is not None:
+            window = self.chunk(starttime, endtime)
+        else:
+            section = self._section(0) if len(self) else None
+            with PcapReader(self.filename) as reader:
+                window = CaptureChunk(self.filename,
+                                      reader.header(self.data_start, section),
+                                      self.data_start, self.size, 0)
+        if window.start >= window.end:
+            return []
+
+        inside = [i for i in range(len(self))
+                  if window.start < self.offsets[i] < window.end]
+        if n <= 1 or not inside:
+            return [window]
+
+        step = len(inside) / float(n)
+        splits = sorted(set(inside[int(k * step)] for k in range(1, n)
+                            if int(k * step) < len(inside)))
+
+        result = [window]
+        with PcapReader(self.filename) as reader:
+            for i in splits:
+                start = self.offsets[i]
+                result.append(CaptureChunk(
+                    self.filename,
+                    reader.header(start, self._section(i)),
+                    start, window.end, self.packets[i]))
+        for prev, chunk in zip(result, result[1:]):
+            prev.end = chunk.start
+        return result
@@ -0,0 +1,621 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Native reader for classic pcap and pcapng capture files.
+
+The file is memory-mapped and only the record (block) headers are
+walked, packet data is never copied.  Timestamps are returned as integer
+nanoseconds since the epoch so that nanosecond-resolution captures are
+not rounded.
+"""
+
+import os
+import mmap
+import struct
+import logging
+import itertools
+from collections import namedtuple
+
+from steelscript.wireshark.core.exceptions import CaptureFormatError
+
+logger = logging.getLogger(__name__)
+
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+IDB_OPT_TSRESOL = 9
+IDB_OPT_TSOFFSET = 14
+
+PCAP_HEADER_LEN = 24
+PCAP_RECORD_LEN = 16
+
+# Records per batch generated by PcapReader.record_batches()
+BATCH_RECORDS = 1 << 18
+
+# Timestamp of records without one in PcapReader.record_batches()
+NO_TIMESTAMP = -1
+
+# A packet record: ``offset`` and ``length`` delimit the whole record
+# (header included), ``data`` is the offset of the packet bytes,
+# ``timestamp`` is in nanoseconds since the epoch (None if the record
+# carries no timestamp) and ``interface`` is the pcapng interface id
+# (always 0 for classic pcap).
+Record = namedtuple('Record', ['offset', 'length', 'data', 'caplen',
+                               'origlen', 'timestamp', 'interface',
+                               'linktype'])
+
+
+class Interface(object):
+    """A capture interface, as described by a pcapng IDB or the classic
+    pcap global header."""
+
+    __slots__ = ['linktype', 'snaplen', 'tsresol', 'tsoffset']
+
+    def __init__(self, linktype, snaplen, tsresol=6, tsoffset=0):
+        self.linktype = linktype
+        self.snaplen = snaplen
+        # tsresol is a power of ten, or a negative value for 2**-n
+        self.tsresol = tsresol
+        self.tsoffset = tsoffset
+
+    def to_ns(self, ticks):
+        """Convert a timestamp in interface units to nanoseconds."""
+        if self.tsresol >= 0:
+            if self.tsresol <= 9:
+                ns = ticks * 10 ** (9 - self.tsresol)
+            else:
+                ns = ticks // 10 ** (self.tsresol - 9)
+        else:
+            ns = (ticks * 10 ** 9) >> -self.tsresol
+        return ns + self.tsoffset * 10 ** 9
+
+
+class PcapReader(object):
+    """Walk the records of a pcap or pcapng file.
+
+    Usage::
+
+        with PcapReader('/tmp/trace.pcap') as reader:
+            for record in reader.records():
+                print(record.offset, record.timestamp)
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = os.path.getsize(filename)
+        self.format = None
+        self.nanosecond = False
+
+        # Interfaces of the current pcapng section, or the single
+        # interface described by the classic pcap header
+        self.interfaces = []
+        # Every interface seen so far, across all pcapng sections
+        self.all_interfaces = []
+        # (offset, length) of the SHB and IDBs of the current section
+        self.section_blocks = []
+        self.position = None
+        self._endian = '<'
+
+        self._map = None
+        self._file = open(filename, 'rb')
+        try:
+            if self.size < 12:
+                raise CaptureFormatError('%s: file too short' % filename)
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+
+        try:
+            self._read_header()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read_header(self):
+        m = self._map
+        magic = m[:4]
+
+        if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+            self._endian = '<'
+        elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+            self._endian = '>'
+        elif struct.unpack_from('<I', m, 0)[0] == PCAPNG_SHB:
+            self.format = 'pcapng'
+            self.data_start = 0
+            self.position = 0
+            return
+        else:
+            raise CaptureFormatError('%s: not a pcap or pcapng file'
+                                     % self.filename)
+
+        if self.size < PCAP_HEADER_LEN:
+            raise CaptureFormatError('%s: truncated pcap header'
+                                     % self.filename)
+
+        self.format = 'pcap'
+        (magic, major, minor, thiszone, sigfigs, snaplen,
+         network) = struct.unpack_from(self._endian + 'IHHiIII', m, 0)
+        self.nanosecond = (magic == PCAP_MAGIC_NSEC)
+        self.version = (major, minor)
+        # thiszone is always 0 in practice and ignored by wireshark
+        self.interfaces = [Interface(network & 0x0fffffff, snaplen,
+                                     9 if self.nanosecond else 6)]
+        self.all_interfaces = list(self.interfaces)
+        self.data_start = PCAP_HEADER_LEN
+        self.position = self.data_start
+
+    def records(self, start=None, end=None, section=None):
+        """Generate a :py:class:`Record` for each packet in the file.
+
+        :param int start: byte offset of the first record to read, must be
+            aligned on a record (pcapng block) boundary.  Defaults to the
+            first record in the file.
+        :param int end: stop at this byte offset.  Defaults to the end of
+            the file.  A truncated final record is ignored.
+        :param list section: for pcapng files read from ``start``, the
+            section blocks in effect there (see :py:meth:`header`)
+
+        Once the generator is exhausted, :py:attr:`position` is the offset
+        just past the last complete record read.
+        """
+        if start is None:
+            start = self.data_start
+        if end is None or end > self.size:
+            end = self.size
+
+        if self.format == 'pcap':
+            return self._pcap_records(start, end)
+        else:
+            return self._pcapng_records(start, end, section)
+
+    def view(self):
+        """Return a read-only numpy ``uint8`` array over the mapped file.
+        It must be deleted before the reader is closed."""
+        import numpy
+        return numpy.frombuffer(self._map, dtype=numpy.uint8)
+
+    def record_batches(self, start=None, end=None, section=None,
+                       count=BATCH_RECORDS):
+        """Generate the records read by :py:meth:`records` as dicts of
+        numpy arrays, up to ``count`` records at a time.
+
+        The keys are the :py:class:`Record` fields except ``interface``.
+        ``timestamp`` is ``NO_TIMESTAMP`` for records without one.  For
+        classic pcap only the record offsets are found one at a time,
+        the headers are then read for the whole batch at once.
+        """
+        if start is None:
+            start = self.data_start
+        if end is None or end > self.size:
+            end = self.size
+
+        if self.format == 'pcap':
+            return self._pcap_batches(start, end, count)
+        return self._pcapng_batches(start, end, section, count)
+
+    def _pcap_batches(self, offset, end, count):
+        import numpy
+
+        m = self._map
+        unpack_from = struct.Struct(self._endian + 'I').unpack_from
+        fields = numpy.dtype(self._endian + 'u4')
+        columns = numpy.arange(PCAP_RECORD_LEN)
+        linktype = self.interfaces[0].linktype
+        scale = 1 if self.nanosecond else 1000
+
+        while True:
+            offsets = []
+            append = offsets.append
+            for _ in range(count):
+                if offset + PCAP_RECORD_LEN > end:
+                    break
+                length = PCAP_RECORD_LEN + unpack_from(m, offset + 8)[0]
+                if offset + length > end:
+                    break
+                append(offset)
+                offset += length
+            self.position = offset
+            if not offsets:
+                return
+
+            off = numpy.array(offsets, dtype=numpy.int64)
+            view = self.view()
+            try:
+                hdr = view[off[:, None] + columns].view(fields)
+            finally:
+                del view
+            hdr = hdr.astype(numpy.int64)
+            caplen = hdr[:, 2]
+            yield {'offset': off,
+                   'length': caplen + PCAP_RECORD_LEN,
+                   'data': off + PCAP_RECORD_LEN,
+                   'caplen': caplen,
+                   'origlen': hdr[:, 3],
+                   'timestamp': hdr[:, 0] * 1000000000 + hdr[:, 1] * scale,
+                   'linktype': numpy.full(len(off), linktype,
+                                          dtype=numpy.int64)}
+            if len(offsets) < count:
+                return
+
+    def _pcapng_batches(self, start, end, section, count):
+        import numpy
+
+        names = ['offset', 'length', 'data', 'caplen', 'origlen',
+                 'timestamp', 'linktype']
+        records = self._pcapng_records(start, end, section)
+        while True:
+            batch = [(r.offset, r.length, r.data, r.caplen, r.origlen,
+                      NO_TIMESTAMP if r.timestamp is None else r.timestamp,
+                      r.linktype)
+                     for r in itertools.islice(records, count)]
+            if not batch:
+                return
+            columns = numpy.array(batch, dtype=numpy.int64)
+            yield dict((name, columns[:, i]) for i, name in enumerate(names))
+            if len(batch) < count:
+                return
+
+    def _pcap_records(self, offset, end):
+        m = self._map
+        hdr = struct.Struct(self._endian + 'IIII')
+        unpack_from = hdr.unpack_from
+        linktype = self.interfaces[0].linktype
+        scale = 1 if self.nanosecond else 1000
+
+        while offset + PCAP_RECORD_LEN <= end:
+            sec, frac, caplen, origlen = unpack_from(m, offset)
+            length = PCAP_RECORD_LEN + caplen
+            if offset + length > end:
+                break
+            yield Record(offset, length, offset + PCAP_RECORD_LEN,
+                         caplen, origlen,
+                         sec * 1000000000 + frac * scale,
+                         0, linktype)
+            offset += length
+
+        self.position = offset
+
+    def _shb_endian(self, offset):
+        """Return the byte order of the section header block at offset."""
+        bom = self._map[offset + 8:offset + 12]
+        if bom == b'\x4d\x3c\x2b\x1a':
+            return '<'
+        elif bom == b'\x1a\x2b\x3c\x4d':
+            return '>'
+        raise CaptureFormatError('%s: bad pcapng byte-order magic at '
+                                 'offset %d' % (self.filename, offset))
+
+    def _read_shb(self, offset, length):
+        """Parse a section header block, resetting the interfaces."""
+        self._endian = self._shb_endian(offset)
+        self.interfaces = []
+        self.section_blocks = [(offset, length)]
+
+    def _read_idb(self, offset, length):
+        """Parse an interface description block and its options."""
+        m = self._map
+        e = self._endian
+        linktype, _, snaplen = struct.unpack_from(e + 'HHI', m, offset + 8)
+        iface = Interface(linktype, snaplen)
+
+        opt = offset + 16
+        opt_end = offset + length - 4
+        while opt + 4 <= opt_end:
+            code, optlen = struct.unpack_from(e + 'HH', m, opt)
+            if code == 0:
+                break
+            value = opt + 4
+            if code == IDB_OPT_TSRESOL and optlen >= 1:
+                resol = m[value]
+                if resol & 0x80:
+                    iface.tsresol = -(resol & 0x7f)
+                else:
+                    iface.tsresol = resol
+            elif code == IDB_OPT_TSOFFSET and optlen >= 8:
+                iface.tsoffset = struct.unpack_from(e + 'q', m, value)[0]
+            opt = value + ((optlen + 3) & ~3)
+
+        self.interfaces.append(iface)
+        self.all_interfaces.append(iface)
+        self.section_blocks.append((offset, length))
+
+    def _enter_section(self, offset, section=None):
+        """Load the section header and interfaces in effect at offset.
+
+        ``section`` is the list of ``(offset, length)`` of the SHB and IDBs
+        of the section containing ``offset``, as found in
+        :py:attr:`section_blocks`.  Without it the file is walked from the
+        start.
+        """
+        if section is None:
+            for _ in self._pcapng_records(0, offset):
+                pass
+            return
+
+        for i, (boff, blen) in enumerate(section):
+            if boff >= offset:
+                break
+            if i == 0:
+                self._read_shb(boff, blen)
+            else:
+                self._read_idb(boff, blen)
+
+    def header(self, offset=None, section=None):
+        """Return the file header bytes needed to read the records starting
+        at ``offset`` as a standalone capture.
+
+        For classic pcap this is the global header.  For pcapng it is the
+        section header block (with an unspecified section length) followed
+        by the interface description blocks in effect at ``offset``.
+        """
+        m = self._map
+        if self.format == 'pcap':
+            return m[:PCAP_HEADER_LEN]
+
+        if not offset:
+            return b''
+        if struct.unpack_from(self._endian + 'I', m, offset)[0] == PCAPNG_SHB:
+            return b''
+
+        self._enter_section(offset, section)
+        blocks = []
+        for i, (boff, blen) in enumerate(self.section_blocks):
+            block = m[boff:boff + blen]
+            if i == 0:
+                block = bytearray(block)
+                struct.pack_into(self._endian + 'q', block, 16, -1)
+                block = bytes(block)
+            blocks.append(block)
+        return b''.join(blocks)
+
+    def _pcapng_records(self, offset, end, section=None):
+        m = self._map
+
+        if offset == 0:
+            self.all_interfaces = []
+        else:
+            # Starting mid-file, pick up the section and interfaces that
+            # are in effect at this offset
+            self._enter_section(offset, section)
+
+        while offset + 12 <= end:
+            e = self._endian
+            btype = struct.unpack_from(e + 'I', m, offset)[0]
+            if btype == PCAPNG_SHB:
+                e = self._shb_endian(offset)
+            length = struct.unpack_from(e + 'I', m, offset + 4)[0]
+            if length < 12 or offset + length > end:
+                if length < 12:
+                    raise CaptureFormatError('%s: bad pcapng block length '
+                                             'at offset %d'
+                                             % (self.filename, offset))
+                break
+
+            if btype == PCAPNG_SHB:
+                self._read_shb(offset, length)
+            elif btype == PCAPNG_EPB:
+                (ifid, high, low,
+                 caplen, origlen) = struct.unpack_from(e + 'IIIII', m,
+                                                       offset + 8)
+                iface = self._interface(ifid, offset)
+                yield Record(offset, length, offset + 28, caplen, origlen,
+                             iface.to_ns((high << 32) | low),
+                             ifid, iface.linktype)
+            elif btype == PCAPNG_SPB:
+                origlen = struct.unpack_from(e + 'I', m, offset + 8)[0]
+                iface = self._interface(0, offset)
+                caplen = min(origlen, length - 16)
+                if iface.snaplen:
+                    caplen = min(caplen, iface.snaplen)
+                yield Record(offset, length, offset + 12, caplen, origlen,
+                             None, 0, iface.linktype)
+            elif btype == PCAPNG_PB:
+                (ifid, drops, high, low,
+                 caplen, origlen) = struct.unpack_from(e + 'HHIIII', m,
+                                                       offset + 8)
+                iface = self._interface(ifid, offset)
+                yield Record(offset, length, offset + 28, caplen, origlen,
+                             iface.to_ns((high << 32) | low),
+                             ifid, iface.linktype)
+            elif btype == PCAPNG_IDB:
+                self._read_idb(offset, length)
+
+            offset += length
+
+        self.position = offset
+
+    def _interface(self, ifid, offset):
+        """The interface of the packet block at ``offset``."""
+        if ifid >= len(self.interfaces):
+            raise CaptureFormatError('%s: packet block at offset %d has '
+                                     'unknown interface %d'
+                                     % (self.filename, offset, ifid))
+        return self.interfaces[ifid]
+
+    def summary(self):
+        """Return a dict of statistics gathered from the record headers:
+        packet count, first and last timestamps (nanoseconds), captured
+        and original byte counts, link types and snapshot lengths."""
+        numpackets = 0
+        starttime = None
+        endtime = None
+        caplen_total = 0
+        origlen_total = 0
+        in_order = True
+        last = None
+
+        for record in self.records():
+            numpackets += 1
+            caplen_total += record.caplen
+            origlen_total += record.origlen
+            ts = record.timestamp
+            if ts is None:
+                continue
+            if last is not None and ts < last:
+                in_order = False
+            last = ts
+            if starttime is None or ts < starttime:
+                starttime = ts
+            if endtime is None or ts > endtime:
+                endtime = ts
+
+        return {'format': self.format,
+                'numpackets': numpackets,
+                'starttime': starttime,
+                'endtime': endtime,
+                'caplen': caplen_total,
+                'origlen': origlen_total,
+                'linktypes': sorted(set(i.linktype
+                                        for i in self.all_interfaces)),
+                'snaplen': max([i.snaplen for i in self.all_interfaces]
+                               or [0]),
+                'interfaces': len(self.all_interfaces),
+                'nanosecond': self.nanosecond or any(
+                    i.tsresol > 6 or i.tsresol < -20
+                    for i in self.all_interfaces),
+                'in_order': in_order,
+                'size': self.size}
+
+
+def pcap_summary(filename):
+    """Convenience wrapper returning :py:meth:`PcapReader.summary` for
+    ``filename``."""
+    with PcapReader(filename) as reader:
+        return reader.summary()
+
+
+class CaptureChunk(object):
+    """A packet-aligned byte range of a capture file that can be read as
+    a standalone capture: the header bytes followed by the records in
+    ``[start, end)`` of the original file, with nothing copied to disk.
+
+    :param str filename: the original capture file
+    :param bytes header: header bytes from :py:meth:`PcapReader.header`
+    :param int start: offset of the first record
+    :param int end: offset just past the last record
+    :param int first_packet: 0-based index of the first packet in the
+        original file, if known
+    """
+
+    BUFSIZE = 1 << 20
+
+    def __init__(self, filename, header, start, end, first_packet=None):
+        self.filename = filename
+        self.header = header
+        self.start = start
+        self.end = end
+        self.first_packet = first_packet
+
+    def __repr__(self):
+        return '<CaptureChunk %s [%d, %d)>' % (self.filename,
+                                               self.start, self.end)
+
+    @property
+    def size(self):
+        """Bytes of the standalone capture, header included."""
+        return len(self.header) + self.end - self.start
+
+    @property
+    def empty(self):
+        """True if the chunk holds no records."""
+        return self.end <= self.start
+
+    def blocks(self):
+        """Generate the bytes of the chunk, the header first and then the
+        records up to ``BUFSIZE`` bytes at a time."""
+        yield self.header
+        with open(self.filename, 'rb') as f:
+            f.seek(self.start)
+            remaining = self.end - self.start
+            while remaining > 0:
+                buf = f.read(min(self.BUFSIZE, remaining))
+                if not buf:
+                    break
+                yield buf
+                remaining -= len(buf)
+
+    def stream(self, out):
+        """Write the chunk to the file object ``out``."""
+        for buf in self.blocks():
+            out.write(buf)
+
+    def write(self, filename):
+        """Save the chunk as a new capture file."""
+        with open(filename, 'wb') as out:
+            self.stream(out)
+
+
+class RecordSelection(CaptureChunk):
+    """Selected records of a capture file read as a standalone capture,
+    for instance the packets passing a
+    :py:mod:`~steelscript.wireshark.core.prefilter`.
+
+    :param str filename: the original capture file
+    :param bytes header: header bytes from :py:meth:`PcapReader.header`
+    :param list runs: ``(start, end)`` byte ranges of consecutive
+        selected records, in file order
+    :param numbers: numpy array of the 0-based number of each selected
+        packet in the original file (or in the chunk it was selected
+        from), used to renumber ``frame.number``
+    """
+
+    def __init__(self, filename, header, runs, numbers):
+        start = runs[0][0] if runs else 0
+        end = runs[-1][1] if runs else 0
+        super(RecordSelection, self).__init__(filename, header, start, end)
+        self.runs = runs
+        self.numbers = numbers
+
+    def __repr__(self):
+        return '<RecordSelection %s %d packets in %d runs>' % (
+            self.filename, len(self.numbers), len(self.runs))
+
+    @property
+    def size(self):
+        return len(self.header) + sum(end - start for start, end in self.runs)
+
+    @property
+    def empty(self):
+        return not self.runs
+
+    def blocks(self):
+        yield self.header
+        with open(self.filename, 'rb') as f:
+            for start, end in self.runs:
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    buf = f.read(min(self.BUFSIZE, remaining))
+                    if not buf:
+                        break
+                    yield buf
+                    remaining -= len(buf)
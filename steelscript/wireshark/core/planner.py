@@ -0,0 +1,527 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Planning of :py:meth:`PcapFile.query
+<steelscript.wireshark.core.pcap.PcapFile.query>`.
+
+A query is answered by one of:
+
+* ``cache`` - a stored result in ``PcapFile.QUERY_CACHE``
+* ``native`` - the headers decoded without tshark by
+  :py:mod:`~steelscript.wireshark.core.decode`, when it supports every
+  field and the filter.  tshark is planned for instead if some packet
+  cannot be decoded exactly.
+* ``ss_packets`` - steelscript.packets alone, when it supports every
+  field.  A filter using only supported fields is evaluated on its
+  output with :py:mod:`~steelscript.wireshark.core.dfilter`.
+* ``sharkd`` - the long-lived session of ``PcapFile.SHARKD_POOL``
+* ``hybrid`` - steelscript.packets for the fields it supports and tshark
+  for the others and the filter, merged on ``frame.number`` as both are
+  read, with the steelscript.packets values converted like tshark's
+* ``parallel`` - tshark over packet-aligned chunks in several processes
+* ``tshark`` - one tshark process
+
+Time ranges go to steelscript.packets as arguments, and to tshark as an
+index chunk when the capture has an ordered index, otherwise as a display
+filter.  A filtered tshark query is first given only the packets the
+:py:mod:`~steelscript.wireshark.core.prefilter` cannot reject from their
+headers.  Where both ``hybrid`` and one of ``tshark`` or ``parallel``
+apply the cheapest estimate is used; the cost model is deliberately
+simple and only meant to rank the choices::
+
+    print(pcap.explain(['ip.src', 'http.host'], 'tcp', workers=4))
+"""
+
+import os
+import logging
+
+from steelscript.wireshark.core import dfilter, decode
+from steelscript.wireshark.core.exceptions import DisplayFilterError
+from steelscript.wireshark.core.pcap import (PcapFile, TSharkFields,
+                                             _resolve_timerange, _to_ns,
+                                             _splittable, _convert_row)
+
+logger = logging.getLogger(__name__)
+
+# Estimated seconds per process, packet, field or cell
+TSHARK_STARTUP = 0.3
+TSHARK_PACKET = 20e-6
+TSHARK_FIELD = 0.5e-6
+SHARKD_PACKET = 5e-6
+SS_STARTUP = 0.01
+SS_PACKET = 2e-6
+SS_FIELD = 0.2e-6
+CONVERT_CELL = 1.5e-6
+COLUMNAR_CELL = 0.2e-6
+PARSE_CELL = 0.3e-6
+TRANSFER_CELL = 0.2e-6
+POOL_STARTUP = 0.1
+JOIN_ROW = 1e-6
+INDEX_BYTE = 2e-9
+PREFILTER_PACKET = 0.5e-6
+NATIVE_PACKET = 0.5e-6
+CACHE_HIT = 0.01
+
+# Average bytes per packet record, used when the packet count is unknown
+AVG_RECORD = 500
+
+# Fraction of packets assumed to match a display filter
+FILTER_SELECTIVITY = 0.5
+
+# Field joining the steelscript.packets and tshark halves of a query
+JOIN_FIELD = 'frame.number'
+
+
+class PlanStep(object):
+    """One backend call of a :py:class:`QueryPlan`.
+
+    :ivar str backend: 'cache', 'native', 'ss_packets', 'sharkd',
+        'tshark' or 'join'
+    :ivar list fieldnames: fields requested from the backend
+    :ivar str filterexpr: display filter applied by the backend
+    :ivar str timerange: how the time range is applied, if any
+    :ivar int workers: tshark processes
+    :ivar float cost: estimated seconds
+    :ivar predicate: for 'ss_packets', the parsed filter evaluated on its
+        output, or None
+    """
+
+    def __init__(self, backend, fieldnames, filterexpr=None, timerange=None,
+                 workers=1, cost=0.0, predicate=None):
+        self.backend = backend
+        self.fieldnames = fieldnames
+        self.filterexpr = filterexpr
+        self.timerange = timerange
+        self.workers = workers
+        self.cost = cost
+        self.predicate = predicate
+
+    def __repr__(self):
+        return '<PlanStep %s %s>' % (self.backend, ','.join(self.fieldnames))
+
+    def __str__(self):
+        msg = '%-10s fields: %s' % (self.backend, ', '.join(self.fieldnames))
+        if self.filterexpr:
+            msg += '; filter: %s' % self.filterexpr
+            if self.predicate is not None:
+                msg += ' (evaluated on its output)'
+        if self.timerange:
+            msg += '; time range: %s' % self.timerange
+        if self.workers > 1:
+            msg += '; %d workers' % self.workers
+        return msg + '; cost %.3fs' % self.cost
+
+
+class QueryPlan(object):
+    """The steps chosen to answer a query, see :py:meth:`explain`.
+
+    :ivar str method: 'cache', 'native', 'ss_packets', 'sharkd',
+        'hybrid', 'parallel' or 'tshark'
+    :ivar list steps: PlanSteps, run in order
+    :ivar dict estimates: estimated packets, packets in range and rows
+    :ivar dict alternatives: estimated cost of each method considered
+    :ivar list notes: reasons for the choice
+    :ivar fallback: for 'native', the QueryPlan run instead if some
+        packet turns out not to be decodable exactly, which is only known
+        once the headers are read
+    """
+
+    def __init__(self, filename, method, steps, estimates=None,
+                 alternatives=None, notes=None, fallback=None):
+        self.filename = filename
+        self.method = method
+        self.steps = steps
+        self.estimates = estimates or {}
+        self.alternatives = alternatives or {}
+        self.notes = notes or []
+        self.fallback = fallback
+
+    @property
+    def cost(self):
+        return sum(step.cost for step in self.steps)
+
+    def __repr__(self):
+        return '<QueryPlan %s %s>' % (self.method, self.filename)
+
+    def __str__(self):
+        return self.explain()
+
+    def explain(self):
+        """Return a description of the plan and its estimated cost."""
+        lines = ['Query plan for %s: %s, estimated %.3fs'
+                 % (self.filename, self.method, self.cost)]
+        for i, step in enumerate(self.steps):
+            lines.append('  %d. %s' % (i + 1, step))
+        if self.estimates:
+            lines.append('  estimates: %s' % ', '.join(
+                '%s %d' % (k, v) for k, v in self.estimates.items()))
+        if len(self.alternatives) > 1:
+            lines.append('  considered: %s' % ', '.join(
+                '%s %.3fs' % (k, v) for k, v in
+                sorted(self.alternatives.items(), key=lambda kv: kv[1])))
+        for note in self.notes:
+            lines.append('  note: %s' % note)
+        if self.fallback is not None:
+            lines.append('  tentative, if some packet cannot be decoded '
+                         'exactly:')
+            lines.extend('    ' + line
+                         for line in self.fallback.explain().split('\n'))
+        return '\n'.join(lines)
+
+
+def _estimate_packets(pcapfile, index):
+    if index is not None:
+        return index.numpackets
+    if pcapfile.numpackets is not None:
+        return int(pcapfile.numpackets)
+    return max(1, os.path.getsize(pcapfile.filename) // AVG_RECORD)
+
+
+def _range_fraction(pcapfile, index, starttime, endtime, byterange):
+    """Estimate the fraction of packets in the time and byte range."""
+    fraction = 1.0
+    if byterange is not None:
+        size = os.path.getsize(pcapfile.filename)
+        fraction = float(byterange[1] - byterange[0]) / max(size, 1)
+
+    first = last = None
+    if index is not None and len(index.timestamps):
+        first, last = index.timestamps[0], index.timestamps[-1]
+    elif pcapfile.starttime is not None:
+        first, last = _to_ns(pcapfile.starttime), _to_ns(pcapfile.endtime)
+
+    if (starttime or endtime) and first is not None and last > first:
+        lo = max(first, _to_ns(starttime) if starttime else first)
+        hi = min(last, _to_ns(endtime) if endtime else last)
+        fraction *= max(0.0, float(hi - lo) / (last - first))
+    return fraction
+
+
+def _ss_supported(filename, names):
+    """Names of ``names`` steelscript.packets can extract."""
+    from steelscript.wireshark.core.pcap import PcapQuery
+    pq = PcapQuery(filename=filename, wshark_fields=list(names))
+    return [n for n in names if pq.fields_supported([n])]
+
+
+def _predicate(filterexpr):
+    """Parse ``filterexpr`` for evaluation on steelscript.packets output,
+    returning the node or None if it cannot be."""
+    try:
+        node = dfilter.parse(filterexpr, TSharkFields.instance())
+    except DisplayFilterError as e:
+        logger.debug("Filter cannot be evaluated in Python: %s" % e)
+        return None
+    if _has_protocol(node):
+        # frame.protocols is not a steelscript.packets field
+        return None
+    return node
+
+
+def _has_protocol(node):
+    if isinstance(node, dfilter.Protocol):
+        return True
+    if isinstance(node, dfilter.Not):
+        return _has_protocol(node.node)
+    if isinstance(node, dfilter.Logical):
+        return any(_has_protocol(n) for n in node.nodes)
+    return False
+
+
+def _printed(value):
+    """steelscript.packets value as the list of strings tshark prints."""
+    if value is None or value == '':
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+def filter_rows(rows, fieldnames, node, ncols):
+    """Generate the first ``ncols`` values of the rows matching ``node``."""
+    for row in rows:
+        packet = dict((name, _printed(v)) for name, v in zip(fieldnames, row))
+        if node.evaluate(packet):
+            yield list(row[:ncols])
+
+
+def _text(value):
+    """steelscript.packets scalar as the text tshark prints, or None."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return str(value)
+
+
+def convert_rows(rows, fields):
+    """Convert steelscript.packets rows to the TSharkField ``fields``
+    types, as tshark output is converted.  Multiple values stay a list."""
+    for row in rows:
+        if not any(isinstance(v, (list, tuple)) for v in row):
+            yield _convert_row(fields, [_text(v) for v in row])
+            continue
+        yield [_convert_row([f] * len(v), [_text(x) for x in v])
+               if isinstance(v, (list, tuple))
+               else _convert_row([f], [_text(v)])[0]
+               for f, v in zip(fields, row)]
+
+
+def join_rows(ss_rows, ss_names, tshark_rows, tshark_names, fieldnames):
+    """Join steelscript.packets and tshark rows on ``frame.number``,
+    keeping the order of the tshark rows and the packets present in
+    both.  Both are in packet order, so they are merged as they are
+    read rather than holding either in memory."""
+    key = ss_names.index(JOIN_FIELD)
+    ss_rows = ((int(row[key]), row) for row in ss_rows
+               if row[key] not in (None, ''))
+    number, other = next(ss_rows, (None, None))
+
+    tkey = tshark_names.index(JOIN_FIELD)
+    columns = [(True, ss_names.index(n)) if n in ss_names
+               else (False, tshark_names.index(n)) for n in fieldnames]
+    for row in tshark_rows:
+        if row[tkey] in (None, ''):
+            continue
+        tnumber = int(row[tkey])
+        # Several tshark rows of one packet join the same row
+        while number is not None and number < tnumber:
+            number, other = next(ss_rows, (None, None))
+        if number is None:
+            break
+        if number != tnumber:
+            continue
+        yield [other[i] if from_ss else row[i] for from_ss, i in columns]
+
+
+def _tshark_cost(packets_read, rows, nfields, workers=1, cell=CONVERT_CELL):
+    cost = (packets_read * (TSHARK_PACKET + TSHARK_FIELD * nfields) +
+            rows * nfields * cell)
+    if workers > 1:
+        return (TSHARK_STARTUP + POOL_STARTUP * workers + cost / workers +
+                rows * nfields * TRANSFER_CELL)
+    return TSHARK_STARTUP + cost
+
+
+def _prefiltered(fieldnames, filterexpr):
+    """True if tshark may be given only the packets the
+    :py:mod:`~steelscript.wireshark.core.prefilter` cannot reject."""
+    if not (PcapFile.PREFILTER and filterexpr and
+            _splittable(fieldnames, filterexpr)):
+        return False
+
+    from steelscript.wireshark.core import prefilter
+    return prefilter.applicable(fieldnames, filterexpr) is not None
+
+
+def _ss_cost(packets, nfields):
+    return SS_STARTUP + packets * (SS_PACKET + SS_FIELD * nfields)
+
+
+def _ss_usable(params):
+    """True if steelscript.packets may answer a query with arguments
+    ``params``."""
+    return (PcapFile.HAVE_STEELSCRIPT_PACKETS and
+            params['use_ss_packets'] and params['byterange'] is None and
+            not params['compact'] and params['explode'] is None and
+            params['occurrence'] == PcapFile.OCCURRENCE_ALL and
+            params['aggregator'] == ',')
+
+
+def cache_key(cache, filename, params):
+    """Return the key of :py:meth:`PcapFile.query` arguments ``params``
+    in QueryCache ``cache``.
+
+    The number of workers does not change the result, nor does
+    ``use_ss_packets`` when steelscript.packets cannot answer the query,
+    so those results are shared with :py:meth:`PcapFile.aquery`.
+    """
+    params = dict(params)
+    params.pop('workers', None)
+    params['use_ss_packets'] = bool(_ss_usable(params))
+    return cache.key(filename, **params)
+
+
+def plan_query(pcapfile, params, cache=None):
+    """Return the :py:class:`QueryPlan` for :py:meth:`PcapFile.query`
+    arguments ``params``.  ``params['native']`` set to False leaves out
+    native decoding.
+
+    :param cache: QueryCache to look the query up in, if any
+    """
+    fieldnames = list(params['fieldnames'])
+    filterexpr = params['filterexpr'] or None
+    byterange = params['byterange']
+    workers = params.get('workers', 1)
+    occurrence = params['occurrence']
+    filename = pcapfile.filename
+
+    if cache is not None:
+        key = cache_key(cache, filename, params)
+        if cache.contains(key):
+            return QueryPlan(filename, 'cache',
+                             [PlanStep('cache', fieldnames,
+                                       cost=CACHE_HIT)])
+
+    index = pcapfile.index(build=False)
+    starttime = endtime = None
+    if params['starttime'] or params['endtime']:
+        starttime, endtime = _resolve_timerange(params['starttime'],
+                                                params['endtime'],
+                                                params['duration'])
+    timed = starttime is not None or endtime is not None
+
+    packets = _estimate_packets(pcapfile, index)
+    in_range = int(packets * _range_fraction(pcapfile, index, starttime,
+                                             endtime, byterange))
+    rows = int(in_range * (FILTER_SELECTIVITY if filterexpr else 1))
+    estimates = {'packets': packets, 'in range': in_range, 'rows': rows}
+    notes = []
+
+    # What tshark reads: an index chunk skips packets outside the time
+    # range, a display filter still dissects them
+    chunked = index is not None and index.ordered
+    if byterange is not None:
+        read = int(packets * _range_fraction(pcapfile, None, None, None,
+                                             byterange))
+        tshark_time = 'display filter' if timed else None
+    elif timed and chunked:
+        read, tshark_time = in_range, 'index chunk'
+    else:
+        read, tshark_time = packets, 'display filter' if timed else None
+
+    if (PcapFile.NATIVE_DECODE and params.get('native', True) and
+            params['use_tshark_fields'] and params['explode'] is None and
+            decode.covers(fieldnames) and
+            (filterexpr is None or decode.supports_filter(filterexpr))):
+        if not timed:
+            native_time = None
+        elif chunked and byterange is None:
+            native_time = 'index chunk'
+        else:
+            native_time = 'timestamps'
+        step = PlanStep('native', fieldnames, filterexpr=filterexpr,
+                        timerange=native_time,
+                        cost=read * NATIVE_PACKET +
+                        rows * len(fieldnames) * COLUMNAR_CELL)
+        notes.append('every field%s is decoded from the packet headers'
+                     % (' and the filter' if filterexpr else ''))
+        fallback = plan_query(pcapfile, dict(params, native=False))
+        return QueryPlan(filename, 'native', [step], estimates,
+                         {'native': step.cost}, notes, fallback)
+
+    # Packets the filter rejects from their headers are not dissected
+    prefilter_cost, dissected = 0, 1
+    if _prefiltered(fieldnames, filterexpr):
+        prefilter_cost, dissected = read * PREFILTER_PACKET, \
+            FILTER_SELECTIVITY
+        notes.append('the filter is evaluated on packet headers first, '
+                     'tshark only reads the packets it may match')
+
+    columnar = (params['as_dataframe'] and
+                (params['columnar'] or params['compact']) and
+                params['use_tshark_fields'] and params['explode'] != 'list')
+    if columnar:
+        cell = COLUMNAR_CELL
+    elif params['use_tshark_fields']:
+        cell = CONVERT_CELL
+    else:
+        cell = PARSE_CELL
+
+    ss_usable = _ss_usable(params)
+    ss_time = 'ss_packets arguments' if timed else None
+
+    if ss_usable:
+        predicate = _predicate(filterexpr) if filterexpr else None
+        extra = []
+        if predicate is not None:
+            extra = sorted(predicate.fields() - set(fieldnames))
+        supported = _ss_supported(filename, fieldnames + extra +
+                                  [JOIN_FIELD])
+
+        if (all(n in supported for n in fieldnames + extra) and
+                (filterexpr is None or predicate is not None)):
+            step = PlanStep('ss_packets', fieldnames + extra,
+                            filterexpr=filterexpr, timerange=ss_time,
+                            cost=_ss_cost(packets, len(fieldnames + extra)),
+                            predicate=predicate)
+            notes.append('steelscript.packets supports every field%s'
+                         % (' and the filter' if filterexpr else ''))
+            return QueryPlan(filename, 'ss_packets', [step], estimates,
+                             {'ss_packets': step.cost}, notes)
+    else:
+        supported = []
+
+    if (PcapFile.SHARKD_POOL is not None and byterange is None and
+            workers <= 1 and params['aggregator'] == ','):
+        step = PlanStep('sharkd', fieldnames, filterexpr=filterexpr,
+                        timerange='display filter' if timed else None,
+                        cost=packets * SHARKD_PACKET +
+                        rows * len(fieldnames) * cell)
+        notes.append('sharkd session pool configured, tshark is run if '
+                     'sharkd fails')
+        return QueryPlan(filename, 'sharkd', [step], estimates,
+                         {'sharkd': step.cost}, notes)
+
+    parallel = workers > 1 and byterange is None
+    if parallel and not _splittable(fieldnames, filterexpr):
+        logger.info("Fields or filter depend on earlier packets, "
+                    "not splitting the query")
+        notes.append('fields or filter depend on earlier packets, not '
+                     'splitting the query')
+        parallel = False
+
+    # Splitting is only skipped when it would change the result, the
+    # number of workers asked for is not second-guessed
+    candidates = {}
+    if not parallel:
+        candidates['tshark'] = [
+            PlanStep('tshark', fieldnames, filterexpr=filterexpr,
+                     timerange=tshark_time,
+                     cost=_tshark_cost(int(read * dissected), rows,
+                                       len(fieldnames), cell=cell) +
+                     prefilter_cost)]
+    else:
+        # The index built for splitting is ordered unless the capture is not
+        split_read = in_range if chunked or index is None else packets
+        cost = (_tshark_cost(int(split_read * dissected), rows,
+                             len(fieldnames), workers, cell) +
+                prefilter_cost / workers)
+        if index is None:
+            cost += os.path.getsize(filename) * INDEX_BYTE
+            notes.append('the packet index is built to split the capture')
+        candidates['parallel'] = [
+            PlanStep('tshark', fieldnames, filterexpr=filterexpr,
+                     timerange=('index chunks' if timed and chunked
+                                else tshark_time),
+                     workers=workers, cost=cost)]
+
+    ss_fields = [n for n in fieldnames if n in supported]
+    if (ss_fields and len(ss_fields) < len(fieldnames) and
+            JOIN_FIELD in supported and params['use_tshark_fields']):
+        ss_names = ss_fields + ([JOIN_FIELD] if JOIN_FIELD not in ss_fields
+                                else [])
+        tshark_names = [n for n in fieldnames if n not in ss_fields]
+        tshark_names.append(JOIN_FIELD)
+        tshark_workers = workers if parallel else 1
+        candidates['hybrid'] = [
+            PlanStep('ss_packets', ss_names, timerange=ss_time,
+                     cost=_ss_cost(packets, len(ss_names))),
+            PlanStep('tshark', tshark_names, filterexpr=filterexpr,
+                     timerange=tshark_time, workers=tshark_workers,
+                     cost=_tshark_cost(int((read if tshark_workers == 1
+                                            else in_range) * dissected),
+                                       rows,
+                                       len(tshark_names), tshark_workers) +
+                     prefilter_cost / tshark_workers),
+            PlanStep('join', fieldnames, cost=rows * JOIN_ROW)]
+
+    alternatives = dict((k, sum(s.cost for s in steps))
+                        for k, steps in candidates.items())
+    method = min(alternatives, key=alternatives.get)
+    return QueryPlan(filename, method, candidates[method], estimates,
+                     alternatives, notes)
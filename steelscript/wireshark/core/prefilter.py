@@ -0,0 +1,378 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Header-level prefiltering of the packets given to tshark.
+
+Before a filtered query runs tshark, the display filter is evaluated on
+headers decoded by :py:mod:`~steelscript.wireshark.core.headers`, and
+the packets it certainly rejects are left out of the capture streamed to
+tshark's stdin::
+
+    pcap.query(['ip.src', 'http.host'],
+               'ip.addr == 10.1.0.0/16 && tcp.port == 80')
+
+tshark still applies the whole filter to the packets it reads, so only
+the amount of dissection changes, not the result.  Each part of the
+filter evaluates to true, false or unknown per packet; unknown parts,
+such as fields not decoded here, can never reject a packet.  Supported
+are ``frame.len``, ``frame.cap_len``, ``frame.time_epoch``, the IPv4
+``ip.*`` addresses, protocol, length and TTL, TCP and UDP ports,
+``tcp.flags``, ``udp.length``, ``icmp.type`` and the protocols ``ip``,
+``ipv6``, ``tcp``, ``udp``, ``icmp`` and ``icmpv6``.
+
+Leaving packets out changes what tshark reassembles and which requests
+it matches responses to.  Filters on ``ip.addr``, ``tcp.port``,
+``udp.port`` and protocols keep or drop both directions of a
+conversation, and filters on time drop what a time range would, so they
+are always used.  Filters on one direction, such as ``ip.src`` or
+``tcp.dstport``, or on per-packet values such as lengths or flags could
+drop some packets of a conversation, so they are only used when every
+field of the query is from the frame, IP or transport layers.  Set
+``PcapFile.PREFILTER = False`` to disable prefiltering.
+"""
+
+import logging
+
+import numpy
+
+from steelscript.wireshark.core import dfilter, headers
+from steelscript.wireshark.core.exceptions import DisplayFilterError
+from steelscript.wireshark.core.pcapreader import (PcapReader,
+                                                   RecordSelection)
+
+logger = logging.getLogger(__name__)
+
+# Minimum fraction of packets that must be rejected to use a selection
+# rather than reading the capture as is
+MIN_REJECTED = 0.1
+
+# Uncertainty of frame.time_epoch literals in nanoseconds, they are
+# compared as floating point seconds
+TIME_SLACK = 1000
+
+# Types the filter literals are parsed as, any other field is compared
+# as a string and evaluates to unknown
+_TYPES = {'frame.len': 'FT_UINT32',
+          'frame.cap_len': 'FT_UINT32',
+          'frame.time_epoch': 'FT_DOUBLE',
+          'ip.src': 'FT_IPv4',
+          'ip.dst': 'FT_IPv4',
+          'ip.addr': 'FT_IPv4',
+          'ip.proto': 'FT_UINT8',
+          'ip.len': 'FT_UINT16',
+          'ip.ttl': 'FT_UINT8',
+          'tcp.srcport': 'FT_UINT16',
+          'tcp.dstport': 'FT_UINT16',
+          'tcp.port': 'FT_UINT16',
+          'tcp.flags': 'FT_UINT16',
+          'udp.srcport': 'FT_UINT16',
+          'udp.dstport': 'FT_UINT16',
+          'udp.port': 'FT_UINT16',
+          'udp.length': 'FT_UINT16',
+          'icmp.type': 'FT_UINT8'}
+
+# Field -> (presence mask, value columns, per-packet value) of Headers,
+# fields of one direction of a conversation count as per-packet
+_FIELDS = {'ip.src': ('ip', ['ip_src'], True),
+           'ip.dst': ('ip', ['ip_dst'], True),
+           'ip.addr': ('ip', ['ip_src', 'ip_dst'], False),
+           'ip.proto': ('ip', ['ip_proto'], False),
+           'ip.len': ('ip', ['ip_len'], True),
+           'ip.ttl': ('ip', ['ip_ttl'], True),
+           'tcp.srcport': ('tcp', ['srcport'], True),
+           'tcp.dstport': ('tcp', ['dstport'], True),
+           'tcp.port': ('tcp', ['srcport', 'dstport'], False),
+           'tcp.flags': ('tcp', ['tcp_flags'], True),
+           'udp.srcport': ('udp', ['srcport'], True),
+           'udp.dstport': ('udp', ['dstport'], True),
+           'udp.port': ('udp', ['srcport', 'dstport'], False),
+           'udp.length': ('udp', ['udp_length'], True),
+           'icmp.type': ('icmp4', ['icmp_type'], True)}
+
+_PROTOCOLS = {'ip': 'ip', 'ipv6': 'ipv6', 'tcp': 'tcp', 'udp': 'udp',
+              'icmp': 'icmp4', 'icmpv6': 'icmp6'}
+
+# Fields whose dissection does not depend on other packets of the
+# conversation, see the module documentation
+_LOWER_LAYERS = ('frame.', 'eth.', 'vlan.', 'sll.', 'ip.', 'ipv6.',
+                 'tcp.', 'udp.', 'icmp.', 'icmpv6.')
+
+
+class _Fields(object):
+    """Field catalog giving the prefilter types to dfilter."""
+
+    def __init__(self, fields):
+        self._fields = fields
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def __getitem__(self, name):
+        from steelscript.wireshark.core.pcap import TSharkField
+
+        field = self._fields[name]
+        return TSharkField(name, field.desc,
+                           _TYPES.get(name, 'FT_STRING'), field.protocol)
+
+
+class _Catalog(object):
+
+    def __init__(self, catalog):
+        self.protocols = catalog.protocols
+        self.fields = _Fields(catalog.fields)
+
+
+def parse(filterexpr):
+    """Parse ``filterexpr`` for :py:func:`evaluate`.
+
+    :raises DisplayFilterError: if the filter cannot be parsed
+    """
+    from steelscript.wireshark.core.pcap import TSharkFields
+
+    return dfilter.parse(filterexpr, _Catalog(TSharkFields.instance()))
+
+
+def decides(node, strict):
+    """True if some part of ``node`` can be evaluated on headers."""
+    if isinstance(node, dfilter.Protocol):
+        return node.name in _PROTOCOLS
+    if isinstance(node, dfilter.Not):
+        return decides(node.node, strict)
+    if isinstance(node, dfilter.Logical):
+        return any(decides(n, strict) for n in node.nodes)
+    name = node.value.field.name
+    if name in _FIELDS:
+        return strict or not _FIELDS[name][2]
+    return name == 'frame.time_epoch' or (strict and name in _TYPES)
+
+
+def complete(node):
+    """True if every part of ``node`` can be evaluated on headers, so
+    packets with exact headers get a definite result."""
+    if isinstance(node, dfilter.Protocol):
+        return node.name in _PROTOCOLS
+    if isinstance(node, dfilter.Not):
+        return complete(node.node)
+    if isinstance(node, dfilter.Logical):
+        return all(complete(n) for n in node.nodes)
+    return node.value.field.name in _TYPES
+
+
+def _present(h, name):
+    if name == 'icmp4':
+        return h.icmp & h.ip
+    if name == 'icmp6':
+        return h.icmp & h.ipv6
+    return getattr(h, name)
+
+
+def _compare(values, op, literal):
+    """Mask of ``values`` matching ``op literal``, or None if the
+    literal cannot be compared with header values."""
+    if isinstance(literal, list):
+        result = numpy.zeros(len(values), dtype=bool)
+        for lit in literal:
+            match = _compare(values, '==', lit)
+            if match is None:
+                return None
+            result |= match
+        return result
+
+    if hasattr(literal, 'netmask'):
+        if literal.version != 4:
+            return None
+        mask = int(literal.netmask)
+        return (values.astype(numpy.int64) & mask) == \
+            int(literal.network_address)
+    if hasattr(literal, 'version'):
+        if literal.version != 4:
+            return None
+        literal = int(literal)
+    elif op not in ('==', '!=', 'in', '>', '<', '>=', '<=') or \
+            isinstance(literal, (str, bool)):
+        return None
+
+    if op in ('==', '!=', 'in'):
+        return values == literal
+    elif op == '>':
+        return values > literal
+    elif op == '<':
+        return values < literal
+    elif op == '>=':
+        return values >= literal
+    return values <= literal
+
+
+def evaluate(node, h, strict):
+    """Evaluate ``node`` on :py:class:`~headers.Headers` ``h``, returning
+    masks ``(true, false)`` of packets where the filter is certainly true
+    and certainly false.
+
+    :param bool strict: if False, fields whose values differ between
+        packets or directions of a conversation are treated as unknown
+    """
+    n = len(h)
+    unknown = (numpy.zeros(n, dtype=bool), numpy.zeros(n, dtype=bool))
+
+    if isinstance(node, dfilter.Logical):
+        results = [evaluate(child, h, strict) for child in node.nodes]
+        true, false = results[0]
+        for t, f in results[1:]:
+            if node.op == 'and':
+                true, false = true & t, false | f
+            else:
+                true, false = true | t, false & f
+        return true, false
+
+    if isinstance(node, dfilter.Not):
+        true, false = evaluate(node.node, h, strict)
+        return false, true
+
+    if isinstance(node, dfilter.Protocol):
+        if node.name not in _PROTOCOLS:
+            return unknown
+        present = _present(h, _PROTOCOLS[node.name])
+        return present, ~present & h.exact
+
+    name = node.value.field.name
+    if name == 'frame.time_epoch' or \
+            (name in ('frame.len', 'frame.cap_len') and strict):
+        return _evaluate_frame(node, h, name)
+
+    if name not in _FIELDS or (_FIELDS[name][2] and not strict):
+        return unknown
+    present_name, columns, _ = _FIELDS[name]
+    present = _present(h, present_name)
+
+    if isinstance(node, dfilter.Exists):
+        return present, ~present & h.exact
+
+    matches = [_compare(getattr(h, c), node.op, node.literal)
+               for c in columns]
+    if any(m is None for m in matches):
+        return unknown
+    match = numpy.logical_or.reduce(matches) & present
+    if node.op == '!=':
+        return present & ~match & h.exact, match
+    return match, ~match & h.exact
+
+
+def _evaluate_frame(node, h, name):
+    """Fields present in every packet, with exact values."""
+    n = len(h)
+    if isinstance(node, dfilter.Exists):
+        return numpy.ones(n, dtype=bool), numpy.zeros(n, dtype=bool)
+
+    if name != 'frame.time_epoch':
+        values = h.origlen if name == 'frame.len' else h.caplen
+        match = _compare(values, node.op, node.literal)
+        if match is None:
+            return numpy.zeros(n, dtype=bool), numpy.zeros(n, dtype=bool)
+        if node.op == '!=':
+            return ~match, match
+        return match, ~match
+
+    # Timestamps are compared in ns, values too close to a literal to
+    # be sure of its rounding are unknown
+    literals = node.literal if isinstance(node.literal, list) \
+        else [node.literal]
+    try:
+        literals = [int(round(float(lit) * 1e9)) for lit in literals]
+    except (TypeError, ValueError):
+        return numpy.zeros(n, dtype=bool), numpy.zeros(n, dtype=bool)
+    known = h.has_timestamp
+    for lit in literals:
+        known &= numpy.abs(h.timestamp - lit) > TIME_SLACK
+    op = node.op if not isinstance(node.literal, list) else 'in'
+    match = _compare(h.timestamp, op, literals if op == 'in' else
+                     literals[0])
+    if op == '!=':
+        return known & ~match, known & match
+    return known & match, known & ~match
+
+
+def applicable(fieldnames, filterexpr):
+    """Return ``(node, strict)`` for :py:func:`evaluate` if some part of
+    ``filterexpr`` can be evaluated on headers for a query of
+    ``fieldnames``, otherwise None."""
+    try:
+        node = parse(filterexpr)
+    except DisplayFilterError as e:
+        logger.debug("Not prefiltering %r: %s" % (filterexpr, e))
+        return None
+
+    strict = all(n.startswith(_LOWER_LAYERS)
+                 for n in list(fieldnames) + sorted(node.fields()))
+    if not decides(node, strict):
+        return None
+    return node, strict
+
+
+def select(pcapfile, source, fieldnames, filterexpr):
+    """Return a :py:class:`RecordSelection` of the packets of ``source``
+    (a CaptureChunk, or None for the whole file) that ``filterexpr`` may
+    match, or None if too few packets can be rejected."""
+    parsed = applicable(fieldnames, filterexpr)
+    if parsed is None:
+        return None
+    node, strict = parsed
+
+    index = pcapfile.index(build=False)
+    start = source.start if source is not None else None
+    end = source.end if source is not None else None
+    first = (source.first_packet or 0) if source is not None else 0
+
+    numbers = []
+    dropped = []
+    total = 0
+    with PcapReader(pcapfile.filename) as reader:
+        if start is None:
+            start, end = reader.data_start, reader.size
+        section = index.section_at(start) if index is not None else None
+        header = reader.header(start, section)
+
+        for batch in reader.record_batches(start, end, section,
+                                           headers.BATCH):
+            h = headers.decode(reader, batch)
+            _, false = evaluate(node, h, strict)
+            numbers.append(first + total + numpy.flatnonzero(~false))
+            dropped.append(_merge(batch['offset'][false],
+                                  batch['offset'][false] +
+                                  batch['length'][false]))
+            total += len(h)
+
+    numbers = (numpy.concatenate(numbers) if numbers
+               else numpy.zeros(0, dtype=numpy.int64))
+    rejected = total - len(numbers)
+    if not total or rejected < total * MIN_REJECTED:
+        logger.debug("Prefilter rejects %d of %d packets, not used"
+                     % (rejected, total))
+        return None
+
+    # Keep everything but the rejected records, including any pcapng
+    # blocks between the records
+    starts, ends = _merge(*[numpy.concatenate(a) for a in zip(*dropped)])
+    runs = [(int(s), int(e)) for s, e in
+            zip(numpy.r_[start, ends], numpy.r_[starts, end]) if e > s]
+    if not len(numbers):
+        runs = []
+
+    selection = RecordSelection(pcapfile.filename, header, runs, numbers)
+    logger.info("Prefilter rejects %d of %d packets, reading %s"
+                % (rejected, total, selection))
+    return selection
+
+
+def _merge(starts, ends):
+    """Coalesce sorted ``[start, end)`` ranges that touch."""
+    if not len(starts):
+        return starts, ends
+    new = numpy.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] != ends[:-1]
+    last = numpy.ones(len(starts), dtype=bool)
+    last[:-1] = new[1:]
+    return starts[new], ends[last]
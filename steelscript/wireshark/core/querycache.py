@@ -0,0 +1,172 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+On-disk cache of :py:meth:`PcapFile.query` results.
+
+Entries are keyed by the identity of the capture file (device, inode,
+size and modification time), the query parameters, the tshark binary and
+the pandas and numpy versions, so a modified or replaced capture or an
+upgrade never returns stale results.  Results are pickled as is,
+DataFrames keep their column blocks and dtypes, and the least recently
+used entries are evicted once the cache exceeds its size limit.  Entries
+that cannot be unpickled are discarded and count as misses.
+"""
+
+import os
+import pickle
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCache(object):
+    """Cache of query results stored as files in ``path``.
+
+    Enable it for all queries with::
+
+        PcapFile.QUERY_CACHE = QueryCache(max_bytes=2 * 1024 ** 3)
+
+    :param str path: cache directory
+    :param int max_bytes: total size of entries before the least recently
+        used ones are evicted
+    :param int max_entries: optional limit on the number of entries
+    """
+
+    CACHEDIR = os.path.join(os.path.expanduser('~'), '.steelscript',
+                            'query_cache')
+    SUFFIX = '.result'
+    VERSION = 1
+
+    def __init__(self, path=CACHEDIR, max_bytes=1024 ** 3, max_entries=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def stats(self):
+        """Return a dict of hit/miss/eviction counters and cache size."""
+        entries = self._entries()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(entries),
+                'bytes': sum(e[2] for e in entries)}
+
+    def key(self, filename, **params):
+        """Return the cache key for a query of ``filename`` with the given
+        query parameters."""
+        st = os.stat(filename)
+        ident = (self.VERSION, _environment(), st.st_dev, st.st_ino,
+                 st.st_size, st.st_mtime_ns, sorted(params.items()))
+        return hashlib.sha1(repr(ident).encode('utf-8')).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
+
+    def get(self, key):
+        """Return ``(True, result)`` on a hit or ``(False, None)``."""
+        path = self._filename(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            # Mark as recently used for eviction
+            os.utime(path, None)
+        except Exception as e:
+            # Besides I/O errors, results pickled by other pandas or numpy
+            # versions may fail with any exception
+            if os.path.exists(path):
+                logger.warning("Discarding unreadable cache entry %s: %s"
+                               % (path, e))
+                self._remove(path)
+            with self._lock:
+                self.misses += 1
+            return False, None
+
+        with self._lock:
+            self.hits += 1
+        logger.debug("Query cache hit %s" % key)
+        return True, result
+
+    def contains(self, key):
+        """True if there is an entry for ``key``, without loading it."""
+        return os.path.exists(self._filename(key))
+
+    def put(self, key, result):
+        """Store ``result`` under ``key`` and evict old entries if the
+        cache is over its limits."""
+        path = self._filename(key)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            logger.warning("Could not cache query result: %s" % e)
+            self._remove(tmp)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until within limits."""
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(e[2] for e in entries)
+        while entries and (total > self.max_bytes or
+                           (self.max_entries is not None and
+                            len(entries) > self.max_entries)):
+            path, _, size = entries.pop(0)
+            self._remove(path)
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all entries."""
+        for path, _, _ in self._entries():
+            self._remove(path)
+
+    def _entries(self):
+        """List of ``(path, mtime, size)`` for every entry."""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, st.st_mtime, st.st_size))
+        return entries
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _environment():
+    """The tshark binary and library versions results depend on."""
+    from steelscript.wireshark.core.pcap import popen_env
+    from steelscript.wireshark.core.fieldcatalog import tshark_identity
+
+    versions = []
+    for name in ('pandas', 'numpy'):
+        try:
+            versions.append(__import__(name).__version__)
+        except ImportError:
+            versions.append(None)
+    return [tshark_identity(popen_env)] + versions
@@ -0,0 +1,242 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Long-lived ``sharkd`` sessions for repeated queries of the same capture.
+
+A :py:class:`SharkdSession` runs ``sharkd -`` and talks JSON-RPC over its
+stdin/stdout.  The capture is loaded and dissected once, after which
+field, filter and frame requests are answered without starting tshark
+again.  :py:class:`SharkdPool` keeps one session per capture and closes
+sessions that have been idle for too long.
+
+Enable it for all queries with::
+
+    PcapFile.SHARKD_POOL = SharkdPool()
+
+Queries the sessions cannot answer exactly fall back to running tshark.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import subprocess
+
+from steelscript.wireshark.core.exceptions import SharkdError
+
+logger = logging.getLogger(__name__)
+
+
+class SharkdSession(object):
+    """A ``sharkd`` process with ``filename`` loaded.
+
+    :param str filename: capture to load
+    :param dict env: environment for the subprocess
+    """
+
+    # Frames requested at a time
+    PAGESIZE = 10000
+
+    def __init__(self, filename, env=None):
+        self.filename = filename
+        self.env = env
+        st = os.stat(filename)
+        self.identity = (st.st_size, st.st_mtime_ns)
+        self.last_used = time.time()
+
+        self._id = 0
+        self._lock = threading.Lock()
+
+        if shutil.which('sharkd', path=(env or os.environ).get('PATH')) \
+                is None:
+            raise SharkdError('sharkd not found')
+
+        cmd = ['sharkd', '-']
+        logger.info('subprocess: %s' % ' '.join(cmd))
+        self.proc = subprocess.Popen(cmd,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL,
+                                     env=env,
+                                     universal_newlines=True)
+        try:
+            self.request('load', file=os.path.abspath(filename))
+        except SharkdError:
+            self.close()
+            raise
+
+    def __repr__(self):
+        return '<SharkdSession %s>' % self.filename
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def is_current(self):
+        """True if the process is running and the capture has not changed
+        since it was loaded."""
+        if not self.alive:
+            return False
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime_ns) == self.identity
+
+    def request(self, method, **params):
+        """Send one JSON-RPC request and return its result."""
+        with self._lock:
+            self.last_used = time.time()
+            self._id += 1
+            msg = {'jsonrpc': '2.0', 'id': self._id, 'method': method}
+            if params:
+                msg['params'] = params
+            try:
+                self.proc.stdin.write(json.dumps(msg) + '\n')
+                self.proc.stdin.flush()
+            except (IOError, OSError) as e:
+                raise SharkdError('sharkd exited: %s' % e)
+
+            while True:
+                line = self.proc.stdout.readline()
+                if not line:
+                    raise SharkdError('sharkd exited')
+                try:
+                    response = json.loads(line)
+                except ValueError:
+                    # Not a response, e.g. a startup message
+                    continue
+                if not isinstance(response, dict) or \
+                        response.get('id') != self._id:
+                    continue
+                if 'error' in response:
+                    error = response['error']
+                    raise SharkdError('%s failed: %s'
+                                      % (method, error.get('message', error)))
+                result = response.get('result')
+                if isinstance(result, dict) and \
+                        result.get('status') not in (None, 'OK'):
+                    raise SharkdError('%s failed: %s' % (method, result))
+                return result
+
+    def status(self):
+        """Return the session status: frames, duration, filesize..."""
+        return self.request('status')
+
+    def check_filter(self, filterexpr):
+        """Raise SharkdError if ``filterexpr`` is not a valid filter."""
+        self.request('check', filter=filterexpr)
+
+    def frames(self, fieldnames, filterexpr=None, occurrence='a'):
+        """Generate, for each frame matching ``filterexpr``, the list of
+        values of ``fieldnames`` as tshark would print them with ``-T
+        fields -E occurrence=<occurrence> -E aggregator=,``."""
+        occ = {'a': 0, 'f': 1, 'l': -1}[occurrence]
+        params = dict(('column%d' % i, '%s:%d' % (name, occ))
+                      for i, name in enumerate(fieldnames))
+        if filterexpr not in [None, '']:
+            params['filter'] = filterexpr
+
+        skip = 0
+        while True:
+            page = self.request('frames', skip=skip, limit=self.PAGESIZE,
+                                **params)
+            for frame in page or []:
+                yield frame['c']
+            if not page or len(page) < self.PAGESIZE:
+                return
+            skip += len(page)
+
+    def close(self):
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            try:
+                self.proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc.stdout.close()
+
+
+class SharkdPool(object):
+    """Keeps one :py:class:`SharkdSession` per capture file.
+
+    :param int max_sessions: sessions kept open, the least recently used
+        is closed when a new one is needed
+    :param float idle_timeout: seconds after which an unused session is
+        closed
+    :param dict env: environment for the sharkd processes
+    """
+
+    def __init__(self, max_sessions=8, idle_timeout=300, env=None):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.env = env
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def session(self, filename):
+        """Return the session for ``filename``, starting one if needed.
+
+        :raises SharkdError: if sharkd cannot be started or cannot load
+            the file
+        """
+        key = os.path.realpath(filename)
+        self.evict_idle()
+
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and not session.is_current():
+                logger.info("Restarting sharkd for %s" % filename)
+                del self._sessions[key]
+                session.close()
+                session = None
+
+            if session is None:
+                while len(self._sessions) >= self.max_sessions:
+                    oldest = min(self._sessions,
+                                 key=lambda k: self._sessions[k].last_used)
+                    self._sessions.pop(oldest).close()
+                session = SharkdSession(filename, env=self.env)
+                self._sessions[key] = session
+
+            session.last_used = time.time()
+            return session
+
+    def evict_idle(self):
+        """Close sessions not used in the last ``idle_timeout`` seconds."""
+        now = time.time()
+        with self._lock:
+            for key, session in list(self._sessions.items()):
+                if now - session.last_used > self.idle_timeout or \
+                        not session.alive:
+                    logger.debug("Closing idle %s" % session)
+                    del self._sessions[key]
+                    session.close()
+
+    def discard(self, filename):
+        """Close the session for ``filename``, if any."""
+        with self._lock:
+            session = self._sessions.pop(os.path.realpath(filename), None)
+        if session is not None:
+            session.close()
+
+    def close(self):
+        """Close all sessions."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            session.close()
@@ -0,0 +1,240 @@
+# Copyright (c) 2019 - 2024 Riverbed Technology, Inc.
+#
+# This software is licensed under the terms and conditions of the MIT License
+# accompanying the software ("License").  This software is distributed "AS IS"
+# as set forth in the License.
+
+"""
+Parsers for the text reports of tshark's ``-q -z`` statistics.
+
+Each parser takes the lines printed by tshark and returns a typed
+DataFrame.  Counts that tshark prints with a size unit (``1,234 bytes``,
+``12 kB``) are converted back to a plain number of bytes.
+"""
+
+import re
+import logging
+
+import numpy
+import pandas
+
+logger = logging.getLogger(__name__)
+
+
+# Protocols whose conversation and endpoint addresses include a port
+PORT_PROTOCOLS = ('tcp', 'udp', 'sctp', 'dccp')
+
+# Multipliers for the units used by tshark's format_size()
+UNITS = {'bytes': 1, 'B': 1,
+         'kB': 10 ** 3, 'MB': 10 ** 6, 'GB': 10 ** 9, 'TB': 10 ** 12,
+         'KiB': 2 ** 10, 'MiB': 2 ** 20, 'GiB': 2 ** 30, 'TiB': 2 ** 40}
+
+_NUMBER = re.compile(r'(-?[\d,]*\.?\d+)(?:\s+(%s)\b)?'
+                     % '|'.join(re.escape(u) for u in UNITS))
+
+CONVERSATION_COUNTS = ['rx_frames', 'rx_bytes', 'tx_frames', 'tx_bytes',
+                       'frames', 'bytes']
+ENDPOINT_COUNTS = ['packets', 'bytes', 'tx_packets', 'tx_bytes',
+                   'rx_packets', 'rx_bytes']
+
+
+def parse_numbers(text):
+    """Return the numbers in ``text``, applying any size units."""
+    values = []
+    for m in _NUMBER.finditer(text):
+        number = m.group(1).replace(',', '')
+        unit = m.group(2)
+        if unit is not None:
+            values.append(int(round(float(number) * UNITS[unit])))
+        elif '.' in number:
+            values.append(float(number))
+        else:
+            values.append(int(number))
+    return values
+
+
+def _split_port(address):
+    """Split ``addr:port`` (IPv6 addresses contain colons too)."""
+    addr, _, port = address.rpartition(':')
+    try:
+        return addr, int(port)
+    except ValueError:
+        return address, None
+
+
+def _report_lines(lines):
+    """The body lines of a report, between its ``=====`` rules and after
+    the column headings."""
+    body = []
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped.startswith('='):
+            continue
+        if '|' in line:
+            # Column headings, anything before is the title
+            body = []
+            continue
+        body.append(line)
+    return body
+
+
+def parse_conversations(lines, proto):
+    """Parse the output of ``-z conv,<proto>``.
+
+    ``tx`` counts are for packets sent from address A to address B and
+    ``rx`` counts for the opposite direction.
+    """
+    ports = proto in PORT_PROTOCOLS
+    records = []
+    for line in _report_lines(lines):
+        m = re.match(r'\s*(\S+)\s+<->\s+(\S+)\s+(.*)$', line)
+        if not m:
+            continue
+        values = parse_numbers(m.group(3))
+        if len(values) != len(CONVERSATION_COUNTS) + 2:
+            logger.warning("Could not parse conversation: %r" % line)
+            continue
+
+        record = []
+        for address in m.group(1, 2):
+            if ports:
+                record.extend(_split_port(address))
+            else:
+                record.append(address)
+        record.extend(values)
+        records.append(record)
+
+    if ports:
+        addresses = ['address_a', 'port_a', 'address_b', 'port_b']
+    else:
+        addresses = ['address_a', 'address_b']
+    columns = addresses + CONVERSATION_COUNTS + ['rel_start', 'duration']
+
+    df = pandas.DataFrame(records, columns=columns)
+    return _typed(df, ints=CONVERSATION_COUNTS, floats=['rel_start',
+                                                        'duration'],
+                  ports=['port_a', 'port_b'] if ports else [])
+
+
+def parse_endpoints(lines, proto):
+    """Parse the output of ``-z endpoints,<proto>``."""
+    ports = proto in PORT_PROTOCOLS
+    records = []
+    for line in _report_lines(lines):
+        tokens = line.split(None, 2 if ports else 1)
+        if len(tokens) < (3 if ports else 2):
+            continue
+        record = tokens[:-1]
+        values = parse_numbers(tokens[-1])
+        if len(values) != len(ENDPOINT_COUNTS):
+            logger.warning("Could not parse endpoint: %r" % line)
+            continue
+        if ports:
+            try:
+                record[1] = int(record[1])
+            except ValueError:
+                record[1] = None
+        records.append(record + values)
+
+    addresses = ['address', 'port'] if ports else ['address']
+    df = pandas.DataFrame(records, columns=addresses + ENDPOINT_COUNTS)
+    return _typed(df, ints=ENDPOINT_COUNTS, ports=['port'] if ports else [])
+
+
+def _cells(line):
+    """Return ``(start, text)`` for each ``|`` separated cell."""
+    cells = []
+    pos = line.index('|') + 1
+    while True:
+        end = line.find('|', pos)
+        if end < 0:
+            break
+        cells.append((pos, line[pos:end]))
+        pos = end + 1
+    return cells
+
+
+def parse_io_stat(lines, exprs=None):
+    """Parse the output of ``-z io,stat,<interval>[,<expr>...]``.
+
+    Returns a DataFrame with the ``start`` and ``end`` of each interval in
+    seconds relative to the first packet, followed by one column per
+    value.  Expressions that produce several values (a plain filter gives
+    frames and bytes) get one column per value, named ``'<expr> <value>'``.
+    """
+    duration = numpy.nan
+    groups = None
+    headings = None
+    rows = []
+
+    for line in lines:
+        if not line.startswith('|'):
+            continue
+        cells = _cells(line)
+        if not cells:
+            continue
+        text = [c[1].strip() for c in cells]
+
+        if '<>' in text[0]:
+            rows.append(text)
+        elif text[0].startswith('Duration:'):
+            m = re.search(r'Duration:\s*([\d.]+)', text[0])
+            if m:
+                duration = float(m.group(1))
+        elif text[0] == 'Interval':
+            headings = cells[1:]
+        elif (text[0] == '' and len(cells) > 1 and
+              all(t.isdigit() for t in text[1:])):
+            groups = [(start, int(t)) for (start, _), t in
+                      zip(cells[1:], text[1:])]
+
+    if headings is None:
+        return None
+
+    ids = [_group_at(groups, start) for start, _ in headings]
+    names = []
+    for (start, heading), group in zip(headings, ids):
+        heading = heading.strip()
+        shared = ids.count(group) > 1
+        if exprs and group <= len(exprs):
+            name = exprs[group - 1]
+            if shared:
+                name = '%s %s' % (name, heading.lower())
+        else:
+            name = heading.lower()
+        names.append(name)
+
+    records = []
+    for text in rows:
+        start, _, end = text[0].partition('<>')
+        start = float(start)
+        end = duration if end.strip() == 'Dur' else float(end)
+        values = []
+        for value in text[1:len(names) + 1]:
+            numbers = parse_numbers(value)
+            values.append(numbers[0] if numbers else numpy.nan)
+        records.append([start, end] + values)
+
+    df = pandas.DataFrame(records, columns=['start', 'end'] + names)
+    for name in names:
+        df[name] = pandas.to_numeric(df[name])
+    return df
+
+
+def _group_at(groups, start):
+    group = 1
+    if groups is not None:
+        for gstart, g in groups:
+            if gstart <= start:
+                group = g
+    return group
+
+
+def _typed(df, ints=(), floats=(), ports=()):
+    for c in ints:
+        df[c] = df[c].astype(numpy.int64)
+    for c in floats:
+        df[c] = df[c].astype(numpy.float64)
+    for c in ports:
+        df[c] = df[c].astype('Int64')
+    return df